@@ -0,0 +1,309 @@
+"""
+Continuous batching of local HF generation.
+
+Concurrent requests for the same model are decoded together, one forward per token for the whole running batch.
+New requests join at token boundaries after their own prompt forward, and finished ones leave, without waiting
+for the rest of the batch.  Each request keeps its own stopping criteria, logits processors, and streamer.
+
+Also batching of reward model scoring, where pairs submitted while a batch is scoring are scored together next.
+"""
+import concurrent.futures
+import copy
+import threading
+import time
+import traceback
+
+import torch
+from transformers import LogitsProcessorList
+
+from utils import NullContext, clear_torch_cache
+
+# decoder-only models with past_key_values as per-layer (key, value) of shape [batch, heads, seq, head_dim]
+# and that take position_ids, so left-padded sequences get correct positions
+supported_model_types = ['gpt2', 'gpt_neox', 'gptj', 'llama']
+
+
+def can_continuous_batch(model, num_beams=1, num_return_sequences=1):
+    config = getattr(model, 'config', None)
+    if config is None or getattr(config, 'is_encoder_decoder', False):
+        return False
+    if config.model_type not in supported_model_types:
+        return False
+    return num_beams == 1 and num_return_sequences == 1
+
+
+class BatchRequest:
+    def __init__(self, input_ids, generation_config, max_new_tokens=256, min_new_tokens=0,
+                 stopping_criteria=None, max_time=None, streamer=None):
+        assert input_ids.shape[0] == 1, "One sequence per request"
+        self.input_ids = input_ids
+        self.generation_config = copy.deepcopy(generation_config)
+        # like generate(), kwargs override generation_config
+        self.generation_config.update(max_new_tokens=max_new_tokens, min_new_tokens=min_new_tokens)
+        self.max_new_tokens = max_new_tokens
+        self.stopping_criteria = stopping_criteria or []
+        self.max_time = max_time
+        self.streamer = streamer
+        eos_token_id = self.generation_config.eos_token_id
+        self.eos_token_ids = [eos_token_id] if isinstance(eos_token_id, int) else list(eos_token_id or [])
+        # full sequence so far, prompt + generated, on cpu
+        self.sequence = input_ids[0].cpu().tolist()
+        self.num_new_tokens = 0
+        self.next_token = None
+        self.start_time = None
+        self.exc = None
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def cancel(self):
+        # e.g. client went away, leave batch at next token
+        self.cancelled = True
+
+    def wait(self, timeout=None):
+        self.done.wait(timeout=timeout)
+        return self.sequence
+
+    def finish(self, exc=None):
+        self.exc = exc
+        if self.streamer is not None:
+            self.streamer.end()
+        self.done.set()
+
+
+class BatchScheduler:
+    """
+    One worker thread per model that runs all submitted requests as one batch
+    """
+
+    def __init__(self, model, device='cuda', use_autocast=False, max_batch_size=8):
+        self.model = model
+        self.device = device
+        self.use_autocast = use_autocast
+        self.max_batch_size = max_batch_size
+        self.pending = []
+        self.cond = threading.Condition()
+        self.thread = None
+        # running batch state
+        self.requests = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+    def submit(self, input_ids, generation_config, **kwargs):
+        request = BatchRequest(input_ids, generation_config, **kwargs)
+        request.start_time = time.time()
+        if request.streamer is not None:
+            # like generate(), streamer first sees prompt
+            request.streamer.put(input_ids.cpu())
+        with self.cond:
+            self.pending.append(request)
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+        return request
+
+    def run(self):
+        # grad and autocast are per-thread, so set here and not just in caller
+        context_class_cast = torch.autocast if self.use_autocast else NullContext
+        with torch.no_grad(), context_class_cast(self.device):
+            while True:
+                with self.cond:
+                    if not self.requests and not self.pending:
+                        self.thread = None
+                        return
+                    new_requests = self.pending[:max(0, self.max_batch_size - len(self.requests))]
+                    self.pending = self.pending[len(new_requests):]
+                try:
+                    for request in new_requests:
+                        self.prefill(request)
+                    if self.requests:
+                        self.step()
+                except BaseException as e:
+                    traceback.print_exc()
+                    # prefill may have already moved some of new_requests into self.requests, finish each once
+                    for request in self.requests + new_requests:
+                        if not request.done.is_set():
+                            request.finish(exc=e)
+                    self.requests = []
+                    self.past_key_values = self.attention_mask = None
+                    clear_torch_cache()
+
+    def prefill(self, request):
+        input_ids = request.input_ids.to(self.model.device)
+        request.logits_processor = self.model._get_logits_processor(
+            generation_config=request.generation_config,
+            input_ids_seq_length=input_ids.shape[-1],
+            encoder_input_ids=input_ids,
+            prefix_allowed_tokens_fn=None,
+            logits_processor=LogitsProcessorList())
+        request.logits_warper = self.model._get_logits_warper(request.generation_config) \
+            if request.generation_config.do_sample else None
+        out = self.model(input_ids=input_ids, use_cache=True)
+        if self.add_token(request, out.logits[:, -1, :]):
+            request.finish()
+            return
+        past_key_values = out.past_key_values
+        attention_mask = torch.ones(1, input_ids.shape[-1], dtype=torch.long, device=input_ids.device)
+        if self.requests:
+            past_key_values, attention_mask = self.merge(past_key_values, attention_mask)
+        self.past_key_values = past_key_values
+        self.attention_mask = attention_mask
+        self.requests.append(request)
+
+    def merge(self, past_key_values, attention_mask):
+        # left pad shorter of running batch and new sequence, then stack along batch
+        length_old = self.attention_mask.shape[1]
+        length_new = attention_mask.shape[1]
+        length = max(length_old, length_new)
+        past_merged = []
+        for (key_old, value_old), (key_new, value_new) in zip(self.past_key_values, past_key_values):
+            key = torch.cat([left_pad(key_old, length - length_old, dim=2),
+                             left_pad(key_new, length - length_new, dim=2)], dim=0)
+            value = torch.cat([left_pad(value_old, length - length_old, dim=2),
+                               left_pad(value_new, length - length_new, dim=2)], dim=0)
+            past_merged.append((key, value))
+        attention_mask = torch.cat([left_pad(self.attention_mask, length - length_old, dim=1),
+                                    left_pad(attention_mask, length - length_new, dim=1)], dim=0)
+        return tuple(past_merged), attention_mask
+
+    def step(self):
+        device = self.attention_mask.device
+        input_ids = torch.tensor([[x.next_token] for x in self.requests], dtype=torch.long, device=device)
+        # position of new token is number of real tokens already in cache
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        attention_mask = torch.cat([self.attention_mask, torch.ones_like(input_ids)], dim=1)
+        out = self.model(input_ids=input_ids, past_key_values=self.past_key_values,
+                         attention_mask=attention_mask, position_ids=position_ids, use_cache=True)
+        self.past_key_values = out.past_key_values
+        self.attention_mask = attention_mask
+        finished = [self.add_token(request, out.logits[batchi:batchi + 1, -1, :])
+                    for batchi, request in enumerate(self.requests)]
+        if any(finished):
+            requests_finished = [x for x, done in zip(self.requests, finished) if done]
+            self.remove([batchi for batchi, done in enumerate(finished) if not done])
+            # only after batch state is consistent, in case waiter then exits
+            [x.finish() for x in requests_finished]
+
+    def remove(self, keep):
+        self.requests = [self.requests[x] for x in keep]
+        if not keep:
+            self.past_key_values = self.attention_mask = None
+            return
+        index = torch.tensor(keep, dtype=torch.long, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # drop left padding no longer needed by any remaining sequence
+        num_pad = int((attention_mask.cumsum(dim=1) == 0).sum(dim=1).min().item())
+        self.attention_mask = attention_mask[:, num_pad:]
+        self.past_key_values = tuple((key.index_select(0, index)[:, :, num_pad:],
+                                      value.index_select(0, index)[:, :, num_pad:])
+                                     for key, value in self.past_key_values)
+
+    def add_token(self, request, logits):
+        """
+        Choose next token for request from its logits, stream it, and check if request is finished
+        :return: True if finished
+        """
+        input_ids = torch.tensor([request.sequence], dtype=torch.long, device=logits.device)
+        scores = request.logits_processor(input_ids, logits.float())
+        if request.logits_warper is not None:
+            scores = request.logits_warper(input_ids, scores)
+            probs = torch.nn.functional.softmax(scores, dim=-1)
+            token = int(torch.multinomial(probs, num_samples=1)[0, 0].item())
+        else:
+            token = int(torch.argmax(scores, dim=-1)[0].item())
+        request.sequence.append(token)
+        request.num_new_tokens += 1
+        request.next_token = token
+        if request.streamer is not None:
+            request.streamer.put(torch.tensor([token]))
+        input_ids = torch.tensor([request.sequence], dtype=torch.long, device=logits.device)
+        return token in request.eos_token_ids or \
+            request.num_new_tokens >= request.max_new_tokens or \
+            request.cancelled or \
+            getattr(request.streamer, 'do_stop', False) or \
+            request.max_time is not None and time.time() - request.start_time > request.max_time or \
+            any(x(input_ids, scores) for x in request.stopping_criteria)
+
+
+def left_pad(x, num, dim):
+    if num == 0:
+        return x
+    shape = list(x.shape)
+    shape[dim] = num
+    return torch.cat([torch.zeros(shape, dtype=x.dtype, device=x.device), x], dim=dim)
+
+
+batch_schedulers = {}
+batch_schedulers_lock = threading.Lock()
+
+
+def get_batch_scheduler(model, device='cuda', use_autocast=False, max_batch_size=8):
+    with batch_schedulers_lock:
+        key = id(model)
+        if key not in batch_schedulers or batch_schedulers[key].model is not model:
+            batch_schedulers[key] = BatchScheduler(model, device=device, use_autocast=use_autocast,
+                                                   max_batch_size=max_batch_size)
+        return batch_schedulers[key]
+
+
+class ScoreScheduler:
+    """
+    One worker thread per reward model that scores all pending (question, answer) pairs together
+    """
+
+    def __init__(self, smodel, stokenizer, max_batch_tokens=None):
+        self.smodel = smodel
+        self.stokenizer = stokenizer
+        self.max_batch_tokens = max_batch_tokens
+        self.pending = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, pairs, max_length_tokenize, cutoff_len):
+        """
+        :param pairs: list of (question, answer), queued together so scored in same batches
+        :return: list of futures of scores, see score_qa_batch
+        """
+        futures = [concurrent.futures.Future() for _ in pairs]
+        with self.lock:
+            self.pending.extend((question, answer, max_length_tokenize, cutoff_len, future)
+                                for (question, answer), future in zip(pairs, futures))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return futures
+
+    def run(self):
+        from generate import score_qa_batch
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.thread = None
+                    return
+                pending, self.pending = self.pending, []
+            # limits only differ if callers differ, e.g. different memory_restriction_level
+            groups = {}
+            for item in pending:
+                groups.setdefault(item[2:4], []).append(item)
+            for (max_length_tokenize, cutoff_len), items in groups.items():
+                try:
+                    scores = score_qa_batch(self.smodel, self.stokenizer, max_length_tokenize,
+                                            [x[0] for x in items], [x[1] for x in items], cutoff_len,
+                                            max_batch_tokens=self.max_batch_tokens)
+                except BaseException as e:
+                    traceback.print_exc()
+                    [x[4].set_exception(e) for x in items]
+                else:
+                    [x[4].set_result(score) for x, score in zip(items, scores)]
+            clear_torch_cache()
+
+
+score_schedulers = {}
+
+
+def get_score_scheduler(smodel, stokenizer, max_batch_tokens=None):
+    with batch_schedulers_lock:
+        key = id(smodel)
+        if key not in score_schedulers or score_schedulers[key].smodel is not smodel:
+            score_schedulers[key] = ScoreScheduler(smodel, stokenizer, max_batch_tokens=max_batch_tokens)
+        return score_schedulers[key]
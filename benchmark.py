@@ -0,0 +1,412 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import queue
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fire
+import numpy as np
+
+from enums import DocumentChoices
+
+
+class StubTGIHandler(BaseHTTPRequestHandler):
+    """
+    Stand-in for HF text-generation-inference server, emits tokens at server's rate, as text_generation client expects
+    """
+    # chunked transfer, so each event reaches client as soon as sent, like TGI
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        # sanity check of server by clients
+        self.send_json(dict(status='ok'))
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        parameters = request.get('parameters') or {}
+        tokens = get_stub_tokens(parameters.get('max_new_tokens') or 20)
+        time.sleep(self.server.ttft)
+        if not request.get('stream'):
+            time.sleep((len(tokens) - 1) / self.server.tokens_per_second)
+            generated_text = ''.join(tokens)
+            if parameters.get('return_full_text'):
+                generated_text = request['inputs'] + generated_text
+            token_dicts = [dict(id=i, text=x, logprob=0.0, special=False) for i, x in enumerate(tokens)]
+            details = dict(finish_reason='length', generated_tokens=len(tokens), seed=parameters.get('seed'),
+                           prefill=[], tokens=token_dicts, best_of_sequences=None)
+            self.send_json([dict(generated_text=generated_text, details=details)])
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i, token in enumerate(tokens):
+            if i > 0:
+                time.sleep(1.0 / self.server.tokens_per_second)
+            last = i == len(tokens) - 1
+            payload = dict(token=dict(id=i, text=token, logprob=0.0, special=False),
+                           generated_text=''.join(tokens) if last else None,
+                           details=dict(finish_reason='length', generated_tokens=len(tokens),
+                                        seed=parameters.get('seed')) if last else None)
+            event = b'data:' + json.dumps(payload).encode('utf-8') + b'\n\n'
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(event), event))
+            self.wfile.flush()
+        self.wfile.write(b'0\r\n\r\n')
+
+    def send_json(self, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_stub_tokens(max_new_tokens):
+    # same output for every request, so runs are comparable
+    return [' word%d' % i for i in range(max_new_tokens)]
+
+
+def start_stub_tgi_server(port=0, tokens_per_second=50.0, ttft=0.05):
+    """
+    :param port: 0 picks free port
+    :param tokens_per_second: rate tokens are emitted after first token
+    :param ttft: seconds before first token
+    :return: server, url
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubTGIHandler)
+    server.daemon_threads = True
+    server.tokens_per_second = tokens_per_second
+    server.ttft = ttft
+    threading.Thread(target=server.serve_forever, name='stub_tgi', daemon=True).start()
+    return server, 'http://127.0.0.1:%s' % server.server_port
+
+
+def start_stub_gradio_server(port=7869, tokens_per_second=50.0, ttft=0.05, concurrency_count=64, queue=True):
+    """
+    Stand-in for upstream h2oGPT gradio server, only the APIs used by evaluate() and get_llm() as gradio client
+    :param queue: whether to enable gradio queue, needed for stream_output, else served over plain HTTP
+    :return: demo, url
+    """
+    os.environ['GRADIO_ANALYTICS_ENABLED'] = 'False'
+    import ast
+    import gradio as gr
+
+    def submit_nochat_api(instruction_dict_str):
+        kwargs = ast.literal_eval(instruction_dict_str)
+        tokens = get_stub_tokens(kwargs.get('max_new_tokens') or 20)
+        time.sleep(ttft)
+        for i in range(len(tokens)):
+            if i > 0:
+                time.sleep(1.0 / tokens_per_second)
+            if kwargs.get('stream_output') or i == len(tokens) - 1:
+                yield str(dict(response=''.join(tokens[:i + 1]), sources=''))
+
+    def submit_nochat_api_final(instruction_dict_str):
+        # gradio only allows generators with queue
+        return list(submit_nochat_api(instruction_dict_str))[-1]
+
+    with gr.Blocks() as demo:
+        text_input = gr.Textbox(visible=False)
+        text_output = gr.Textbox(visible=False)
+        submit_button = gr.Button(visible=False)
+        hash_button = gr.Button(visible=False)
+        submit_button.click(submit_nochat_api if queue else submit_nochat_api_final, inputs=text_input,
+                            outputs=text_output, api_name='submit_nochat_api')
+        hash_button.click(lambda: 'stub', inputs=None, outputs=text_output, api_name='system_hash')
+    if queue:
+        demo.queue(concurrency_count=concurrency_count)
+    demo.launch(server_name='127.0.0.1', server_port=port, prevent_thread_lock=True)
+    return demo, 'http://127.0.0.1:%s' % port
+
+
+class HashEmbeddings:
+    """
+    Deterministic embedding from hash of text, so retrieval is measured without embedding model cost or download
+    """
+
+    def __init__(self, size=384):
+        self.size = size
+
+    def embed(self, text):
+        seed = int.from_bytes(hashlib.sha256(text.encode('utf-8')).digest()[:4], 'little')
+        vector = np.random.RandomState(seed).normal(size=self.size)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def embed_documents(self, texts):
+        return [self.embed(x) for x in texts]
+
+    def embed_query(self, text):
+        return self.embed(text)
+
+
+def get_benchmark_db(num_docs=1000, hf_embedding_model='fake', persist_directory=None):
+    """
+    Chroma db of synthetic documents
+    :param hf_embedding_model: 'fake' for HashEmbeddings, else HF embedding model name
+    """
+    from langchain.docstore.document import Document
+    from langchain.vectorstores import Chroma
+    from gpt_langchain import get_embedding
+    if hf_embedding_model == 'fake':
+        embedding = HashEmbeddings()
+    else:
+        embedding = get_embedding(False, hf_embedding_model=hf_embedding_model)
+    persist_directory = persist_directory or tempfile.mkdtemp()
+    sources = [Document(page_content="Document %d is about topic %d and mentions item_%d. " % (i, i % 17, i) * 10,
+                        metadata=dict(source='doc%d.txt' % i)) for i in range(num_docs)]
+    db = Chroma.from_documents(documents=sources, embedding=embedding, persist_directory=persist_directory,
+                               collection_name='UserData')
+    return db
+
+
+def get_benchmark_tokenizer(tokenizer_base_model=None, model_max_length=2048):
+    if tokenizer_base_model:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(tokenizer_base_model)
+        tokenizer.model_max_length = model_max_length
+        return tokenizer
+    from utils import FakeTokenizer
+    return FakeTokenizer(model_max_length=model_max_length)
+
+
+def get_client(backend, url):
+    if backend == 'gradio':
+        from gradio_utils.grclient import GradioClient
+        return GradioClient(url)
+    from text_generation import Client as HFClient
+    return HFClient(url, timeout=300)
+
+
+def get_prompt_text(prompt_chars, request_id):
+    # long prompts exercise prompt truncation, request_id keeps prompts distinct
+    base = "Request %d: summarize what documents say about item_%d. " % (request_id, request_id)
+    return (base * (1 + prompt_chars // len(base)))[:max(prompt_chars, len(base))]
+
+
+def iter_evaluate(client, url, tokenizer, prompt, stream_output, max_new_tokens, db=None):
+    from generate import evaluate
+    model_state = dict(model=client, tokenizer=tokenizer, device='cpu', base_model='stub',
+                       tokenizer_base_model='', lora_weights='', inference_server=url,
+                       prompt_type='human_bot', prompt_dict='')
+    langchain_mode = 'UserData' if db is not None else 'Disabled'
+    # like CLI model, so evaluate() uses model_state0
+    for res in evaluate(dict(model='model'), [None], model_state0=model_state,
+                        instruction='', iinput='', context='', stream_output=stream_output,
+                        prompt_type='human_bot', prompt_dict='',
+                        temperature=0.1, top_p=0.75, top_k=40, num_beams=1,
+                        max_new_tokens=max_new_tokens, min_new_tokens=0, early_stopping=False,
+                        max_time=600, repetition_penalty=1.07, num_return_sequences=1, do_sample=False,
+                        chat=False, instruction_nochat=prompt, iinput_nochat='',
+                        langchain_mode=langchain_mode, top_k_docs=4, chunk=True, chunk_size=512,
+                        document_choice=[DocumentChoices.All_Relevant.name],
+                        concurrency_count=64, memory_restriction_level=0, raise_generate_gpu_exceptions=True,
+                        chat_context=False, use_openai_embedding=False, use_openai_model=False,
+                        hf_embedding_model='fake', db_type='chroma', n_jobs=1, first_para=False,
+                        dbs={langchain_mode: db} if db is not None else {}, max_max_new_tokens=max_new_tokens,
+                        max_max_time=600, auto_reduce_chunks=False, max_chunks=100, hybrid_search=False):
+        yield res['response']
+
+
+def iter_get_llm(client, url, tokenizer, prompt, stream_output, max_new_tokens, db=None):
+    from gpt_langchain import get_llm
+    from prompter import Prompter
+    from utils import EThread
+    prompter = Prompter('human_bot', '', chat=False, stream_output=stream_output)
+    llm, model_name, streamer, prompt_type = get_llm(model_name='stub', model=client, tokenizer=tokenizer,
+                                                     inference_server=url, stream_output=stream_output,
+                                                     max_new_tokens=max_new_tokens, max_time=600,
+                                                     prompt_type='human_bot', prompt_dict='', prompter=prompter)
+    if not stream_output:
+        yield llm(prompt)
+        return
+    bucket = queue.Queue()
+    thread = EThread(target=llm, args=(prompt,), streamer=streamer, bucket=bucket)
+    thread.start()
+    outputs = None
+    try:
+        for new_text in streamer:
+            if outputs is None:
+                # streamer gets prompt first
+                outputs = ''
+                continue
+            outputs += new_text
+            yield outputs
+    finally:
+        thread.join()
+
+
+def iter_run_qa_db(client, url, tokenizer, prompt, stream_output, max_new_tokens, db=None):
+    from gpt_langchain import run_qa_db
+    from prompter import Prompter
+    prompter = Prompter('human_bot', '', chat=False, stream_output=stream_output)
+    for ret, extra in run_qa_db(query=prompt, model_name='stub', model=client, tokenizer=tokenizer,
+                                inference_server=url, stream_output=stream_output, prompter=prompter,
+                                prompt_type='human_bot', prompt_dict='',
+                                use_openai_model=False, use_openai_embedding=False, hf_embedding_model='fake',
+                                first_para=False, text_limit=None, top_k_docs=4, chunk=True, chunk_size=512,
+                                user_path=None, detect_user_path_changes_every_query=False, db_type='chroma',
+                                cut_distanct=1e10, sanitize_bot_response=False, load_db_if_exists=True, db=db,
+                                do_sample=False, temperature=0.1, top_k=40, top_p=0.75, num_beams=1,
+                                max_new_tokens=max_new_tokens, min_new_tokens=0, early_stopping=False,
+                                max_time=600, repetition_penalty=1.07, num_return_sequences=1,
+                                langchain_mode='UserData', document_choice=[DocumentChoices.All_Relevant.name],
+                                n_jobs=1, verbose=False, cli=False, reverse_docs=True, lora_weights='',
+                                auto_reduce_chunks=False, max_chunks=100, hybrid_search=False):
+        yield ret
+
+
+benchmark_targets = dict(evaluate=iter_evaluate, get_llm=iter_get_llm, run_qa_db=iter_run_qa_db)
+
+
+def measure_request(iter_func, tokenizer, **kwargs):
+    """
+    :return: dict of time to first output, gaps between changed outputs, duration, and tokens of final output
+    """
+    t0 = time.time()
+    output_times = []
+    last = ''
+    for output in iter_func(tokenizer=tokenizer, **kwargs):
+        if output and output != last:
+            output_times.append(time.time())
+            last = output
+    t1 = time.time()
+    num_tokens = len(tokenizer(last)['input_ids']) if last else 0
+    return dict(ttft=output_times[0] - t0 if output_times else None,
+                itl=np.diff(output_times).tolist(),
+                duration=t1 - t0,
+                num_tokens=num_tokens)
+
+
+def percentiles(values, qs=(50, 99)):
+    values = [x for x in values if x is not None]
+    if not values:
+        return {'p%d' % q: None for q in qs}
+    return {'p%d' % q: float(np.percentile(values, q)) for q in qs}
+
+
+def summarize(measures, wall_time):
+    tokens_per_second = [x['num_tokens'] / x['duration'] for x in measures if x['duration'] > 0 and x['num_tokens']]
+    summary = dict(num_requests=len(measures),
+                   ttft=percentiles([x['ttft'] for x in measures]),
+                   itl=percentiles([y for x in measures for y in x['itl']]),
+                   duration=percentiles([x['duration'] for x in measures]),
+                   tokens_per_second=percentiles(tokens_per_second),
+                   total_tokens_per_second=sum(x['num_tokens'] for x in measures) / wall_time if wall_time else None)
+    return summary
+
+
+def run_benchmark(backends=('tgi',),
+                  targets=('evaluate', 'get_llm', 'run_qa_db'),
+                  concurrency=(1, 4),
+                  num_requests=8,
+                  stream_output=True,
+                  max_new_tokens=64,
+                  tokens_per_second=50.0,
+                  ttft=0.05,
+                  prompt_chars=2000,
+                  num_docs=1000,
+                  hf_embedding_model='fake',
+                  tokenizer_base_model=None,
+                  gradio_port=7869,
+                  gradio_queue=True,
+                  output_file='benchmark_baseline.json',
+                  ):
+    """
+    Measure latency and throughput of h2oGPT streaming, prompt handling, and retrieval against local stand-ins
+    for inference servers that emit tokens at fixed rate, so runs on CPU-only machine and are comparable across commits
+
+    python benchmark.py --backends="['tgi','gradio']" --concurrency="[1,4,16]" --output_file=benchmark_baseline.json
+
+    :param backends: 'tgi' for stand-in HF text-generation-inference server, 'gradio' for stand-in h2oGPT gradio server
+    :param targets: functions to drive: 'evaluate', 'get_llm', 'run_qa_db'
+    :param concurrency: list of number of concurrent requests
+    :param num_requests: requests per backend, target, and concurrency
+    :param stream_output: whether to stream, else inter-token latency is not measured
+    :param max_new_tokens: tokens generated by stand-in per request
+    :param tokens_per_second: rate stand-in emits tokens for each request
+    :param ttft: stand-in delay before first token
+    :param prompt_chars: characters of each prompt
+    :param num_docs: documents in synthetic db for run_qa_db
+    :param hf_embedding_model: 'fake' for deterministic hash embedding, else HF embedding model name
+    :param tokenizer_base_model: HF tokenizer to use, else FakeTokenizer (tiktoken) like for inference servers
+    :param gradio_port: port for stand-in gradio server
+    :param gradio_queue: whether stand-in gradio server uses queue, False serves over HTTP, only for no stream_output
+    :param output_file: JSON file for results, None to not write
+    :return: dict of results
+    """
+    if isinstance(backends, str):
+        backends = [backends]
+    if isinstance(targets, str):
+        targets = [targets]
+    if isinstance(concurrency, int):
+        concurrency = [concurrency]
+    tokenizer = get_benchmark_tokenizer(tokenizer_base_model)
+    db = get_benchmark_db(num_docs=num_docs, hf_embedding_model=hf_embedding_model) \
+        if 'run_qa_db' in targets else None
+
+    config = dict(backends=list(backends), targets=list(targets), concurrency=list(concurrency),
+                  num_requests=num_requests, stream_output=stream_output, max_new_tokens=max_new_tokens,
+                  tokens_per_second=tokens_per_second, ttft=ttft, prompt_chars=prompt_chars, num_docs=num_docs,
+                  hf_embedding_model=hf_embedding_model, tokenizer_base_model=tokenizer_base_model)
+    results = []
+    for backend in backends:
+        if backend == 'tgi':
+            server, url = start_stub_tgi_server(tokens_per_second=tokens_per_second, ttft=ttft)
+        elif backend == 'gradio':
+            server, url = start_stub_gradio_server(port=gradio_port, tokens_per_second=tokens_per_second, ttft=ttft,
+                                                   queue=gradio_queue)
+        else:
+            raise ValueError("No such backend %s" % backend)
+        try:
+            client = get_client(backend, url)
+            for target in targets:
+                # first request pays for imports and client setup, not part of steady state
+                measure_request(benchmark_targets[target], tokenizer, client=client, url=url,
+                                prompt=get_prompt_text(prompt_chars, -1), stream_output=stream_output,
+                                max_new_tokens=max_new_tokens, db=db if target == 'run_qa_db' else None)
+                for concurrency1 in concurrency:
+                    t0 = time.time()
+                    with concurrent.futures.ThreadPoolExecutor(concurrency1) as executor:
+                        futures = [executor.submit(measure_request, benchmark_targets[target], tokenizer,
+                                                   client=client, url=url,
+                                                   prompt=get_prompt_text(prompt_chars, request_id),
+                                                   stream_output=stream_output, max_new_tokens=max_new_tokens,
+                                                   db=db if target == 'run_qa_db' else None)
+                                   for request_id in range(num_requests)]
+                        measures = [x.result() for x in futures]
+                    num_empty = len([x for x in measures if x['num_tokens'] == 0])
+                    # stand-ins always generate, so no output is a bug, not something to average over
+                    assert num_empty == 0, "%s %s concurrency=%s: %d of %d requests had no output" % (
+                        backend, target, concurrency1, num_empty, len(measures))
+                    wall_time = time.time() - t0
+                    result = dict(backend=backend, target=target, concurrency=concurrency1,
+                                  **summarize(measures, wall_time))
+                    print("%s %s concurrency=%s: ttft p50=%s p99=%s itl p50=%s p99=%s tokens/s p50=%s total=%s" % (
+                        backend, target, concurrency1, result['ttft']['p50'], result['ttft']['p99'],
+                        result['itl']['p50'], result['itl']['p99'], result['tokens_per_second']['p50'],
+                        result['total_tokens_per_second']), flush=True)
+                    results.append(result)
+        finally:
+            if backend == 'tgi':
+                server.shutdown()
+            else:
+                server.close()
+
+    benchmark = dict(time=time.time(), config=config, results=results)
+    if output_file:
+        with open(output_file, 'wt') as f:
+            json.dump(benchmark, f, indent=2)
+        print("Wrote %s" % output_file, flush=True)
+    return benchmark
+
+
+if __name__ == "__main__":
+    fire.Fire(run_benchmark)
@@ -31,8 +31,9 @@ def run_cli(  # for local function:
         use_openai_embedding=None, use_openai_model=None, hf_embedding_model=None,
         db_type=None, n_jobs=None, first_para=None, text_limit=None, verbose=None, cli=None, reverse_docs=None,
         use_cache=None,
-        auto_reduce_chunks=None, max_chunks=None, model_lock=None, force_langchain_evaluate=None,
+        auto_reduce_chunks=None, max_chunks=None, hybrid_search=None, model_lock=None, force_langchain_evaluate=None,
         model_state_none=None,
+        continuous_batching=None,
         # unique to this function:
         cli_loop=None,
 ):
@@ -1,6 +1,9 @@
+import hashlib
 import inspect
+import json
 import os
-import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 import numpy as np
 import pandas as pd
 import torch
@@ -9,6 +12,7 @@ from matplotlib import pyplot as plt
 from generate import eval_func_param_names, eval_extra_columns, get_context, get_score_model, get_model, evaluate, \
     inputs_kwargs_list, check_locals
 from prompter import Prompter
+from batching import get_score_scheduler
 from utils import clear_torch_cache, NullContext, get_kwargs
 
 
@@ -50,9 +54,11 @@ def run_eval(  # for local function:
         use_openai_embedding=None, use_openai_model=None, hf_embedding_model=None,
         db_type=None, n_jobs=None, first_para=None, text_limit=None, verbose=None, cli=None, reverse_docs=None,
         use_cache=None,
-        auto_reduce_chunks=None, max_chunks=None,
+        auto_reduce_chunks=None, max_chunks=None, hybrid_search=None,
         model_lock=None, force_langchain_evaluate=None,
         model_state_none=None,
+        continuous_batching=None,
+        eval_concurrency=None, eval_save_every=None, eval_resume=None,
 ):
     check_locals(**locals())
 
@@ -155,98 +161,148 @@ def run_eval(  # for local function:
 
             def get_response(*args, exi=0):
                 # assumes same ordering of examples and responses
-                yield responses[exi]
+                yield dict(response=responses[exi], sources='')
 
             fun = get_response
         t0 = time.time()
-        score_dump = []
+        if memory_restriction_level > 0:
+            cutoff_len = 768 if memory_restriction_level <= 2 else 512
+        else:
+            # only used for scoring
+            cutoff_len = (stokenizer if eval_as_output else tokenizer).model_max_length if smodel else None
+
+        # one row per scored response, appended as done so can resume after crash
+        checkpoint_filename = eval_out_filename.replace('.parquet', '.jsonl')
+        if not eval_resume and os.path.isfile(checkpoint_filename):
+            os.remove(checkpoint_filename)
+        score_dump = load_eval_checkpoint(checkpoint_filename)
+        # rows from other examples, e.g. changed eval_filename, eval_prompts_only_num or seed, would mix in silently
+        if any(x[0] >= num_examples or x[1] != get_example_hash(examples[x[0]]) for x in score_dump):
+            print("Checkpoint %s is for other examples, restarting" % checkpoint_filename, flush=True)
+            os.remove(checkpoint_filename)
+            score_dump = []
+        done_exis = set(x[0] for x in score_dump)
+        if done_exis:
+            print("Resuming from %s: %s of %s examples already done" % (checkpoint_filename, len(done_exis),
+                                                                       num_examples), flush=True)
         score_avg = 0
         score_median = 0
 
-        for exi, ex in enumerate(examples):
-            clear_torch_cache()
+        def get_responses(exi, ex):
+            # device context is per-thread
+            with context_class(device):
+                return _get_responses(exi, ex)
 
+        def _get_responses(exi, ex):
+            clear_torch_cache()
             instruction = ex[eval_func_param_names.index('instruction_nochat')]
             iinput = ex[eval_func_param_names.index('iinput_nochat')]
             context = ex[eval_func_param_names.index('context')]
-            clear_torch_cache()
-            print("")
-            print("START" + "=" * 100)
-            print("Question: %s %s" % (instruction, ('input=%s' % iinput if iinput else '')))
-            print("-" * 105)
             # fun yields as generator, so have to iterate over it
             # Also means likely do NOT want --stream_output=True, else would show all generations
             t1 = time.time()
             gener = fun(*tuple(ex), exi=exi) if eval_as_output else fun(*tuple(ex))
-            for res_fun in gener:
-                res = res_fun['response']
-                extra = res_fun['sources']
-                print(res)
-                if smodel:
-                    score_with_prompt = False
-                    if score_with_prompt:
-                        data_point = dict(instruction=instruction, input=iinput, context=context)
-                        prompter = Prompter(prompt_type, prompt_dict,
-                                            debug=debug, chat=chat, stream_output=stream_output)
-                        prompt = prompter.generate_prompt(data_point)
-                    else:
-                        # just raw input and output
-                        if eval_prompts_only_num > 0:
-                            # only our own examples have this filled at moment
-                            assert iinput in [None, ''], iinput  # should be no iinput
-                        if not (chat_context and prompt_type == 'human_bot'):
-                            assert context in [None, ''], context  # should be no context
-                        prompt = instruction
-                    if memory_restriction_level > 0:
-                        cutoff_len = 768 if memory_restriction_level <= 2 else 512
-                    else:
-                        cutoff_len = tokenizer.model_max_length
-                    inputs = stokenizer(prompt, res,
-                                        return_tensors="pt",
-                                        truncation=True,
-                                        max_length=cutoff_len)
-                    try:
-                        score = torch.sigmoid(smodel(**inputs).logits[0].float()).cpu().detach().numpy()[0]
-                    except torch.cuda.OutOfMemoryError as e:
-                        print("GPU OOM 1: question: %s answer: %s exception: %s" % (prompt, res, str(e)),
-                              flush=True)
-                        traceback.print_exc()
+            res_list = [res_fun['response'] for res_fun in gener]
+            # still checkpointed without score model, so progress kept
+            scores = [(instruction, res, None) for res in res_list]
+            if smodel:
+                score_with_prompt = False
+                if score_with_prompt:
+                    data_point = dict(instruction=instruction, input=iinput, context=context)
+                    prompter = Prompter(prompt_type, prompt_dict,
+                                        debug=debug, chat=chat, stream_output=stream_output)
+                    prompt = prompter.generate_prompt(data_point)
+                else:
+                    # just raw input and output
+                    if eval_prompts_only_num > 0:
+                        # only our own examples have this filled at moment
+                        assert iinput in [None, ''], iinput  # should be no iinput
+                    if not (chat_context and prompt_type == 'human_bot'):
+                        assert context in [None, ''], context  # should be no context
+                    prompt = instruction
+                # scored in same batch as other examples finishing at same time
+                futures = get_score_scheduler(smodel, stokenizer).submit([(prompt, res) for res in res_list],
+                                                                         cutoff_len, cutoff_len * 4)
+                scores = [(prompt, res, future.result()) for res, future in zip(res_list, futures)]
+            return exi, ex, res_list, scores, time.time() - t1
+
+        todo = [(exi, ex) for exi, ex in enumerate(examples) if exi not in done_exis]
+        with ThreadPoolExecutor(max_workers=eval_concurrency) as executor:
+            futures = [executor.submit(get_responses, exi, ex) for exi, ex in todo]
+            for donei, future in enumerate(as_completed(futures)):
+                exi, ex, res_list, scores, dt = future.result()
+                instruction = ex[eval_func_param_names.index('instruction_nochat')]
+                iinput = ex[eval_func_param_names.index('iinput_nochat')]
+                print("")
+                print("START" + "=" * 100)
+                print("Question: %s %s" % (instruction, ('input=%s' % iinput if iinput else '')))
+                print("-" * 105)
+                [print(res) for res in res_list]
+                for prompt, res, score in scores:
+                    if isinstance(score, str):
+                        # GPU OOM or error
                         score = 0.0
-                        clear_torch_cache()
-                    except (Exception, RuntimeError) as e:
-                        if 'Expected all tensors to be on the same device' in str(e) or \
-                                'expected scalar type Half but found Float' in str(e) or \
-                                'probability tensor contains either' in str(e) or \
-                                'cublasLt ran into an error!' in str(e):
-                            print("GPU error: question: %s answer: %s exception: %s" % (prompt, res, str(e)),
-                                  flush=True)
-                            traceback.print_exc()
-                            score = 0.0
-                            clear_torch_cache()
-                        else:
-                            raise
-                    score_dump.append(ex + [prompt, res, score])
-                    # dump every score in case abort
-                    df_scores = pd.DataFrame(score_dump,
-                                             columns=eval_func_param_names + eval_extra_columns)
-                    df_scores.to_parquet(eval_out_filename, index=False)
-                    # plot histogram so far
-                    plt.figure(figsize=(10, 10))
-                    plt.hist(df_scores['score'], bins=20)
-                    score_avg = np.mean(df_scores['score'])
-                    score_median = np.median(df_scores['score'])
-                    print("SCORE %s: %s  So far: AVG: %s MEDIAN: %s" % (exi, score, score_avg, score_median),
-                          flush=True)
-                    plt.title("Score avg: %s median: %s" % (score_avg, score_median))
-                    plt.savefig(eval_out_filename.replace('.parquet', '.png'))
-                    plt.close()
-
-            print("END" + "=" * 102)
-            print("")
-            t2 = time.time()
-            print("Time taken for example: %s Time taken so far: %.4f about %.4g per example" % (
-                t2 - t1, t2 - t0, (t2 - t0) / (1 + exi)))
+                    score_dump.append([exi, get_example_hash(ex)] + ex +
+                                      [prompt, res, float(score) if score is not None else None])
+                    append_eval_checkpoint(checkpoint_filename, score_dump[-1])
+                    print("SCORE %s: %s" % (exi, score), flush=True)
+                if smodel and ((donei + 1) % eval_save_every == 0 or donei + 1 == len(todo)):
+                    score_avg, score_median = save_eval_scores(score_dump, eval_out_filename)
+                    print("So far: AVG: %s MEDIAN: %s" % (score_avg, score_median), flush=True)
+                print("END" + "=" * 102)
+                print("")
+                t2 = time.time()
+                print("Time taken for example: %s Time taken so far: %.4f about %.4g per example" % (
+                    dt, t2 - t0, (t2 - t0) / (1 + donei)))
+        if smodel and score_dump and not todo:
+            # all done before, just ensure parquet and plot match checkpoint
+            score_avg, score_median = save_eval_scores(score_dump, eval_out_filename)
         t1 = time.time()
-        print("Total time taken: %.4f about %.4g per example" % (t1 - t0, (t1 - t0) / num_examples))
+        print("Total time taken: %.4f about %.4g per example" % (t1 - t0, (t1 - t0) / max(1, len(todo))))
         print("Score avg: %s median: %s" % (score_avg, score_median), flush=True)
     return eval_out_filename
+
+
+def get_example_hash(ex):
+    instruction = ex[eval_func_param_names.index('instruction_nochat')]
+    iinput = ex[eval_func_param_names.index('iinput_nochat')]
+    return hashlib.sha256(json.dumps([instruction, iinput]).encode('utf-8')).hexdigest()
+
+
+def load_eval_checkpoint(checkpoint_filename):
+    """
+    :return: rows of example index, hash of example instruction, example, prompt, response, and score already done
+    """
+    score_dump = []
+    if not os.path.isfile(checkpoint_filename):
+        return score_dump
+    with open(checkpoint_filename, 'rt') as f:
+        for line in f:
+            try:
+                score_dump.append(json.loads(line))
+            except json.JSONDecodeError:
+                # partial last line if crashed while writing
+                print("Skipping bad line in %s: %s" % (checkpoint_filename, line), flush=True)
+    return score_dump
+
+
+def append_eval_checkpoint(checkpoint_filename, row):
+    with open(checkpoint_filename, 'at') as f:
+        f.write(json.dumps(row, default=str) + '\n')
+        f.flush()
+
+
+def save_eval_scores(score_dump, eval_out_filename):
+    # same order as examples, regardless of order finished
+    score_dump = sorted(score_dump, key=lambda x: x[0])
+    df_scores = pd.DataFrame([x[2:] for x in score_dump], columns=eval_func_param_names + eval_extra_columns)
+    df_scores.to_parquet(eval_out_filename, index=False)
+    # plot histogram so far
+    plt.figure(figsize=(10, 10))
+    plt.hist(df_scores['score'], bins=20)
+    score_avg = np.mean(df_scores['score'])
+    score_median = np.median(df_scores['score'])
+    plt.title("Score avg: %s median: %s" % (score_avg, score_median))
+    plt.savefig(eval_out_filename.replace('.parquet', '.png'))
+    plt.close()
+    return score_avg, score_median
@@ -1,4 +1,5 @@
 import ast
+import contextlib
 import copy
 import functools
 import glob
@@ -6,11 +7,13 @@ import inspect
 import queue
 import sys
 import os
+import threading
 import time
 import traceback
 import types
 import typing
 import warnings
+from collections import OrderedDict
 from datetime import datetime
 import filelock
 import requests
@@ -32,6 +35,9 @@ from enums import DocumentChoices, LangChainMode, no_lora_str, model_token_mappi
 from loaders import get_loaders
 from utils import set_seed, clear_torch_cache, save_generate_output, NullContext, wrapped_partial, EThread, get_githash, \
     import_matplotlib, get_device, makedirs, get_kwargs, start_faulthandler, get_hf_server, FakeTokenizer, remove
+from gradio_utils.stream_queue import StreamQueue
+from utils_metrics import track_generation, start_metrics_server, dump_metrics_json, startup_seconds, startup_phase, \
+    record_startup_phase, print_startup_phases
 
 start_faulthandler()
 import_matplotlib()
@@ -66,12 +72,14 @@ def main(
         gpu_id: int = 0,
         compile_model: bool = True,
         use_cache: bool = None,
+        continuous_batching: bool = False,
         inference_server: str = "",
         prompt_type: Union[int, str] = None,
         prompt_dict: typing.Dict = None,
 
         model_lock: typing.List[typing.Dict[str, str]] = None,
         model_lock_columns: int = None,
+        model_load_workers: int = None,
         fail_if_cannot_connect: bool = False,
 
         # input to generation
@@ -136,6 +144,9 @@ def main(
         eval_prompts_only_num: int = 0,
         eval_prompts_only_seed: int = 1234,
         eval_as_output: bool = False,
+        eval_concurrency: int = 1,
+        eval_save_every: int = 100,
+        eval_resume: bool = False,
 
         langchain_mode: str = 'Disabled',
         force_langchain_evaluate: bool = False,
@@ -160,12 +171,17 @@ def main(
         reverse_docs: bool = True,
         auto_reduce_chunks: bool = True,
         max_chunks: int = 100,
+        hybrid_search: bool = False,
         n_jobs: int = -1,
         enable_captions: bool = True,
         captions_model: str = "Salesforce/blip-image-captioning-base",
         pre_load_caption_model: bool = False,
         caption_gpu: bool = True,
         enable_ocr: bool = False,
+        parse_cache_dir: str = None,
+
+        metrics_port: int = None,
+        metrics_json: str = None,
 ):
     """
 
@@ -179,6 +195,8 @@ def main(
     :param gpu_id: if infer_devices, then use gpu_id for cuda device ID, or auto mode if gpu_id != -1
     :param compile_model Whether to compile the model
     :param use_cache: Whether to use caching in model (some models fail when multiple threads use)
+    :param continuous_batching: Whether to batch concurrent local HF generations together token by token
+           Only for gpt2, gpt_neox, gptj, llama model types without beams or multiple return sequences
     :param inference_server: Consume base_model as type of model at this address
                              Address can be text-generation-server hosting that base_model
                              e.g. python generate.py --inference_server="http://192.168.1.46:6112" --base_model=h2oai/h2ogpt-oasst1-512-12b
@@ -201,6 +219,10 @@ def main(
            If None, then defaults to up to 3
            if -1, then all goes into 1 row
            Maximum value is 4 due to non-dynamic gradio rendering elements
+    :param model_load_workers: How many local models (model_lock or base_model, and score_model) to load at the same
+           time at startup.  Inference server models always load alongside.  UI opens once all models are loaded.
+           If None, local models load at the same time as long as their weights, estimated from model config,
+           fit in free GPU memory (or CPU memory if no GPUs), and any model whose size cannot be estimated loads alone
     :param fail_if_cannot_connect: if doing model locking (e.g. with many models), fail if True.  Otherwise ignore.
            Useful when many endpoints and want to just see what works, but still have to wait for timeout.
     :param temperature: generation temperature
@@ -265,6 +287,11 @@ def main(
     :param eval_prompts_only_num: for no gradio benchmark, if using eval_filename prompts for eval instead of examples
     :param eval_prompts_only_seed: for no gradio benchmark, seed for eval_filename sampling
     :param eval_as_output: for no gradio benchmark, whether to test eval_filename output itself
+    :param eval_concurrency: for no gradio benchmark, number of examples to generate at once (local model or inference_server),
+           responses finishing together are scored in same batch
+    :param eval_save_every: for no gradio benchmark, write parquet and plot of scores every this many examples (and at end)
+    :param eval_resume: for no gradio benchmark, skip examples already scored in checkpoint from previous run with same settings,
+           e.g. after crash.  If False, checkpoint is started over
     :param langchain_mode: Data source to include.  Choose "UserData" to only consume files from make_db.py.
            WARNING: wiki_full requires extra data processing via read_wiki_full.py and requires really good workstation to generate db, unless already present.
     :param force_langchain_evaluate: Whether to force langchain LLM use even if not doing langchain, mostly for testing.
@@ -282,6 +309,7 @@ def main(
     :param load_db_if_exists: Whether to load chroma db if exists or re-generate db
     :param keep_sources_in_context: Whether to keep url sources in context, not helpful usually
     :param db_type: 'faiss' for in-memory or 'chroma' or 'weaviate' for persisted on disk
+           or 'faiss_mmap' for faiss persisted on disk and memory-mapped, see make_db.py for quantized index
     :param use_openai_embedding: Whether to use OpenAI embeddings for vector db
     :param use_openai_model: Whether to use OpenAI model for use with vector db
     :param hf_embedding_model: Which HF embedding model to use for vector db
@@ -302,6 +330,9 @@ def main(
            But smaller 6_9 models fail to use newest context and can get stuck on old information.
     :param auto_reduce_chunks: Whether to automatically reduce top_k_docs to fit context given prompt
     :param max_chunks: If top_k_docs=-1, maximum number of chunks to allow
+    :param hybrid_search: Whether to also retrieve chunks by BM25 keyword index and fuse with vector retrieval
+           by reciprocal rank, so exact terms like identifiers are found.  Only for chroma.
+           Keyword index is built on first use and then kept next to db and updated when documents added.
     :param n_jobs: Number of processors to use when consuming documents (-1 = all, is default)
     :param enable_captions: Whether to support captions using BLIP for image files as documents, then preloads that model
     :param captions_model: Which model to use for captions.
@@ -314,8 +345,17 @@ def main(
            Recommended if using larger caption model
     :param caption_gpu: If support caption, then use GPU if exists
     :param enable_ocr: Whether to support OCR on images
+    :param parse_cache_dir: If not None, directory to cache parsed documents in, keyed by file content and parse
+           settings, so re-ingesting same files skips parsing.  Not size limited, so remove directory to free space.
+    :param metrics_port: If not None, serve prometheus metrics of generation, retrieval, ingestion, gradio queue,
+           GPU memory, and startup phases on http://127.0.0.1:<metrics_port>/metrics, and JSON snapshot on /metrics.json
+    :param metrics_json: If not None, file to write JSON snapshot of metrics to at exit, e.g. for offline eval runs
     :return:
     """
+    # interpreter start and imports, before any of main
+    startup_time = psutil.Process().create_time()
+    startup_seconds.set(time.time() - startup_time, phase='imports')
+
     if base_model is None:
         base_model = ''
     if tokenizer_base_model is None:
@@ -497,6 +537,16 @@ def main(
                             verbose,
                             )
 
+    if metrics_port is not None or metrics_json:
+        # else no one reads output tokens, so avoid tokenizing each response again
+        import utils_metrics
+        utils_metrics.count_tokens_enabled = True
+    if metrics_port is not None:
+        start_metrics_server(metrics_port)
+    if metrics_json:
+        import atexit
+        atexit.register(dump_metrics_json, metrics_json)
+
     git_hash = get_githash()
     locals_dict = locals()
     locals_print = '\n'.join(['%s: %s' % (k, v) for k, v in locals_dict.items()])
@@ -504,11 +554,21 @@ def main(
         print(f"Generating model with params:\n{locals_print}", flush=True)
         print("Command: %s\nHash: %s" % (str(' '.join(sys.argv)), git_hash), flush=True)
 
+    t0 = time.time()
     if langchain_mode != "Disabled":
         # SECOND PLACE where LangChain referenced, but all imports are kept local so not required
-        from gpt_langchain import prep_langchain, get_some_dbs_from_hf
+        import gpt_langchain
+        from gpt_langchain import prep_langchain, get_some_dbs_from_hf, register_token_counter
         if is_hf:
             get_some_dbs_from_hf()
+        # keep BM25 index of chroma dbs at ingestion, so hybrid search queries need not build it
+        gpt_langchain.lexical_index_enabled = hybrid_search
+        if base_model and not inference_server and base_model not in non_hf_types:
+            # so ingestion below stores token counts of chunks for tokenizer queries will use
+            try:
+                register_token_counter(tokenizer_base_model or base_model)
+            except BaseException as e:
+                print("Not storing token counts in db, failed to get tokenizer: %s" % str(e), flush=True)
         dbs = {}
         for langchain_mode1 in visible_langchain_modes:
             if langchain_mode1 in ['MyData']:
@@ -541,6 +601,7 @@ def main(
         if os.environ.get("TEST_LANGCHAIN_IMPORT"):
             assert 'gpt_langchain' not in sys.modules, "Dev bug, import of langchain when should not have"
             assert 'langchain' not in sys.modules, "Dev bug, import of langchain when should not have"
+    record_startup_phase('langchain dbs', t0)
 
     model_state_none = dict(model=None, tokenizer=None, device=None,
                             base_model=None, tokenizer_base_model=None, lora_weights=None,
@@ -548,13 +609,16 @@ def main(
 
     if cli:
         from cli import run_cli
+        print_startup_phases(startup_time)
         return run_cli(**get_kwargs(run_cli, exclude_names=['model_state0'], **locals()))
     elif not gradio:
         from eval import run_eval
+        print_startup_phases(startup_time)
         return run_eval(**get_kwargs(run_eval, exclude_names=['model_state0'], **locals()))
     elif gradio:
         # imported here so don't require gradio to run generate
-        from gradio_runner import go_gradio
+        with startup_phase('import gradio'):
+            from gradio_runner import go_gradio
 
         # get default model
         model_states = []
@@ -565,65 +629,89 @@ def main(
         assert len(model_state_none) == len(model_state0)
         if model_lock:
             model_list = model_lock
-        for model_dict in reversed(model_list):
-            # do reverse, so first is default base_model etc., so some logic works in go_gradio() more easily
-            # handles defaults user didn't have to pass
-            model_dict['base_model'] = base_model = model_dict.get('base_model', '')
-            model_dict['tokenizer_base_model'] = tokenizer_base_model = model_dict.get('tokenizer_base_model', '')
-            model_dict['lora_weights'] = lora_weights = model_dict.get('lora_weights', '')
-            model_dict['inference_server'] = inference_server = model_dict.get('inference_server', '')
-            prompt_type = model_dict.get('prompt_type', model_list0[0]['prompt_type'])  # don't use mutated value
-            # try to infer, ignore empty initial state leading to get_generate_params -> 'plain'
-            if model_dict.get('prompt_type') is None:
-                model_lower = base_model.lower()
-                if model_lower in inv_prompt_type_to_model_lower:
-                    prompt_type = inv_prompt_type_to_model_lower[model_lower]
-                    prompt_dict, error0 = get_prompt(prompt_type, '',
-                                                     chat=False, context='', reduced=False, making_context=False,
-                                                     return_dict=True)
-            model_dict['prompt_type'] = prompt_type
-            model_dict['prompt_dict'] = prompt_dict = model_dict.get('prompt_dict', prompt_dict)
+        # load models concurrently, so startup overlaps downloads, reading, and placement of each model
+        t0 = time.time()
+        from concurrent.futures import ThreadPoolExecutor
+        if model_load_workers is None:
+            model_load_semaphore = ModelLoadBudget()
+        else:
+            model_load_semaphore = threading.Semaphore(model_load_workers)
+        model_futures = []
+        # exiting with waits for all loads, also if one failed and its exception is raised below
+        with ThreadPoolExecutor(max_workers=len(model_list) + 1) as model_executor:
+            for model_dict in reversed(model_list):
+                # do reverse, so first is default base_model etc., so some logic works in go_gradio() more easily
+                # handles defaults user didn't have to pass
+                model_dict['base_model'] = base_model = model_dict.get('base_model', '')
+                model_dict['tokenizer_base_model'] = tokenizer_base_model = model_dict.get('tokenizer_base_model', '')
+                model_dict['lora_weights'] = lora_weights = model_dict.get('lora_weights', '')
+                model_dict['inference_server'] = inference_server = model_dict.get('inference_server', '')
+                prompt_type = model_dict.get('prompt_type', model_list0[0]['prompt_type'])  # don't use mutated value
+                # try to infer, ignore empty initial state leading to get_generate_params -> 'plain'
+                if model_dict.get('prompt_type') is None:
+                    model_lower = base_model.lower()
+                    if model_lower in inv_prompt_type_to_model_lower:
+                        prompt_type = inv_prompt_type_to_model_lower[model_lower]
+                        prompt_dict, error0 = get_prompt(prompt_type, '',
+                                                         chat=False, context='', reduced=False, making_context=False,
+                                                         return_dict=True)
+                model_dict['prompt_type'] = prompt_type
+                model_dict['prompt_dict'] = prompt_dict = model_dict.get('prompt_dict', prompt_dict)
+                all_kwargs = locals().copy()
+                if base_model and not login_mode_if_model0:
+                    # local models limited by memory or model_load_workers, inference servers only connect so no limit
+                    model_future = model_executor.submit(get_model_limited,
+                                                         model_load_semaphore if not inference_server else None,
+                                                         get_model,
+                                                         reward_type=False,
+                                                         **get_kwargs(get_model, exclude_names=['reward_type'],
+                                                                      **all_kwargs))
+                else:
+                    # if empty model, then don't load anything, just get gradio up
+                    model_future = None
+                model_futures.append((model_dict, model_future))
+
+            # get score model, while other models load, but like them limited since also local HF model
             all_kwargs = locals().copy()
-            if base_model and not login_mode_if_model0:
-                model0, tokenizer0, device = get_model(reward_type=False,
-                                                       **get_kwargs(get_model, exclude_names=['reward_type'],
+            score_model_future = model_executor.submit(get_model_limited, model_load_semaphore, get_score_model,
+                                                       reward_type=True,
+                                                       **get_kwargs(get_score_model, exclude_names=['reward_type'],
                                                                     **all_kwargs))
-            else:
-                # if empty model, then don't load anything, just get gradio up
-                model0, tokenizer0, device = None, None, None
-            if model0 is None:
-                if fail_if_cannot_connect:
-                    raise RuntimeError("Could not connect, see logs")
-                # skip
-                if isinstance(model_lock, list):
-                    model_lock.remove(model_dict)
-                continue
-            model_state_trial = dict(model=model0, tokenizer=tokenizer0, device=device)
-            model_state_trial.update(model_dict)
-            assert len(model_state_none) == len(model_state_trial)
-            print("Model %s" % model_dict, flush=True)
-            if model_lock:
-                # last in iteration will be first
-                model_states.insert(0, model_state_trial)
-                # fill model_state0 so go_gradio() easier, manage model_states separately
-                model_state0 = model_state_trial.copy()
-            else:
-                model_state0 = model_state_trial.copy()
-            assert len(model_state_none) == len(model_state0)
-
-        # get score model
-        all_kwargs = locals().copy()
-        smodel, stokenizer, sdevice = get_score_model(reward_type=True,
-                                                      **get_kwargs(get_score_model, exclude_names=['reward_type'],
-                                                                   **all_kwargs))
+
+            for model_dict, model_future in model_futures:
+                model0, tokenizer0, device = model_future.result() if model_future is not None else (None, None, None)
+                if model0 is None:
+                    if fail_if_cannot_connect:
+                        raise RuntimeError("Could not connect, see logs")
+                    # skip
+                    if isinstance(model_lock, list):
+                        model_lock.remove(model_dict)
+                    continue
+                model_state_trial = dict(model=model0, tokenizer=tokenizer0, device=device)
+                model_state_trial.update(model_dict)
+                assert len(model_state_none) == len(model_state_trial)
+                print("Model %s" % model_dict, flush=True)
+                if model_lock:
+                    # last in iteration will be first
+                    model_states.insert(0, model_state_trial)
+                    # fill model_state0 so go_gradio() easier, manage model_states separately
+                    model_state0 = model_state_trial.copy()
+                else:
+                    model_state0 = model_state_trial.copy()
+                assert len(model_state_none) == len(model_state0)
+
+            smodel, stokenizer, sdevice = score_model_future.result()
+        del model_executor, model_futures, model_future, score_model_future, model_load_semaphore
         score_model_state0 = dict(model=smodel, tokenizer=stokenizer, device=sdevice,
                                   base_model=score_model, tokenizer_base_model='', lora_weights='',
                                   inference_server='', prompt_type='', prompt_dict='')
+        record_startup_phase('models', t0)
 
         if enable_captions:
             if pre_load_caption_model:
                 from image_captions import H2OImageCaptionLoader
-                caption_loader = H2OImageCaptionLoader(caption_gpu=caption_gpu).load_model()
+                with startup_phase('caption model'):
+                    caption_loader = H2OImageCaptionLoader(caption_gpu=caption_gpu).load_model()
             else:
                 caption_loader = 'gpu' if caption_gpu else 'cpu'
         else:
@@ -633,6 +721,101 @@ def main(
         go_gradio(**locals())
 
 
+def get_model_limited(semaphore, get_model_func, **kwargs):
+    """
+    get_model() or get_score_model() while holding semaphore, if any, to limit how many models load at once
+    :param semaphore: threading.Semaphore, ModelLoadBudget that holds estimated size of model while loading, or None
+    """
+    if isinstance(semaphore, ModelLoadBudget):
+        size_kwargs = {k: kwargs[k] for k in ['load_8bit', 'load_4bit', 'load_half', 'use_auth_token',
+                                              'trust_remote_code', 'offload_folder'] if k in kwargs}
+        if kwargs.get('reward_type'):
+            # full precision, like get_score_model()
+            base_model = (kwargs.get('score_model') or '').strip()
+            size_kwargs.update(load_8bit=False, load_4bit=False, load_half=False)
+        else:
+            base_model = kwargs.get('base_model', '')
+        semaphore = semaphore.reserve(get_model_bytes(base_model, **size_kwargs))
+    with semaphore or NullContext():
+        return get_model_func(**kwargs)
+
+
+def get_free_memory():
+    """
+    :return: bytes free on all GPUs, or in CPU memory if no GPUs
+    """
+    n_gpus = torch.cuda.device_count() if torch.cuda.is_available else 0
+    if n_gpus > 0:
+        return sum(torch.cuda.mem_get_info(i)[0] for i in range(n_gpus))
+    return psutil.virtual_memory().available
+
+
+def get_model_bytes(base_model='',
+                    load_8bit: bool = False,
+                    load_4bit: bool = False,
+                    load_half: bool = True,
+                    use_auth_token: Union[str, bool] = False,
+                    trust_remote_code: bool = True,
+                    offload_folder: str = None,
+                    ):
+    """
+    Estimate memory of model weights from model config, on empty weights so nothing is loaded
+    :return: bytes, or None if cannot estimate, e.g. llama.cpp or GPTQ model, or config not found
+    """
+    if not base_model:
+        return 0
+    try:
+        config, model = get_config(base_model, use_auth_token=use_auth_token, trust_remote_code=trust_remote_code,
+                                   offload_folder=offload_folder, return_model=True, raise_exception=False)
+    except BaseException as e:
+        print("Cannot estimate size of %s: %s" % (base_model, str(e)), flush=True)
+        return None
+    if model is None:
+        return None
+    if load_4bit:
+        bytes_per_param = 0.5
+    elif load_8bit:
+        bytes_per_param = 1
+    elif load_half:
+        bytes_per_param = 2
+    else:
+        bytes_per_param = 4
+    return int(sum(p.numel() for p in model.parameters()) * bytes_per_param)
+
+
+class ModelLoadBudget:
+    """
+    Limit models loading at once by memory, instead of by count like threading.Semaphore
+    A load starts once its estimated size, plus sizes of loads in progress, fits in memory free at that time,
+    which already excludes models done loading.  Any load starts if nothing else is loading,
+    so model too large or of unknown size (None) still loads, but alone
+    """
+
+    def __init__(self, get_free_memory_func=None):
+        self.get_free_memory = get_free_memory_func or get_free_memory
+        self.loading = []
+        self.condition = threading.Condition()
+
+    def fits(self, nbytes):
+        if not self.loading:
+            return True
+        if nbytes is None or None in self.loading:
+            return False
+        return nbytes + sum(self.loading) <= self.get_free_memory()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.fits(nbytes))
+            self.loading.append(nbytes)
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.loading.remove(nbytes)
+                self.condition.notify_all()
+
+
 def get_config(base_model,
                use_auth_token=False,
                trust_remote_code=True,
@@ -1241,8 +1424,10 @@ def evaluate_from_str(
         cli=False,
         reverse_docs=True,
         use_cache=None,
+        continuous_batching=False,
         auto_reduce_chunks=None,
         max_chunks=None,
+        hybrid_search=None,
         model_lock=None,
         force_langchain_evaluate=None,
         model_state_none=None,
@@ -1296,8 +1481,10 @@ def evaluate_from_str(
         cli=cli,
         reverse_docs=reverse_docs,
         use_cache=use_cache,
+        continuous_batching=continuous_batching,
         auto_reduce_chunks=auto_reduce_chunks,
         max_chunks=max_chunks,
+        hybrid_search=hybrid_search,
         model_lock=model_lock,
         force_langchain_evaluate=force_langchain_evaluate,
         model_state_none=model_state_none,
@@ -1310,6 +1497,16 @@ def evaluate_from_str(
         clear_torch_cache()
 
 
+def get_num_output_tokens(args, kwargs, response):
+    # for metrics of evaluate(), when have tokenizer to count with, only if metrics_port or metrics_json
+    model_state = args[0] if args else kwargs.get('model_state')
+    tokenizer = model_state.get('tokenizer') if isinstance(model_state, dict) else None
+    if tokenizer is None or isinstance(tokenizer, str) or not isinstance(response, str):
+        return None
+    return len(tokenizer(response)['input_ids'])
+
+
+@track_generation(num_tokens=get_num_output_tokens)
 def evaluate(
         model_state,
         my_db_state,
@@ -1369,8 +1566,10 @@ def evaluate(
         cli=False,
         reverse_docs=True,
         use_cache=None,
+        continuous_batching=False,
         auto_reduce_chunks=None,
         max_chunks=None,
+        hybrid_search=None,
         model_lock=None,
         force_langchain_evaluate=None,
         model_state_none=None,
@@ -1494,10 +1693,10 @@ def evaluate(
 
     # restrict instruction, typically what has large input
     from h2oai_pipeline import H2OTextGenerationPipeline
-    instruction, num_prompt_tokens1 = H2OTextGenerationPipeline.limit_prompt(instruction, tokenizer)
-    context, num_prompt_tokens2 = H2OTextGenerationPipeline.limit_prompt(context, tokenizer)
-    iinput, num_prompt_tokens3 = H2OTextGenerationPipeline.limit_prompt(iinput, tokenizer)
-    num_prompt_tokens = (num_prompt_tokens1 or 0) + (num_prompt_tokens2 or 0) + (num_prompt_tokens3 or 0)
+    # one token budget shared by all parts, each part tokenized once
+    (instruction, context, iinput), num_prompt_tokens = \
+        H2OTextGenerationPipeline.limit_prompts([instruction, context, iinput], tokenizer)
+    num_prompt_tokens = num_prompt_tokens or 0
 
     # get prompt
     prompter = Prompter(prompt_type, prompt_dict, debug=debug, chat=chat, stream_output=stream_output)
@@ -1569,6 +1768,7 @@ def evaluate(
 
                            auto_reduce_chunks=auto_reduce_chunks,
                            max_chunks=max_chunks,
+                           hybrid_search=hybrid_search,
                            ):
             outr, extra = r  # doesn't accumulate, new answer every yield, so only save that full answer
             yield dict(response=outr, sources=extra)
@@ -1628,9 +1828,9 @@ def evaluate(
                         collected_events.append(event)  # save the event response
                         event_text = event['choices'][0]['text']  # extract the text
                         text += event_text  # append the text
-                        yield dict(response=prompter.get_response(prompt + text, prompt=prompt,
-                                                                  sanitize_bot_response=sanitize_bot_response),
-                                   sources='')
+                        response1 = prompter.get_response_stream(prompt + text, prompt=prompt,
+                                                                 sanitize_bot_response=sanitize_bot_response)
+                        yield dict(response=response1, sources='')
             elif inference_server == 'openai_chat':
                 response = openai.ChatCompletion.create(
                     model=base_model,
@@ -1654,9 +1854,9 @@ def evaluate(
                         delta = chunk["choices"][0]["delta"]
                         if 'content' in delta:
                             text += delta['content']
-                            yield dict(response=prompter.get_response(prompt + text, prompt=prompt,
-                                                                      sanitize_bot_response=sanitize_bot_response),
-                                       sources='')
+                            response1 = prompter.get_response_stream(prompt + text, prompt=prompt,
+                                                                     sanitize_bot_response=sanitize_bot_response)
+                            yield dict(response=response1, sources='')
             else:
                 raise RuntimeError("No such OpenAI mode: %s" % inference_server)
         elif inference_server.startswith('http'):
@@ -1751,22 +1951,19 @@ def evaluate(
                     text = ''
                     sources = ''
                     res_dict = dict(response=text, sources=sources)
-                    while not job.done():
-                        outputs_list = job.communicator.job.outputs
-                        if outputs_list:
-                            res = job.communicator.job.outputs[-1]
-                            res_dict = ast.literal_eval(res)
-                            text = res_dict['response']
-                            sources = res_dict['sources']
-                            if gr_prompt_type == 'plain':
-                                # then gradio server passes back full prompt + text
-                                prompt_and_text = text
-                            else:
-                                prompt_and_text = prompt + text
-                            yield dict(response=prompter.get_response(prompt_and_text, prompt=prompt,
-                                                                      sanitize_bot_response=sanitize_bot_response),
-                                       sources=sources)
-                        time.sleep(0.01)
+                    # wakes as soon as each output arrives
+                    for res in gr_client.stream_outputs(job):
+                        res_dict = ast.literal_eval(res)
+                        text = res_dict['response']
+                        sources = res_dict['sources']
+                        if gr_prompt_type == 'plain':
+                            # then gradio server passes back full prompt + text
+                            prompt_and_text = text
+                        else:
+                            prompt_and_text = prompt + text
+                        response1 = prompter.get_response_stream(prompt_and_text, prompt=prompt,
+                                                                 sanitize_bot_response=sanitize_bot_response)
+                        yield dict(response=response1, sources=sources)
                     # ensure get last output to avoid race
                     res_all = job.outputs()
                     if len(res_all) > 0:
@@ -1824,9 +2021,9 @@ def evaluate(
                             # stop_sequences
                             text_chunk = response.token.text
                             text += text_chunk
-                            yield dict(response=prompter.get_response(prompt + text, prompt=prompt,
-                                                                      sanitize_bot_response=sanitize_bot_response),
-                                       sources='')
+                            response1 = prompter.get_response_stream(prompt + text, prompt=prompt,
+                                                                     sanitize_bot_response=sanitize_bot_response)
+                            yield dict(response=response1, sources='')
             else:
                 raise RuntimeError("Failed to get client: %s" % inference_server)
         else:
@@ -1960,9 +2157,43 @@ def evaluate(
                 else:
                     if verbose:
                         print("WARNING: Special characters in prompt", flush=True)
-                if stream_output:
+                from batching import can_continuous_batch
+                if continuous_batching and can_continuous_batch(model, num_beams=num_beams,
+                                                                num_return_sequences=num_return_sequences):
+                    # share forward passes with other concurrent requests for this model
+                    from batching import get_batch_scheduler
+                    scheduler = get_batch_scheduler(model, device=device,
+                                                    use_autocast=context_class_cast != NullContext)
+                    streamer = H2OTextIteratorStreamer(tokenizer, skip_prompt=False,
+                                                       **decoder_kwargs) if stream_output else None
+                    batch_request = scheduler.submit(input_ids, generation_config,
+                                                     max_new_tokens=max_new_tokens, min_new_tokens=min_new_tokens,
+                                                     stopping_criteria=stopping_criteria, max_time=max_time,
+                                                     streamer=streamer)
+                    try:
+                        if stream_output:
+                            outputs = ""
+                            for new_text in streamer:
+                                outputs += new_text
+                                response1 = prompter.get_response_stream(outputs, prompt=inputs_decoded,
+                                                                         sanitize_bot_response=sanitize_bot_response)
+                                yield dict(response=response1, sources='')
+                            decoded_output = outputs
+                        batch_request.wait()
+                        if batch_request.exc:
+                            raise batch_request.exc
+                        if not stream_output:
+                            outputs = [decoder(batch_request.sequence)]
+                            yield dict(response=prompter.get_response(outputs, prompt=inputs_decoded,
+                                                                      sanitize_bot_response=sanitize_bot_response),
+                                       sources='')
+                            decoded_output = prompt + outputs[0]
+                    finally:
+                        # e.g. if user stopped, leave batch
+                        batch_request.cancel()
+                elif stream_output:
                     skip_prompt = False
-                    streamer = H2OTextIteratorStreamer(tokenizer, skip_prompt=skip_prompt, block=False,
+                    streamer = H2OTextIteratorStreamer(tokenizer, skip_prompt=skip_prompt,
                                                        **decoder_kwargs)
                     gen_kwargs.update(dict(streamer=streamer))
                     target = wrapped_partial(generate_with_exceptions, model.generate,
@@ -1978,9 +2209,9 @@ def evaluate(
                             if bucket.qsize() > 0 or thread.exc:
                                 thread.join()
                             outputs += new_text
-                            yield dict(response=prompter.get_response(outputs, prompt=inputs_decoded,
-                                                                      sanitize_bot_response=sanitize_bot_response),
-                                       sources='')
+                            response1 = prompter.get_response_stream(outputs, prompt=inputs_decoded,
+                                                                     sanitize_bot_response=sanitize_bot_response)
+                            yield dict(response=response1, sources='')
                     except BaseException:
                         # if any exception, raise that exception if was from thread, first
                         if thread.exc:
@@ -2046,23 +2277,33 @@ def get_cutoffs(memory_restriction_level, for_context=False, model_max_length=20
 class H2OTextIteratorStreamer(TextIteratorStreamer):
     """
     normally, timeout required for now to handle exceptions, else get()
-    but with H2O version of TextIteratorStreamer, loop over block to handle
+    but with H2O version of TextIteratorStreamer, wait on StreamQueue that also wakes on do_stop, so no polling
+    maxsize > 0 makes generation wait for slow consumer
     """
 
     def __init__(self, tokenizer, skip_prompt: bool = False, timeout: typing.Optional[float] = None,
-                 block=True, **decode_kwargs):
+                 maxsize=0, **decode_kwargs):
         super().__init__(tokenizer, skip_prompt, **decode_kwargs)
-        self.text_queue = queue.Queue()
+        self.text_queue = StreamQueue(maxsize=maxsize)
         self.stop_signal = None
         self.do_stop = False
         self.timeout = timeout
-        self.block = block
+
+    @property
+    def do_stop(self):
+        return self.text_queue.stopped
+
+    @do_stop.setter
+    def do_stop(self, value):
+        # e.g. set by EThread if generation fails, wakes consumer and any blocked producer
+        if value:
+            self.text_queue.stop()
 
     def on_finalized_text(self, text: str, stream_end: bool = False):
-        """Put the new text in the queue. If the stream is ending, also put a stop signal in the queue."""
+        """Put the new text in the queue. If the stream is ending, also close the queue."""
         self.text_queue.put(text, timeout=self.timeout)
         if stream_end:
-            self.text_queue.put(self.stop_signal, timeout=self.timeout)
+            self.text_queue.close()
 
     def __iter__(self):
         return self
@@ -2070,20 +2311,14 @@ class H2OTextIteratorStreamer(TextIteratorStreamer):
     def __next__(self):
         while True:
             try:
-                value = self.stop_signal  # value looks unused in pycharm, not true
                 if self.do_stop:
                     print("hit stop", flush=True)
                     # could raise or break, maybe best to raise and make parent see if any exception in thread
                     raise StopIteration()
-                    # break
-                value = self.text_queue.get(block=self.block, timeout=self.timeout)
-                break
+                # raises StopIteration once stream ended or stopped
+                return self.text_queue.get(timeout=self.timeout)
             except queue.Empty:
-                time.sleep(0.01)
-        if value == self.stop_signal:
-            raise StopIteration()
-        else:
-            return value
+                continue
 
 
 def generate_with_exceptions(func, *args, prompt='', inputs_decoded='', raise_generate_gpu_exceptions=True, **kwargs):
@@ -2341,36 +2576,61 @@ def get_context(chat_context, prompt_type):
 
 
 def score_qa(smodel, stokenizer, max_length_tokenize, question, answer, cutoff_len):
-    question = question[-cutoff_len:]
-    answer = answer[-cutoff_len:]
+    return score_qa_batch(smodel, stokenizer, max_length_tokenize, [question], [answer], cutoff_len)[0]
 
-    inputs = stokenizer(question, answer,
-                        return_tensors="pt",
-                        truncation=True,
-                        max_length=max_length_tokenize).to(smodel.device)
-    try:
-        score = torch.sigmoid(smodel(**inputs).logits[0]).cpu().detach().numpy()[0]
-    except torch.cuda.OutOfMemoryError as e:
-        print("GPU OOM 3: question: %s answer: %s exception: %s" % (question, answer, str(e)), flush=True)
-        del inputs
-        traceback.print_exc()
-        clear_torch_cache()
-        return 'Response Score: GPU OOM'
-    except (Exception, RuntimeError) as e:
-        if 'Expected all tensors to be on the same device' in str(e) or \
-                'expected scalar type Half but found Float' in str(e) or \
-                'probability tensor contains either' in str(e) or \
-                'cublasLt ran into an error!' in str(e) or \
-                'device-side assert triggered' in str(e):
-            print("GPU Error: question: %s answer: %s exception: %s" % (question, answer, str(e)),
-                  flush=True)
+
+def score_qa_batch(smodel, stokenizer, max_length_tokenize, questions, answers, cutoff_len, max_batch_tokens=None):
+    """
+    Score question/answer pairs with reward model, in padded batches of similar length
+    :param max_batch_tokens: max padded tokens per forward, default is 8 pairs of max_length_tokenize
+    :return: list of scores in same order as pairs, with error string instead for pairs in failed batch
+    """
+    if max_batch_tokens is None:
+        max_batch_tokens = 8 * max_length_tokenize
+    questions = [question[-cutoff_len:] for question in questions]
+    answers = [answer[-cutoff_len:] for answer in answers]
+
+    encodings = stokenizer(questions, answers, truncation=True, max_length=max_length_tokenize)
+    lengths = [len(x) for x in encodings['input_ids']]
+    # longest first, so first pair in batch sets padded length of batch
+    batches = []
+    for i in sorted(range(len(questions)), key=lambda i: -lengths[i]):
+        if batches and (len(batches[-1]) + 1) * lengths[batches[-1][0]] <= max_batch_tokens:
+            batches[-1].append(i)
+        else:
+            batches.append([i])
+
+    scores = [None] * len(questions)
+    for batch in batches:
+        inputs = stokenizer.pad([{k: v[i] for k, v in encodings.items()} for i in batch],
+                                return_tensors="pt").to(smodel.device)
+        try:
+            with torch.no_grad():
+                batch_scores = list(torch.sigmoid(smodel(**inputs).logits[:, 0]).cpu().detach().numpy())
+        except torch.cuda.OutOfMemoryError as e:
+            print("GPU OOM 3: questions: %s answers: %s exception: %s" %
+                  ([questions[i] for i in batch], [answers[i] for i in batch], str(e)), flush=True)
+            del inputs
             traceback.print_exc()
             clear_torch_cache()
-            return 'Response Score: GPU Error'
-        else:
-            raise
+            batch_scores = ['Response Score: GPU OOM'] * len(batch)
+        except (Exception, RuntimeError) as e:
+            if 'Expected all tensors to be on the same device' in str(e) or \
+                    'expected scalar type Half but found Float' in str(e) or \
+                    'probability tensor contains either' in str(e) or \
+                    'cublasLt ran into an error!' in str(e) or \
+                    'device-side assert triggered' in str(e):
+                print("GPU Error: questions: %s answers: %s exception: %s" %
+                      ([questions[i] for i in batch], [answers[i] for i in batch], str(e)), flush=True)
+                traceback.print_exc()
+                clear_torch_cache()
+                batch_scores = ['Response Score: GPU Error'] * len(batch)
+            else:
+                raise
+        for i, score in zip(batch, batch_scores):
+            scores[i] = score
     os.environ['TOKENIZERS_PARALLELISM'] = 'true'
-    return score
+    return scores
 
 
 def check_locals(**kwargs):
@@ -2427,8 +2687,93 @@ def get_minmax_top_k_docs(is_public):
     return min_top_k_docs, max_top_k_docs, label_top_k_docs
 
 
+class HistoryContext:
+    """
+    Chat history of one conversation formatted as context, each turn formatted and stripped of sources once,
+    so each new message only formats the newest turn, and trimming from the front uses cached sizes
+    """
+
+    def __init__(self, langchain_mode1, prompt_type1, prompt_dict1, chat1, keep_sources_in_context1, tokenizer=None):
+        self.langchain_mode1 = langchain_mode1
+        self.prompt_type1 = prompt_type1
+        self.prompt_dict1 = prompt_dict1
+        self.chat1 = chat1
+        self.keep_sources_in_context1 = keep_sources_in_context1
+        self.tokenizer = tokenizer
+        # (instruction, output) of each cached turn, and formatted prompt and size of each
+        self.turns = []
+        self.prompts = []
+        self.sizes = []
+        _, _, _, _, self.chat_turn_sep = generate_prompt({}, prompt_type1, prompt_dict1, chat1, reduced=True,
+                                                         making_context=True)
+
+    def format_turn(self, instruction, output):
+        data_point = dict(instruction=instruction, input='', output=output)
+        prompt, pre_response, terminate_response, chat_sep, chat_turn_sep = generate_prompt(data_point,
+                                                                                            self.prompt_type1,
+                                                                                            self.prompt_dict1,
+                                                                                            self.chat1,
+                                                                                            reduced=True,
+                                                                                            making_context=True)
+        # md -> back to text, maybe not super important if model trained enough
+        if not self.keep_sources_in_context1 and self.langchain_mode1 != 'Disabled' and \
+                prompt.find(source_prefix) >= 0:
+            # relatively slow even for small amount of text, like 0.3s each history item, so only done once per turn
+            import re
+            prompt = re.sub(f'{re.escape(source_prefix)}.*?{re.escape(source_postfix)}', '', prompt,
+                            flags=re.DOTALL)
+            if prompt.endswith('\n<p>'):
+                prompt = prompt[:-4]
+        prompt = prompt.replace('<br>', chat_turn_sep)
+        if not prompt.endswith(chat_turn_sep):
+            prompt += chat_turn_sep
+        if self.tokenizer is not None:
+            size = len(self.tokenizer(prompt)['input_ids'])
+        else:
+            size = len(prompt)
+        return prompt, size
+
+    def update(self, turns):
+        """
+        :param turns: list of [instruction, output] pairs, reuses cached turns up to first that changed
+        """
+        num_same = 0
+        for turn, cached_turn in zip(turns, self.turns):
+            if tuple(turn) != cached_turn:
+                break
+            num_same += 1
+        del self.turns[num_same:], self.prompts[num_same:], self.sizes[num_same:]
+        for instruction, output in turns[num_same:]:
+            prompt, size = self.format_turn(instruction, output)
+            self.turns.append((instruction, output))
+            self.prompts.append(prompt)
+            self.sizes.append(size)
+
+    def get_context(self, max_size):
+        """
+        :param max_size: max tokens if have tokenizer, else max characters
+        :return: most recent turns that fit in max_size, oldest first
+        """
+        total = 0
+        start = len(self.prompts)
+        # most recent first, add older if can
+        while start > 0 and total + self.sizes[start - 1] <= max_size:
+            start -= 1
+            total += self.sizes[start]
+        context1 = ''.join(self.prompts[start:])
+        if context1 and not context1.endswith(self.chat_turn_sep):
+            context1 += self.chat_turn_sep  # ensure if terminates abruptly, then human continues on next line
+        return context1
+
+
+# HistoryContext per conversation, keyed by settings and first turn, since chat history is passed in full each time
+history_contexts = OrderedDict()
+history_contexts_lock = threading.Lock()
+history_contexts_max = 1000
+
+
 def history_to_context(history, langchain_mode1, prompt_type1, prompt_dict1, chat1, model_max_length1,
-                       memory_restriction_level1, keep_sources_in_context1):
+                       memory_restriction_level1, keep_sources_in_context1, tokenizer1=None):
     """
     consumes all history up to (but not including) latest history item that is presumed to be an [instruction, None] pair
     :param history:
@@ -2439,6 +2784,7 @@ def history_to_context(history, langchain_mode1, prompt_type1, prompt_dict1, cha
     :param model_max_length1:
     :param memory_restriction_level1:
     :param keep_sources_in_context1:
+    :param tokenizer1: if not None, limit context by tokens, else estimate from characters
     :return:
     """
     # ensure output will be unique to models
@@ -2446,38 +2792,27 @@ def history_to_context(history, langchain_mode1, prompt_type1, prompt_dict1, cha
                                              for_context=True, model_max_length=model_max_length1)
     context1 = ''
     if max_prompt_length is not None and langchain_mode1 not in ['LLM']:
-        context1 = ''
         # - 1 below because current instruction already in history from user()
-        for histi in range(0, len(history) - 1):
-            data_point = dict(instruction=history[histi][0], input='', output=history[histi][1])
-            prompt, pre_response, terminate_response, chat_sep, chat_turn_sep = generate_prompt(data_point,
-                                                                                                prompt_type1,
-                                                                                                prompt_dict1,
-                                                                                                chat1,
-                                                                                                reduced=True,
-                                                                                                making_context=True)
-            # md -> back to text, maybe not super important if model trained enough
-            if not keep_sources_in_context1 and langchain_mode1 != 'Disabled' and prompt.find(source_prefix) >= 0:
-                # FIXME: This is relatively slow even for small amount of text, like 0.3s each history item
-                import re
-                prompt = re.sub(f'{re.escape(source_prefix)}.*?{re.escape(source_postfix)}', '', prompt,
-                                flags=re.DOTALL)
-                if prompt.endswith('\n<p>'):
-                    prompt = prompt[:-4]
-            prompt = prompt.replace('<br>', chat_turn_sep)
-            if not prompt.endswith(chat_turn_sep):
-                prompt += chat_turn_sep
-            # most recent first, add older if can
-            # only include desired chat history
-            if len(prompt + context1) > max_prompt_length:
-                break
-            context1 += prompt
-
-        _, pre_response, terminate_response, chat_sep, chat_turn_sep = generate_prompt({}, prompt_type1, prompt_dict1,
-                                                                                       chat1, reduced=True,
-                                                                                       making_context=True)
-        if context1 and not context1.endswith(chat_turn_sep):
-            context1 += chat_turn_sep  # ensure if terminates abruptly, then human continues on next line
+        turns = [tuple(x) for x in history[:-1]]
+        if not turns:
+            return context1
+        tokenizer_name = getattr(tokenizer1, 'name_or_path', type(tokenizer1).__name__) \
+            if tokenizer1 is not None else None
+        key = (langchain_mode1, prompt_type1, str(prompt_dict1), bool(chat1), keep_sources_in_context1, tokenizer_name,
+               turns[0])
+        with history_contexts_lock:
+            history_context = history_contexts.pop(key, None)
+        if history_context is None:
+            history_context = HistoryContext(langchain_mode1, prompt_type1, prompt_dict1, chat1,
+                                             keep_sources_in_context1, tokenizer=tokenizer1)
+        history_context.update(turns)
+        # max_prompt_length is in characters, about 4 per token
+        max_size = max_prompt_length // 4 if tokenizer1 is not None else max_prompt_length
+        context1 = history_context.get_context(max_size)
+        with history_contexts_lock:
+            history_contexts[key] = history_context
+            while len(history_contexts) > history_contexts_max:
+                history_contexts.popitem(last=False)
     return context1
 
 
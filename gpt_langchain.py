@@ -1,21 +1,27 @@
 import ast
+import atexit
+import contextlib
 import glob
 import inspect
+import json
 import os
 import pathlib
 import pickle
+import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 import traceback
 import types
 import uuid
+import weakref
 import zipfile
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import Future
 from datetime import datetime
-from functools import reduce
-from operator import concat
+
 import filelock
 
 from joblib import delayed
@@ -23,12 +29,15 @@ from langchain.callbacks import streaming_stdout
 from langchain.embeddings import HuggingFaceInstructEmbeddings
 from tqdm import tqdm
 
-from enums import DocumentChoices, no_lora_str, model_token_mapping, source_prefix, source_postfix
+from enums import DocumentChoices, LangChainMode, no_lora_str, model_token_mapping, source_prefix, source_postfix
 from generate import gen_hyper, get_model, SEED
 from prompter import non_hf_types, PromptType, Prompter
 from utils import wrapped_partial, EThread, import_matplotlib, sanitize_filename, makedirs, get_url, flatten_list, \
-    get_device, ProgressParallel, remove, hash_file, clear_torch_cache, NullContext, get_hf_server, FakeTokenizer
+    get_device, ProgressParallel, remove, hash_file, clear_torch_cache, NullContext, get_hf_server, FakeTokenizer, \
+    ReadWriteLock, get_sha, have_package
+from gradio_utils.stream_queue import StreamQueue
 from utils_langchain import StreamingGradioCallbackHandler
+from utils_metrics import track_retrieval, track_ingestion
 
 import_matplotlib()
 
@@ -46,16 +55,24 @@ from langchain.document_loaders import PyPDFLoader, TextLoader, CSVLoader, Pytho
     UnstructuredEPubLoader, UnstructuredImageLoader, UnstructuredRTFLoader, ArxivLoader, UnstructuredPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter, Language
 from langchain.chains.question_answering import load_qa_chain
+from langchain.docstore.base import AddableMixin, Docstore
 from langchain.docstore.document import Document
 from langchain import PromptTemplate, HuggingFaceTextGenInference
-from langchain.vectorstores import Chroma
+from langchain.vectorstores import Chroma, FAISS
 
 
 def get_db(sources, use_openai_embedding=False, db_type='faiss',
            persist_directory="db_dir", load_db_if_exists=True,
            langchain_mode='notset',
            collection_name=None,
-           hf_embedding_model="sentence-transformers/all-MiniLM-L6-v2"):
+           hf_embedding_model="sentence-transformers/all-MiniLM-L6-v2",
+           embeddings=None,
+           faiss_index_factory=None):
+    """
+    :param embeddings: embeddings of sources if already computed, e.g. by separate embedding stage of path_to_db,
+      else for faiss and chroma from embedding cache or model
+    :param faiss_index_factory: faiss index factory string for new faiss_mmap db, default FAISS_INDEX_FACTORY or Flat
+    """
     if not sources:
         return None
 
@@ -64,11 +81,17 @@ def get_db(sources, use_openai_embedding=False, db_type='faiss',
     assert collection_name is not None or langchain_mode != 'notset'
     if collection_name is None:
         collection_name = langchain_mode.replace(' ', '_')
+    add_num_tokens(sources)
 
     # Create vector database
     if db_type == 'faiss':
         from langchain.vectorstores import FAISS
-        db = FAISS.from_documents(sources, embedding)
+        if embeddings is None:
+            embeddings = embed_documents_cached(embedding, [x.page_content for x in sources],
+                                                use_openai_embedding=use_openai_embedding,
+                                                hf_embedding_model=hf_embedding_model)
+        db = FAISS.from_embeddings(list(zip([x.page_content for x in sources], embeddings)), embedding,
+                                   metadatas=[x.metadata for x in sources])
     elif db_type == 'weaviate':
         import weaviate
         from weaviate.embedded import EmbeddedOptions
@@ -83,6 +106,26 @@ def get_db(sources, use_openai_embedding=False, db_type='faiss',
         index_name = collection_name.capitalize()
         db = Weaviate.from_documents(documents=sources, embedding=embedding, client=client, by_text=False,
                                      index_name=index_name)
+    elif db_type == 'faiss_mmap':
+        assert persist_directory is not None
+        db = get_existing_db(None, persist_directory, load_db_if_exists, db_type, use_openai_embedding, langchain_mode,
+                             hf_embedding_model, verbose=False)
+        if db is None:
+            if embeddings is None:
+                embeddings = embed_documents_cached(embedding, [x.page_content for x in sources],
+                                                    use_openai_embedding=use_openai_embedding,
+                                                    hf_embedding_model=hf_embedding_model)
+            db = FAISSMmap.create(embedding, persist_directory, collection_name, len(embeddings[0]),
+                                  index_factory=faiss_index_factory)
+            add_embedded_documents(db, sources, embeddings)
+            persist_db(db, force=True)
+            save_embed(db, use_openai_embedding, hf_embedding_model)
+            set_db_handle(db, use_openai_embedding, hf_embedding_model)
+        else:
+            db, num_new_sources, new_sources_metadata = add_to_db(db, sources, db_type=db_type,
+                                                                  use_openai_embedding=use_openai_embedding,
+                                                                  hf_embedding_model=hf_embedding_model,
+                                                                  embeddings=embeddings)
     elif db_type == 'chroma':
         assert persist_directory is not None
         os.makedirs(persist_directory, exist_ok=True)
@@ -91,25 +134,317 @@ def get_db(sources, use_openai_embedding=False, db_type='faiss',
         db = get_existing_db(None, persist_directory, load_db_if_exists, db_type, use_openai_embedding, langchain_mode,
                              hf_embedding_model, verbose=False)
         if db is None:
-            db = Chroma.from_documents(documents=sources,
-                                       embedding=embedding,
-                                       persist_directory=persist_directory,
-                                       collection_name=collection_name,
-                                       anonymized_telemetry=False)
-            db.persist()
+            if embeddings is None:
+                embeddings = embed_documents_cached(embedding, [x.page_content for x in sources],
+                                                    use_openai_embedding=use_openai_embedding,
+                                                    hf_embedding_model=hf_embedding_model)
+            from chromadb.config import Settings
+            client_settings = Settings(anonymized_telemetry=False,
+                                       chroma_db_impl="duckdb+parquet",
+                                       persist_directory=persist_directory)
+            db = Chroma(embedding_function=embedding,
+                        persist_directory=persist_directory,
+                        collection_name=collection_name,
+                        client_settings=client_settings)
+            add_embedded_documents(db, sources, embeddings)
+            if lexical_index_enabled:
+                get_lexical_index(db)
+            # also saves lexical index
+            persist_db(db, force=True)
             clear_embedding(db)
             save_embed(db, use_openai_embedding, hf_embedding_model)
+            set_db_handle(db, use_openai_embedding, hf_embedding_model)
         else:
             # then just add
             db, num_new_sources, new_sources_metadata = add_to_db(db, sources, db_type=db_type,
                                                                   use_openai_embedding=use_openai_embedding,
-                                                                  hf_embedding_model=hf_embedding_model)
+                                                                  hf_embedding_model=hf_embedding_model,
+                                                                  embeddings=embeddings)
     else:
         raise RuntimeError("No such db_type=%s" % db_type)
 
     return db
 
 
+def add_embedded_documents(db, sources, embeddings):
+    """
+    Add sources with already computed embeddings, like db.add_documents() but without embedding again
+    :return: ids of added documents
+    """
+    from langchain.vectorstores import FAISS
+    texts = [x.page_content for x in sources]
+    metadatas = [x.metadata for x in sources]
+    if isinstance(db, FAISS):
+        return db.add_embeddings(list(zip(texts, embeddings)), metadatas=metadatas)
+    elif isinstance(db, Chroma):
+        ids = [str(uuid.uuid1()) for _ in texts]
+        db._collection.add(metadatas=metadatas, embeddings=embeddings, documents=texts, ids=ids)
+        return ids
+    else:
+        return db.add_documents(documents=sources)
+
+
+# index factory string for new faiss_mmap dbs, e.g. 'Flat', 'SQ8' for int8, 'IVF1024,PQ32' for IVF with PQ
+faiss_index_factory_default = os.getenv('FAISS_INDEX_FACTORY', 'Flat')
+
+
+class ColumnarDocstore(Docstore, AddableMixin):
+    """
+    Documents of faiss_mmap db, as column of utf-8 texts and column of json metadatas, each with offsets,
+    memory-mapped so not held in memory.  Documents added since last save are held in memory until save()
+    id of document is str of its row, same as its position in faiss index
+    """
+
+    columns = ['texts', 'metadatas']
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.pending = []
+        self.data = {}
+        self.offsets = {}
+        self.num_saved = 0
+        self.load()
+
+    def load(self):
+        for name in self.columns:
+            offsets_file = os.path.join(self.directory, '%s_offsets.npy' % name)
+            if os.path.isfile(offsets_file):
+                self.offsets[name] = np.load(offsets_file, mmap_mode='r')
+            else:
+                self.offsets[name] = np.zeros(1, dtype=np.int64)
+            num_bytes = int(self.offsets[name][-1])
+            # memmap cannot map empty file
+            self.data[name] = np.memmap(os.path.join(self.directory, '%s.bin' % name), dtype=np.uint8, mode='r',
+                                        shape=(num_bytes,)) if num_bytes > 0 else np.zeros(0, dtype=np.uint8)
+        self.num_saved = len(self.offsets['texts']) - 1
+
+    def __len__(self):
+        return self.num_saved + len(self.pending)
+
+    def get_value(self, name, row):
+        start, end = int(self.offsets[name][row]), int(self.offsets[name][row + 1])
+        return bytes(self.data[name][start:end]).decode('utf-8', errors='surrogatepass')
+
+    def get_document(self, row):
+        if row >= self.num_saved:
+            return self.pending[row - self.num_saved]
+        return Document(page_content=self.get_value('texts', row),
+                        metadata=json.loads(self.get_value('metadatas', row)))
+
+    def search(self, search):
+        row = int(search)
+        if not 0 <= row < len(self):
+            return "ID %s not found." % search
+        return self.get_document(row)
+
+    def add(self, texts):
+        ids = list(texts)
+        assert ids == [str(len(self) + i) for i in range(len(ids))], "Documents must be added in row order"
+        self.pending.extend(texts.values())
+
+    def documents(self):
+        for row in range(len(self)):
+            yield self.get_document(row)
+
+    def metadatas(self):
+        for row in range(len(self)):
+            if row >= self.num_saved:
+                yield self.pending[row - self.num_saved].metadata
+            else:
+                yield json.loads(self.get_value('metadatas', row))
+
+    def save(self):
+        if not self.pending:
+            return
+        makedirs(self.directory)
+        for name in self.columns:
+            values = [x.page_content if name == 'texts' else json.dumps(x.metadata, default=str)
+                      for x in self.pending]
+            values = [x.encode('utf-8', errors='surrogatepass') for x in values]
+            # append, offsets written after so any partial append from before is dropped here
+            with open(os.path.join(self.directory, '%s.bin' % name), 'ab') as f:
+                f.truncate(int(self.offsets[name][-1]))
+                [f.write(x) for x in values]
+            offsets = np.concatenate([self.offsets[name],
+                                      int(self.offsets[name][-1]) + np.cumsum([len(x) for x in values], dtype=np.int64)])
+            offsets_file = os.path.join(self.directory, '%s_offsets.npy' % name)
+            np.save(offsets_file + '.tmp.npy', offsets)
+            os.replace(offsets_file + '.tmp.npy', offsets_file)
+        self.pending = []
+        self.load()
+
+    def truncate(self, num_rows):
+        """
+        Drop saved rows from num_rows on, data itself is cut on next save()
+        """
+        assert not self.pending, "Only saved documents can be truncated"
+        for name in self.columns:
+            offsets_file = os.path.join(self.directory, '%s_offsets.npy' % name)
+            np.save(offsets_file + '.tmp.npy', np.array(self.offsets[name][:num_rows + 1]))
+            os.replace(offsets_file + '.tmp.npy', offsets_file)
+        self.load()
+
+
+class RowIds:
+    """
+    index_to_docstore_id for ColumnarDocstore, row of faiss index is id, so no dict of all rows
+    """
+
+    def __init__(self, docstore):
+        self.docstore = docstore
+
+    def __len__(self):
+        return len(self.docstore)
+
+    def __getitem__(self, i):
+        return str(i)
+
+    def update(self, index_to_id):
+        pass
+
+
+class FAISSMmap(FAISS):
+    """
+    FAISS db persisted to persist_directory, with optionally quantized index given by faiss index factory string,
+    memory-mapped when loaded if faiss supports it for that index (IVF), and documents in ColumnarDocstore
+    Index types that need training keep added vectors aside until enough to train, searched by brute force until then
+    """
+
+    def __init__(self, embedding, index, persist_directory, collection_name, index_factory='Flat', nprobe=16,
+                 mmapped=False):
+        docstore = ColumnarDocstore(persist_directory)
+        super().__init__(embedding.embed_query, index, docstore, RowIds(docstore))
+        # like chroma, so embedding can be cleared and checked
+        self._embedding_function = embedding
+        self._persist_directory = persist_directory
+        self.collection_name = collection_name
+        self.index_factory = index_factory
+        self.nprobe = nprobe
+        self.mmapped = mmapped
+        untrained_file = os.path.join(persist_directory, 'untrained.npy')
+        self.untrained = np.load(untrained_file) if os.path.isfile(untrained_file) else None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def create(cls, embedding, persist_directory, collection_name, dimension, index_factory=None):
+        import faiss
+        index_factory = index_factory or faiss_index_factory_default
+        index = faiss.index_factory(dimension, index_factory, faiss.METRIC_L2)
+        return cls(embedding, index, persist_directory, collection_name, index_factory=index_factory)
+
+    @classmethod
+    def load(cls, embedding, persist_directory):
+        import faiss
+        with open(os.path.join(persist_directory, 'faiss_info'), 'rt') as f:
+            info = json.load(f)
+        index_file = os.path.join(persist_directory, 'faiss.index')
+        try:
+            index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            mmapped = True
+        except RuntimeError:
+            index = faiss.read_index(index_file)
+            mmapped = False
+        db = cls(embedding, index, persist_directory, info['collection_name'], index_factory=info['index_factory'],
+                 nprobe=info['nprobe'], mmapped=mmapped)
+        db.repair()
+        return db
+
+    def repair(self):
+        """
+        Make vectors and documents same count after persist() interrupted part way,
+        vectors are written first, so extra vectors are dropped, else extra documents are dropped
+        """
+        import faiss
+        if self.index.ntotal > 0 and self.untrained is not None:
+            # index written as trained before untrained file removed
+            self.untrained = None
+        num_vectors = self.index.ntotal + (self.untrained.shape[0] if self.untrained is not None else 0)
+        num_docs = len(self.docstore)
+        if num_vectors == num_docs:
+            return
+        print("Repairing faiss db %s with %d vectors and %d documents" %
+              (self._persist_directory, num_vectors, num_docs), flush=True)
+        if num_vectors > num_docs:
+            if self.untrained is not None:
+                self.untrained = self.untrained[:num_docs]
+            else:
+                if self.mmapped:
+                    self.index = faiss.read_index(os.path.join(self._persist_directory, 'faiss.index'))
+                    self.mmapped = False
+                self.index.remove_ids(faiss.IDSelectorRange(num_docs, self.index.ntotal))
+        else:
+            self.docstore.truncate(num_vectors)
+        self.persist()
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        import faiss
+        texts, embeddings = zip(*text_embeddings)
+        vectors = np.array(embeddings, dtype=np.float32)
+        with self.lock:
+            if self.mmapped:
+                # read-only mapping, so load fully once to add
+                self.index = faiss.read_index(os.path.join(self._persist_directory, 'faiss.index'))
+                self.mmapped = False
+            start = len(self.docstore)
+            ids = [str(start + i) for i in range(len(texts))]
+            self.docstore.add({id1: Document(page_content=text, metadata=metadatas[i] if metadatas else {})
+                               for i, (id1, text) in enumerate(zip(ids, texts))})
+            if self.index.is_trained:
+                self.index.add(vectors)
+            else:
+                self.untrained = vectors if self.untrained is None else np.concatenate([self.untrained, vectors])
+                self.train()
+        return ids
+
+    def train(self):
+        # untrained vectors are always first rows, since nothing added to index until trained
+        try:
+            self.index.train(self.untrained)
+        except RuntimeError as e:
+            # e.g. fewer vectors than IVF clusters, wait for more
+            print("Not yet training faiss index %s on %d vectors: %s" %
+                  (self.index_factory, self.untrained.shape[0], str(e)), flush=True)
+            return
+        self.index.add(self.untrained)
+        self.untrained = None
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20):
+        if self.untrained is not None:
+            distances = np.sum((self.untrained - np.array(embedding, dtype=np.float32)) ** 2, axis=1)
+            rows = np.argsort(distances)[:k if filter is None else fetch_k]
+            docs = [(self.docstore.get_document(int(row)), float(distances[row])) for row in rows]
+            if filter is not None:
+                docs = [x for x in docs if all(x[0].metadata.get(key) == value for key, value in filter.items())]
+            return docs[:k]
+        import faiss
+        try:
+            faiss.extract_index_ivf(self.index).nprobe = self.nprobe
+        except RuntimeError:
+            # not IVF
+            pass
+        return super().similarity_search_with_score_by_vector(embedding, k=k, filter=filter, fetch_k=fetch_k)
+
+    def persist(self):
+        import faiss
+        with self.lock:
+            makedirs(self._persist_directory)
+            # vectors before documents, so any interrupted persist leaves extra vectors that repair() drops
+            if not self.mmapped:
+                index_file = os.path.join(self._persist_directory, 'faiss.index')
+                faiss.write_index(self.index, index_file + '.tmp')
+                os.replace(index_file + '.tmp', index_file)
+            untrained_file = os.path.join(self._persist_directory, 'untrained.npy')
+            if self.untrained is not None:
+                np.save(untrained_file + '.tmp.npy', self.untrained)
+                os.replace(untrained_file + '.tmp.npy', untrained_file)
+            elif os.path.isfile(untrained_file):
+                remove(untrained_file)
+            self.docstore.save()
+            with open(os.path.join(self._persist_directory, 'faiss_info'), 'wt') as f:
+                json.dump(dict(collection_name=self.collection_name, index_factory=self.index_factory,
+                               nprobe=self.nprobe, num_documents=len(self.docstore)), f)
+
+
 def _get_unique_sources_in_weaviate(db):
     batch_size = 100
     id_source_list = []
@@ -124,17 +459,584 @@ def _get_unique_sources_in_weaviate(db):
     return unique_sources
 
 
+# per collection reader-writer locks, so similarity searches run concurrently and only adding documents is exclusive
+# weak, so per-user MyData locks go away with their last holder
+db_locks = weakref.WeakValueDictionary()
+db_locks_lock = threading.Lock()
+
+
+def get_db_lock(langchain_mode, persist_directory=None):
+    """
+    Reader-writer lock of db in this process, take read() around searches and write() around changes
+    :param persist_directory: db location, required for MyData since each user has own db
+    """
+    key = (langchain_mode or '').replace(' ', '_')
+    if langchain_mode == LangChainMode.MY_DATA.value and persist_directory is not None:
+        key = (key, os.path.abspath(persist_directory))
+    with db_locks_lock:
+        lock = db_locks.get(key)
+        if lock is None:
+            lock = db_locks[key] = ReadWriteLock()
+        return lock
+
+
+# inside each db's persist_directory, so each MyData user's db has own lock, kept when db files are replaced
+db_lock_file = '.db.lock'
+
+
+@contextlib.contextmanager
+def db_write_lock(langchain_mode, persist_directory=None):
+    """
+    Exclusive access for changing db: file lock against other processes, e.g. make_db.py while serving,
+    and write lock against this process's searches.  Not re-entrant, so only take at top of ingestion
+    """
+    persist_directory = persist_directory or get_persist_directory(langchain_mode)
+    makedirs(persist_directory)
+    with filelock.FileLock(os.path.join(persist_directory, db_lock_file)), \
+            get_db_lock(langchain_mode, persist_directory).write():
+        yield
+
+
+def db_dir_exists(persist_directory):
+    # not just lock file from db_write_lock()
+    return os.path.isdir(persist_directory) and any(x != db_lock_file for x in os.listdir(persist_directory))
+
+
+def clear_db_dir(persist_directory, backup=False):
+    """
+    Remove db files, or move them to new backup directory, but keep lock file that may be held
+    """
+    if not os.path.isdir(persist_directory):
+        return
+    backup_directory = persist_directory + "_" + str(uuid.uuid4()) + ".bak" if backup else None
+    for name in os.listdir(persist_directory):
+        if name == db_lock_file:
+            continue
+        if backup_directory:
+            makedirs(backup_directory)
+            shutil.move(os.path.join(persist_directory, name), os.path.join(backup_directory, name))
+        else:
+            remove(os.path.join(persist_directory, name))
+
+
+class ThreadLocalConnection:
+    """
+    Stand-in for chroma's one duckdb connection, with own cursor per thread on same database.
+    chroma runs each query and then fetches its result from the connection, so threads sharing
+    one connection get each other's results
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.local = threading.local()
+
+    def __getattr__(self, name):
+        cursor = getattr(self.local, 'cursor', None)
+        if cursor is None:
+            cursor = self.local.cursor = self.conn.cursor()
+        return getattr(cursor, name)
+
+
+def share_chroma_reads(db):
+    """
+    Let chroma db be searched from several threads at once, hnswlib queries are already safe concurrently
+    """
+    from chromadb.db.duckdb import DuckDB
+    db_impl = getattr(db._client, '_db', None)
+    if not isinstance(db_impl, DuckDB):
+        return
+    with db_locks_lock:
+        if db_impl._conn is not None and not isinstance(db_impl._conn, ThreadLocalConnection):
+            db_impl._conn = ThreadLocalConnection(db_impl._conn)
+
+
+def db_read_lock(db, langchain_mode):
+    """
+    Lock for searching or listing db, shared by concurrent searches
+    """
+    if isinstance(db, Chroma):
+        share_chroma_reads(db)
+    return get_db_lock(langchain_mode, getattr(db, '_persist_directory', None)).read()
+
+
+# per chroma collection index of source -> ids and hashid -> ids, so adding does not scan whole collection
+# keyed by absolute persist_directory, saved as source_index file next to embed_info when db is persisted
+source_indexes = {}
+# chroma dbs with added but not yet persisted documents, keyed by absolute persist_directory
+db_persist_pending = {}
+db_persist_lock = threading.Lock()
+# persist once this many chunks added or this many seconds passed since last persist, else defer
+db_persist_min_chunks = 1000
+db_persist_max_delay = 60
+# background thread persisting deferred dbs once db_persist_max_delay passed, running only while any are pending
+db_persist_thread = None
+
+
+def get_source_index_file(persist_directory):
+    return os.path.join(persist_directory, 'source_index')
+
+
+def new_source_index():
+    return dict(id2meta={}, source2ids={}, hashid2ids={})
+
+
+def add_to_source_index(source_index, ids, metadatas):
+    for id1, metadata in zip(ids, metadatas):
+        source = metadata.get('source')
+        hashid = metadata.get('hashid')
+        source_index['id2meta'][id1] = (source, hashid)
+        source_index['source2ids'].setdefault(source, set()).add(id1)
+        if hashid not in ["None", None]:
+            source_index['hashid2ids'].setdefault(hashid, set()).add(id1)
+
+
+def remove_from_source_index(source_index, ids):
+    for id1 in ids:
+        source, hashid = source_index['id2meta'].pop(id1, (None, None))
+        for key, value in [('source2ids', source), ('hashid2ids', hashid)]:
+            ids1 = source_index[key].get(value)
+            if ids1 is not None:
+                ids1.discard(id1)
+                if not ids1:
+                    source_index[key].pop(value)
+
+
+def get_source_index(db):
+    """
+    Get index for chroma db from memory, else from disk, else build from one scan of collection (migration)
+    Index on disk is only trusted if consistent with collection size, e.g. not if process died before persist
+    """
+    persist_directory = os.path.abspath(db._persist_directory)
+    source_index = source_indexes.get(persist_directory)
+    if source_index is not None:
+        return source_index
+    count = db._collection.count()
+    source_index_file = get_source_index_file(persist_directory)
+    if os.path.isfile(source_index_file):
+        try:
+            with open(source_index_file, 'rb') as f:
+                source_index = pickle.load(f)
+        except BaseException as e:
+            print("Failed to load %s: %s" % (source_index_file, str(e)), flush=True)
+            source_index = None
+        if source_index is not None and len(source_index['id2meta']) != count:
+            source_index = None
+    if source_index is None:
+        print("Building source index for %s from %d chunks" % (db._collection.name, count), flush=True)
+        source_index = new_source_index()
+        collection = db.get(include=['metadatas'])
+        add_to_source_index(source_index, collection['ids'], collection['metadatas'])
+    source_indexes[persist_directory] = source_index
+    return source_index
+
+
+def save_source_index(db):
+    persist_directory = os.path.abspath(db._persist_directory)
+    source_index = source_indexes.get(persist_directory)
+    if source_index is not None:
+        with open(get_source_index_file(persist_directory), 'wb') as f:
+            pickle.dump(source_index, f)
+        if db._collection.name == LangChainMode.MY_DATA.value:
+            # per-user scratch db, reload from disk next time instead of growing memory with each session
+            source_indexes.pop(persist_directory, None)
+    lexical_index = lexical_indexes.get(persist_directory)
+    if lexical_index is not None:
+        with open(get_lexical_index_file(persist_directory), 'wb') as f:
+            pickle.dump(lexical_index, f)
+        if db._collection.name == LangChainMode.MY_DATA.value:
+            lexical_indexes.pop(persist_directory, None)
+
+
+def persist_db(db, num_new=0, force=False):
+    """
+    Persist chroma or faiss_mmap db and chroma source index, deferred until enough chunks or time accumulated
+    unless force.  Pending dbs are persisted by background thread once db_persist_max_delay passed even if no more
+    documents are added, at exit, or by flush_persist_db() before anything else reads the directory
+    """
+    persist_directory = os.path.abspath(db._persist_directory)
+    if get_collection_name(db) == LangChainMode.MY_DATA.value:
+        # per-user scratch db, don't hold onto it
+        force = True
+    with db_persist_lock:
+        pending = db_persist_pending.setdefault(persist_directory, dict(db=db, num=0, time=time.time()))
+        pending['db'] = db
+        pending['num'] += num_new
+        if not force and pending['num'] < db_persist_min_chunks and \
+                time.time() - pending['time'] < db_persist_max_delay:
+            start_persist_thread()
+            return False
+        db_persist_pending.pop(persist_directory)
+    db.persist()
+    if isinstance(db, Chroma):
+        save_source_index(db)
+    return True
+
+
+def get_collection_name(db):
+    return db._collection.name if isinstance(db, Chroma) else db.collection_name
+
+
+def flush_persist_db(persist_directory=None, lock=False):
+    """
+    Persist any deferred chroma db for persist_directory, or all if None
+    :param lock: whether to take db write lock, e.g. from background thread, else caller holds it or is exiting
+    """
+    with db_persist_lock:
+        if persist_directory is None:
+            dbs = [x['db'] for x in db_persist_pending.values()]
+        else:
+            pending = db_persist_pending.get(os.path.abspath(persist_directory))
+            dbs = [pending['db']] if pending is not None else []
+    for db in dbs:
+        if lock:
+            with db_write_lock(get_collection_name(db), db._persist_directory):
+                # may have been persisted or dropped while waiting for lock
+                if os.path.abspath(db._persist_directory) in db_persist_pending:
+                    persist_db(db, force=True)
+        else:
+            persist_db(db, force=True)
+
+
+atexit.register(flush_persist_db)
+
+
+def start_persist_thread():
+    # caller holds db_persist_lock
+    global db_persist_thread
+    if db_persist_thread is None:
+        db_persist_thread = threading.Thread(target=persist_pending_dbs, name='persist_db', daemon=True)
+        db_persist_thread.start()
+
+
+def persist_pending_dbs():
+    """
+    Persist deferred dbs as they become db_persist_max_delay old, exit once none pending
+    """
+    global db_persist_thread
+    while True:
+        with db_persist_lock:
+            if not db_persist_pending:
+                db_persist_thread = None
+                return
+            now = time.time()
+            due = [k for k, v in db_persist_pending.items() if now - v['time'] >= db_persist_max_delay]
+            wait = min(db_persist_max_delay - (now - v['time']) for v in db_persist_pending.values())
+        for persist_directory in due:
+            try:
+                flush_persist_db(persist_directory, lock=True)
+            except BaseException as e:
+                print("Failed to persist %s: %s" % (persist_directory, str(e)), flush=True)
+        if not due:
+            time.sleep(max(wait, 0.1))
+
+
+def drop_persist_db(persist_directory):
+    """
+    Forget pending persist and source index, e.g. if persist_directory is removed or moved
+    """
+    persist_directory = os.path.abspath(persist_directory)
+    with db_persist_lock:
+        db_persist_pending.pop(persist_directory, None)
+    source_indexes.pop(persist_directory, None)
+    lexical_indexes.pop(persist_directory, None)
+
+
+# per chroma collection BM25 index of chunks, only for hybrid_search, keyed by absolute persist_directory
+# saved as lexical_index file next to source_index, and updated along with collection once exists
+lexical_indexes = {}
+# set if hybrid_search, so ingestion builds and updates lexical index under db write lock and queries only read it
+lexical_index_enabled = False
+
+
+class LexicalIndex:
+    """
+    Inverted index of chunk terms for BM25 scoring, by chroma id
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> {id: term frequency}
+        self.postings = {}
+        # id -> (number of terms, unique terms)
+        self.id2terms = {}
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.id2terms)
+
+    @staticmethod
+    def tokenize(text):
+        # keep identifiers like get_db whole, but also match their parts
+        tokens = re.findall(r'\w+', text.lower())
+        return tokens + [x for token in tokens if '_' in token for x in token.split('_') if x]
+
+    def add(self, ids, texts):
+        for id1, text in zip(ids, texts):
+            if id1 in self.id2terms:
+                self.remove([id1])
+            tokens = self.tokenize(text or '')
+            counts = defaultdict(int)
+            for token in tokens:
+                counts[token] += 1
+            for token, count in counts.items():
+                self.postings.setdefault(token, {})[id1] = count
+            self.id2terms[id1] = (len(tokens), list(counts))
+            self.total_len += len(tokens)
+
+    def remove(self, ids):
+        for id1 in ids:
+            num_tokens, terms = self.id2terms.pop(id1, (0, []))
+            self.total_len -= num_tokens
+            for term in terms:
+                postings = self.postings.get(term)
+                if postings is not None:
+                    postings.pop(id1, None)
+                    if not postings:
+                        self.postings.pop(term)
+
+    def search(self, query, k=100, ids=None):
+        """
+        :param ids: only score these ids, e.g. chunks of documents chosen
+        :return: list of (id, score) of top k by BM25 score
+        """
+        num_docs = len(self.id2terms)
+        if num_docs == 0:
+            return []
+        avg_len = self.total_len / num_docs
+        scores = defaultdict(float)
+        for term in set(self.tokenize(query)):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = np.log(1 + (num_docs - len(postings) + 0.5) / (len(postings) + 0.5))
+            for id1, tf in postings.items():
+                if ids is not None and id1 not in ids:
+                    continue
+                doc_len = self.id2terms[id1][0]
+                scores[id1] += idf * tf * (self.k1 + 1) / (tf + self.k1 * (1 - self.b + self.b * doc_len / avg_len))
+        return sorted(scores.items(), key=lambda x: x[1], reverse=True)[:k]
+
+
+def get_lexical_index_file(persist_directory):
+    return os.path.join(persist_directory, 'lexical_index')
+
+
+def get_lexical_index(db, build=True, keep=True):
+    """
+    Get BM25 index for chroma db from memory, else from disk, else if build then from one scan of collection
+    Like source index, only trusted if consistent with collection size
+    Only build under db write lock, at ingestion or when db first used, see lexical_index_enabled
+    :param keep: whether to keep index loaded from disk in memory, so later changes to db update it
+    """
+    persist_directory = os.path.abspath(db._persist_directory)
+    count = db._collection.count()
+    lexical_index = lexical_indexes.get(persist_directory)
+    if lexical_index is not None and len(lexical_index) == count:
+        return lexical_index
+    lexical_index = None
+    lexical_index_file = get_lexical_index_file(persist_directory)
+    if os.path.isfile(lexical_index_file):
+        try:
+            with open(lexical_index_file, 'rb') as f:
+                lexical_index = pickle.load(f)
+        except BaseException as e:
+            print("Failed to load %s: %s" % (lexical_index_file, str(e)), flush=True)
+        if lexical_index is not None and len(lexical_index) != count:
+            lexical_index = None
+    if lexical_index is None:
+        if not build:
+            lexical_indexes.pop(persist_directory, None)
+            return None
+        print("Building lexical index for %s from %d chunks" % (db._collection.name, count), flush=True)
+        lexical_index = LexicalIndex()
+        collection = db.get(include=['documents'])
+        lexical_index.add(collection['ids'], collection['documents'])
+    if keep:
+        lexical_indexes[persist_directory] = lexical_index
+    return lexical_index
+
+
+def update_lexical_index(db, ids, texts=None):
+    """
+    Keep any lexical index of chroma db in memory consistent with collection after ids added or removed
+    If still out of sync, e.g. db changed by other process, next ingestion or first use rebuilds it
+    :param texts: texts of added ids, else ids were removed
+    """
+    lexical_index = lexical_indexes.get(os.path.abspath(db._persist_directory))
+    if lexical_index is None:
+        return
+    if texts is not None:
+        lexical_index.add(ids, texts)
+    else:
+        lexical_index.remove(ids)
+
+
+def hybrid_search_with_score(db, query, k=100, filter=None, sources=None, rrf_k=60):
+    """
+    Retrieve chunks from chroma db by both vector similarity and BM25, fused by reciprocal rank
+    :param filter: chroma where filter for vector search, e.g. from document_choice
+    :param sources: same documents chosen, for filtering lexical search by ids in source index
+    :param rrf_k: reciprocal rank fusion constant, higher weighs lower ranks more
+    :return: list of (Document, distance) of top k, and python ids of those Documents found by lexical search
+    """
+    count = db._collection.count()
+    if count == 0:
+        return [], set()
+    query_embedding = db._embedding_function.embed_query(query)
+    vector_res = db._collection.query(query_embeddings=[query_embedding], n_results=min(k, count), where=filter,
+                                      include=['documents', 'metadatas', 'distances'])
+    vector_ids = vector_res['ids'][0]
+    results = {id1: (document, metadata or {}, distance) for id1, document, metadata, distance in
+               zip(vector_ids, vector_res['documents'][0], vector_res['metadatas'][0], vector_res['distances'][0])}
+
+    ids = None
+    if sources:
+        source_index = get_source_index(db)
+        ids = set(flatten_list([list(source_index['source2ids'].get(x, [])) for x in sources]))
+    # built at ingestion, so only read here, and per-user MyData not kept in memory like save_source_index()
+    lexical_index = get_lexical_index(db, build=False, keep=db._collection.name != LangChainMode.MY_DATA.value)
+    if lexical_index is None:
+        print("No lexical index for %s, using only vector search" % db._collection.name, flush=True)
+        lexical_ids = []
+    else:
+        lexical_ids = [id1 for id1, score in lexical_index.search(query, k=k, ids=ids)]
+
+    missing_ids = [x for x in lexical_ids if x not in results]
+    if missing_ids:
+        # distance of chunks only found by lexical search, same space as vector search
+        missing = db._collection.get(ids=missing_ids, include=['documents', 'metadatas', 'embeddings'])
+        space = (db._collection.metadata or {}).get('hnsw:space', 'l2')
+        query_embedding = np.array(query_embedding)
+        for id1, document, metadata, embedding in zip(missing['ids'], missing['documents'], missing['metadatas'],
+                                                      missing['embeddings']):
+            embedding = np.array(embedding)
+            if space == 'cosine':
+                distance = 1 - np.dot(query_embedding, embedding) / \
+                           (np.linalg.norm(query_embedding) * np.linalg.norm(embedding) + 1e-12)
+            elif space == 'ip':
+                distance = 1 - np.dot(query_embedding, embedding)
+            else:
+                distance = np.sum((query_embedding - embedding) ** 2)
+            results[id1] = (document, metadata or {}, float(distance))
+
+    rrf = defaultdict(float)
+    for ranked_ids in [vector_ids, lexical_ids]:
+        for rank, id1 in enumerate(ranked_ids):
+            rrf[id1] += 1.0 / (rrf_k + rank + 1)
+    top_ids = sorted([x for x in rrf if x in results], key=lambda x: rrf[x], reverse=True)[:k]
+    docs_with_score = [(Document(page_content=results[x][0], metadata=results[x][1]), results[x][2])
+                       for x in top_ids]
+    lexical_ids = set(lexical_ids)
+    return docs_with_score, set(id(x[0]) for x, id1 in zip(docs_with_score, top_ids) if id1 in lexical_ids)
+
+
+def get_file_manifest_file(persist_directory):
+    return os.path.join(persist_directory, 'file_manifest')
+
+
+def load_file_manifest(persist_directory):
+    """
+    Manifest of files ingested from user_path into db at persist_directory
+    :return: dict of file -> dict(size, mtime, inode, hashid)
+    """
+    file_manifest_file = get_file_manifest_file(persist_directory)
+    if os.path.isfile(file_manifest_file):
+        try:
+            with open(file_manifest_file, 'rb') as f:
+                return pickle.load(f)
+        except BaseException as e:
+            print("Failed to load %s: %s" % (file_manifest_file, str(e)), flush=True)
+    return {}
+
+
+def save_file_manifest(persist_directory, file_manifest):
+    makedirs(persist_directory)
+    file_manifest_file = get_file_manifest_file(persist_directory)
+    # write then move, so partial manifest never seen if killed while writing
+    with open(file_manifest_file + '.tmp', 'wb') as f:
+        pickle.dump(file_manifest, f)
+    os.replace(file_manifest_file + '.tmp', file_manifest_file)
+
+
+def get_file_signature(file):
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return dict(size=stat.st_size, mtime=stat.st_mtime_ns, inode=stat.st_ino)
+
+
+def get_manifest_hash(file_manifest, file, signature):
+    """
+    :return: hashid of file from manifest if file unchanged since, else None
+    """
+    entry = file_manifest.get(file)
+    if signature is None or entry is None or entry.get('hashid') in ["None", None]:
+        return None
+    if any(entry.get(k) != v for k, v in signature.items()):
+        return None
+    return entry['hashid']
+
+
+def purge_deleted_files(db, file_manifest, db_type='chroma', verbose=False):
+    """
+    Remove chunks of files in manifest that no longer exist on disk, from db and manifest
+    :return: list of removed files
+    """
+    deleted_files = [x for x in file_manifest if not os.path.exists(x)]
+    if not deleted_files:
+        return []
+    if db is not None and db_type == 'chroma':
+        source_index = get_source_index(db)
+        ids = flatten_list([list(source_index['source2ids'].get(x, [])) for x in deleted_files])
+        if ids:
+            db._collection.delete(ids=ids)
+            remove_from_source_index(source_index, ids)
+            update_lexical_index(db, ids)
+            persist_db(db, num_new=len(ids), force=True)
+    elif db is not None:
+        # FIXME: faiss in this langchain has no delete, weaviate only by file name
+        print("Cannot purge deleted files from db_type=%s, only from manifest" % db_type, flush=True)
+    [file_manifest.pop(x) for x in deleted_files]
+    print("Purged %s deleted files" % len(deleted_files), flush=True)
+    if verbose:
+        print("Files purged: %s" % '\n'.join(deleted_files), flush=True)
+    return deleted_files
+
+
 def add_to_db(db, sources, db_type='faiss',
               avoid_dup_by_file=False,
               avoid_dup_by_content=True,
               use_openai_embedding=False,
-              hf_embedding_model=None):
+              hf_embedding_model=None,
+              embeddings=None):
+    """
+    :param embeddings: embeddings of sources if already computed, e.g. by separate embedding stage of path_to_db
+    """
     assert hf_embedding_model is not None
     num_new_sources = len(sources)
     if not sources:
         return db, num_new_sources, []
-    if db_type == 'faiss':
-        db.add_documents(sources)
+    if embeddings is not None:
+        # by document, since sources are filtered below
+        embeddings = dict(zip([id(x) for x in sources], embeddings))
+
+    def get_embeddings(sources1):
+        if embeddings is not None:
+            return [embeddings[id(x)] for x in sources1]
+        # only after filtering, so duplicates are not embedded
+        embedding = get_embedding(use_openai_embedding, hf_embedding_model=hf_embedding_model)
+        return embed_documents_cached(embedding, [x.page_content for x in sources1],
+                                      use_openai_embedding=use_openai_embedding,
+                                      hf_embedding_model=hf_embedding_model)
+    if db_type in ['faiss', 'faiss_mmap']:
+        # FIXME: faiss_mmap like faiss avoids duplicates only by path_to_docs skipping files with same hash
+        add_num_tokens(sources)
+        add_embedded_documents(db, sources, get_embeddings(sources))
+        if db_type == 'faiss_mmap':
+            persist_db(db, num_new=num_new_sources)
+            set_db_handle(db, use_openai_embedding, hf_embedding_model)
     elif db_type == 'weaviate':
         # FIXME: only control by file name, not hash yet
         if avoid_dup_by_file or avoid_dup_by_content:
@@ -143,45 +1045,51 @@ def add_to_db(db, sources, db_type='faiss',
         num_new_sources = len(sources)
         if num_new_sources == 0:
             return db, num_new_sources, []
+        add_num_tokens(sources)
         db.add_documents(documents=sources)
     elif db_type == 'chroma':
-        collection = db.get()
-        # files we already have:
-        metadata_files = set([x['source'] for x in collection['metadatas']])
+        # files and hashes we already have, from index kept next to collection instead of scanning collection
+        source_index = get_source_index(db)
+        if lexical_index_enabled:
+            # so updated below along with collection
+            get_lexical_index(db)
         if avoid_dup_by_file:
             # Too weak in case file changed content, assume parent shouldn't pass true for this for now
             raise RuntimeError("Not desired code path")
-            sources = [x for x in sources if x.metadata['source'] not in metadata_files]
+            sources = [x for x in sources if x.metadata['source'] not in source_index['source2ids']]
         if avoid_dup_by_content:
             # look at hash, instead of page_content
             # migration: If no hash previously, avoid updating,
             #  since don't know if need to update and may be expensive to redo all unhashed files
-            metadata_hash_ids = set(
-                [x['hashid'] for x in collection['metadatas'] if 'hashid' in x and x['hashid'] not in ["None", None]])
             # avoid sources with same hash
-            sources = [x for x in sources if x.metadata.get('hashid') not in metadata_hash_ids]
+            sources = [x for x in sources if x.metadata.get('hashid') in ["None", None] or
+                       x.metadata.get('hashid') not in source_index['hashid2ids']]
             num_nohash = len([x for x in sources if not x.metadata.get('hashid')])
             print("Found %s new sources (%d have no hash in original source,"
                   " so have to reprocess for migration to sources with hash)" % (len(sources), num_nohash), flush=True)
             # get new file names that match existing file names.  delete existing files we are overridding
-            dup_metadata_files = set([x.metadata['source'] for x in sources if x.metadata['source'] in metadata_files])
+            dup_metadata_files = set([x.metadata['source'] for x in sources
+                                      if x.metadata['source'] in source_index['source2ids']])
             print("Removing %s duplicate files from db because ingesting those as new documents" % len(
                 dup_metadata_files), flush=True)
-            client_collection = db._client.get_collection(name=db._collection.name,
-                                                          embedding_function=db._collection._embedding_function)
-            for dup_file in dup_metadata_files:
-                dup_file_meta = dict(source=dup_file)
-                try:
-                    client_collection.delete(where=dup_file_meta)
-                except KeyError:
-                    pass
+            dup_ids = flatten_list([list(source_index['source2ids'][x]) for x in dup_metadata_files])
+            if dup_ids:
+                # single batched delete by id, no where scan per file
+                db._collection.delete(ids=dup_ids)
+                remove_from_source_index(source_index, dup_ids)
+                update_lexical_index(db, dup_ids)
         num_new_sources = len(sources)
         if num_new_sources == 0:
             return db, num_new_sources, []
-        db.add_documents(documents=sources)
-        db.persist()
+        add_num_tokens(sources)
+        ids = add_embedded_documents(db, sources, get_embeddings(sources))
+        add_to_source_index(source_index, ids, [x.metadata for x in sources])
+        update_lexical_index(db, ids, [x.page_content for x in sources])
+        persist_db(db, num_new=num_new_sources)
         clear_embedding(db)
         save_embed(db, use_openai_embedding, hf_embedding_model)
+        # collection changed, so replace any registered handle with this updated one
+        set_db_handle(db, use_openai_embedding, hf_embedding_model)
     else:
         raise RuntimeError("No such db_type=%s" % db_type)
 
@@ -191,7 +1099,12 @@ def add_to_db(db, sources, db_type='faiss',
 
 
 def create_or_update_db(db_type, persist_directory, collection_name,
-                        sources, use_openai_embedding, add_if_exists, verbose, hf_embedding_model):
+                        sources, use_openai_embedding, add_if_exists, verbose, hf_embedding_model,
+                        path_kwargs=None):
+    """
+    :param sources: documents to add, or None to stream documents from files given by path_kwargs
+    :param path_kwargs: kwargs for path_to_db if sources is None, e.g. path_or_paths, n_jobs, embed_workers
+    """
     if db_type == 'weaviate':
         import weaviate
         from weaviate.embedded import EmbeddedOptions
@@ -208,12 +1121,14 @@ def create_or_update_db(db_type, persist_directory, collection_name,
             client.schema.delete_class(index_name)
             if verbose:
                 print("Removing %s" % index_name, flush=True)
-    elif db_type == 'chroma':
-        if not os.path.isdir(persist_directory) or not add_if_exists:
-            if os.path.isdir(persist_directory):
+    elif db_type in ['chroma', 'faiss_mmap']:
+        if not db_dir_exists(persist_directory) or not add_if_exists:
+            if db_dir_exists(persist_directory):
                 if verbose:
                     print("Removing %s" % persist_directory, flush=True)
-                remove(persist_directory)
+                with db_write_lock(collection_name, persist_directory):
+                    invalidate_db_handle(collection_name, persist_directory)
+                    clear_db_dir(persist_directory)
             if verbose:
                 print("Generating db", flush=True)
 
@@ -224,16 +1139,204 @@ def create_or_update_db(db_type, persist_directory, collection_name,
         if verbose:
             print("Loading and updating db", flush=True)
 
-    db = get_db(sources,
-                use_openai_embedding=use_openai_embedding,
-                db_type=db_type,
-                persist_directory=persist_directory,
-                langchain_mode=collection_name,
-                hf_embedding_model=hf_embedding_model)
+    if sources is None:
+        # takes db write lock per batch
+        db, num_new_sources, new_sources_metadata = path_to_db(None,
+                                                               use_openai_embedding=use_openai_embedding,
+                                                               db_type=db_type,
+                                                               persist_directory=persist_directory,
+                                                               langchain_mode=collection_name,
+                                                               hf_embedding_model=hf_embedding_model,
+                                                               verbose=verbose,
+                                                               **path_kwargs)
+    else:
+        with db_write_lock(collection_name, persist_directory):
+            db = get_db(sources,
+                        use_openai_embedding=use_openai_embedding,
+                        db_type=db_type,
+                        persist_directory=persist_directory,
+                        langchain_mode=collection_name,
+                        hf_embedding_model=hf_embedding_model)
 
     return db
 
 
+def path_to_db(db, path_or_paths, use_openai_embedding=False, db_type='chroma', persist_directory=None,
+               langchain_mode='UserData', hf_embedding_model="sentence-transformers/all-MiniLM-L6-v2",
+               embed_batch_size=256, embed_workers=1, queue_size=4, faiss_index_factory=None, verbose=False,
+               **kwargs):
+    """
+    Streaming ingestion of files into db: parse and chunk -> embed -> add to db,
+    with stages connected by bounded queues so embedding and db writes overlap with parsing,
+    and at most a few batches per stage are in memory no matter how many files
+    :param db: db to add to, or None to get or make db with first batch
+    :param embed_batch_size: number of chunks embedded and added to db at once, more if needed to keep file in one batch
+    :param embed_workers: threads embedding batches, parsing uses n_jobs processes and db writes are one at a time
+    :param queue_size: max batches waiting between stages
+    :param faiss_index_factory: see get_db
+    :param kwargs: for path_to_docs_iter, e.g. n_jobs, chunk, chunk_size, existing_hash_ids
+    :return: db, number of new chunks, metadata of first new chunk of each source
+    """
+    embedding = get_embedding(use_openai_embedding, hf_embedding_model=hf_embedding_model)
+    parsed = StreamQueue(maxsize=queue_size)
+    embedded = StreamQueue(maxsize=queue_size)
+    stage_exceptions = []
+    num_embed_done = [0]
+    num_embed_done_lock = threading.Lock()
+
+    def run_stage(func, queue_out):
+        try:
+            func()
+        except BaseException as e:
+            traceback.print_exc()
+            stage_exceptions.append(e)
+            parsed.stop()
+            embedded.stop()
+        finally:
+            if queue_out is parsed:
+                parsed.close()
+            else:
+                with num_embed_done_lock:
+                    num_embed_done[0] += 1
+                    if num_embed_done[0] == embed_workers:
+                        embedded.close()
+
+    def parse():
+        batch = []
+        for documents in path_to_docs_iter(path_or_paths, verbose=verbose, **kwargs):
+            exceptions = [x for x in documents if x.metadata.get('exception')]
+            if exceptions:
+                print("Exceptions: %s" % exceptions, flush=True)
+            # all chunks of a file in same batch, since add_to_db skips chunks whose file hash is already in db
+            batch.extend([x for x in documents if not x.metadata.get('exception')])
+            if len(batch) >= embed_batch_size:
+                if not parsed.put(batch):
+                    return
+                batch = []
+        if batch:
+            parsed.put(batch)
+
+    def embed():
+        for batch in parsed:
+            embeddings = embed_documents_cached(embedding, [x.page_content for x in batch],
+                                                use_openai_embedding=use_openai_embedding,
+                                                hf_embedding_model=hf_embedding_model)
+            if not embedded.put((batch, embeddings)):
+                return
+
+    threads = [threading.Thread(target=run_stage, args=(parse, parsed))] + \
+              [threading.Thread(target=run_stage, args=(embed, embedded)) for _ in range(embed_workers)]
+    [x.start() for x in threads]
+    num_new_sources = 0
+    new_sources_metadata = {}
+    try:
+        for batch, embeddings in embedded:
+            # lock per batch, so searches of db can run between batches
+            with db_write_lock(langchain_mode, persist_directory):
+                if db is None:
+                    db = get_db(batch, use_openai_embedding=use_openai_embedding, db_type=db_type,
+                                persist_directory=persist_directory, langchain_mode=langchain_mode,
+                                hf_embedding_model=hf_embedding_model, embeddings=embeddings,
+                                faiss_index_factory=faiss_index_factory)
+                    num_new_sources1, new_sources_metadata1 = len(batch), [x.metadata for x in batch]
+                else:
+                    db, num_new_sources1, new_sources_metadata1 = add_to_db(db, batch, db_type=db_type,
+                                                                            use_openai_embedding=use_openai_embedding,
+                                                                            hf_embedding_model=hf_embedding_model,
+                                                                            embeddings=embeddings)
+            num_new_sources += num_new_sources1
+            [new_sources_metadata.setdefault(x['source'], x) for x in new_sources_metadata1]
+            if verbose:
+                print("Added %s chunks to db, %s so far" % (num_new_sources1, num_new_sources), flush=True)
+    finally:
+        # e.g. if db write failed, let other stages exit
+        parsed.stop()
+        embedded.stop()
+        [x.join() for x in threads]
+    if stage_exceptions:
+        raise stage_exceptions[0]
+    if db_type in ['chroma', 'faiss_mmap'] and db is not None:
+        with db_write_lock(langchain_mode, persist_directory):
+            flush_persist_db(db._persist_directory)
+    return db, num_new_sources, list(new_sources_metadata.values())
+
+
+# process-wide pool of loaded HF embedding models, shared by ingestion, query, and embedding checks
+# keyed by (hf_embedding_model, device), value is Future of model so loading is outside lock, ordered by least-recently used
+embedding_pool = OrderedDict()
+embedding_pool_lock = threading.Lock()
+# approximate bytes of embedding model weights to keep resident before evicting least-recently used
+embedding_pool_max_bytes = int(os.getenv('EMBEDDING_POOL_MAX_BYTES', str(4 * 1024 ** 3)))
+
+
+def get_embedding_bytes(embedding):
+    client = getattr(embedding, 'client', None)
+    if client is None or not hasattr(client, 'parameters'):
+        return 0
+    return sum(p.numel() * p.element_size() for p in client.parameters())
+
+
+# number of ingestions and queries using model of each pool key, counted by embedding_user(), never evicted while used
+embedding_users = {}
+
+
+def get_embedding_pool_key(embedding):
+    """
+    :return: pool key of loaded embedding model, or None if not from pool, e.g. OpenAI. Caller holds embedding_pool_lock
+    """
+    for key, future in embedding_pool.items():
+        if future.done() and future.exception() is None and future.result() is embedding:
+            return key
+    return None
+
+
+@contextlib.contextmanager
+def embedding_user(embedding):
+    """
+    Count embedding model as used, e.g. during ingestion or query, so pool does not evict it meanwhile
+    :param embedding: embedding, or db's embedding function, e.g. faiss's bound embed_query
+    """
+    embedding = getattr(embedding, '__self__', embedding)
+    with embedding_pool_lock:
+        key = get_embedding_pool_key(embedding)
+        if key is not None:
+            embedding_users[key] = embedding_users.get(key, 0) + 1
+    try:
+        yield embedding
+    finally:
+        if key is not None:
+            with embedding_pool_lock:
+                embedding_users[key] -= 1
+                if embedding_users[key] == 0:
+                    embedding_users.pop(key)
+
+
+def evict_embeddings(keep_key):
+    """
+    Evict least-recently used embedding models until pool fits, never the one just loaded, ones still loading,
+    or ones used by ingestion or query.  Idle db handles using evicted models are dropped too, so memory is freed
+    and next access reloads db with model from pool, instead of a second copy staying alive in handle
+    """
+    evicted = []
+    with embedding_pool_lock:
+        loaded = [key for key, future in embedding_pool.items() if future.done() and future.exception() is None]
+        total_bytes = sum(get_embedding_bytes(embedding_pool[key].result()) for key in loaded)
+        for key in loaded:
+            if total_bytes <= embedding_pool_max_bytes:
+                break
+            if key == keep_key or embedding_users.get(key, 0) > 0:
+                continue
+            embedding = embedding_pool.pop(key).result()
+            total_bytes -= get_embedding_bytes(embedding)
+            print("Evicting embedding model from pool: %s" % str(key), flush=True)
+            evicted.append(embedding)
+    if evicted:
+        drop_db_handles(evicted)
+        # last references, so memory is freed before clearing cache
+        del embedding, evicted
+        clear_torch_cache()
+
+
 def get_embedding(use_openai_embedding, hf_embedding_model="sentence-transformers/all-MiniLM-L6-v2"):
     # Get embedding model
     if use_openai_embedding:
@@ -241,21 +1344,132 @@ def get_embedding(use_openai_embedding, hf_embedding_model="sentence-transformer
         from langchain.embeddings import OpenAIEmbeddings
         embedding = OpenAIEmbeddings(disallowed_special=())
     else:
-        # to ensure can fork without deadlock
-        from langchain.embeddings import HuggingFaceEmbeddings
-
         device, torch_dtype, context_class = get_device_dtype()
-        model_kwargs = dict(device=device)
-        if 'instructor' in hf_embedding_model:
-            encode_kwargs = {'normalize_embeddings': True}
-            embedding = HuggingFaceInstructEmbeddings(model_name=hf_embedding_model,
-                                                      model_kwargs=model_kwargs,
-                                                      encode_kwargs=encode_kwargs)
-        else:
-            embedding = HuggingFaceEmbeddings(model_name=hf_embedding_model, model_kwargs=model_kwargs)
+        key = (hf_embedding_model, device)
+        with embedding_pool_lock:
+            future = embedding_pool.get(key)
+            load = future is None
+            if load:
+                # first caller loads, others for same model wait on future, others for other models not blocked
+                future = embedding_pool[key] = Future()
+                future.set_running_or_notify_cancel()
+            else:
+                embedding_pool.move_to_end(key)
+        if not load:
+            return future.result()
+        try:
+            embedding = get_hf_embedding(hf_embedding_model, device)
+        except BaseException as e:
+            with embedding_pool_lock:
+                embedding_pool.pop(key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(embedding)
+        evict_embeddings(key)
     return embedding
 
 
+def get_hf_embedding(hf_embedding_model, device):
+    # to ensure can fork without deadlock
+    from langchain.embeddings import HuggingFaceEmbeddings
+
+    model_kwargs = dict(device=device)
+    if 'instructor' in hf_embedding_model:
+        encode_kwargs = {'normalize_embeddings': True}
+        embedding = HuggingFaceInstructEmbeddings(model_name=hf_embedding_model,
+                                                  model_kwargs=model_kwargs,
+                                                  encode_kwargs=encode_kwargs)
+    else:
+        embedding = HuggingFaceEmbeddings(model_name=hf_embedding_model, model_kwargs=model_kwargs)
+    return embedding
+
+
+# sqlite file of chunk embeddings keyed by (embedding model, sha256 of chunk text), shared by all dbs, off unless set
+embedding_cache_path = os.getenv('EMBEDDING_CACHE_PATH')
+# oldest written vectors dropped beyond this many, ~3GB for 768-dim vectors
+embedding_cache_max_rows = int(os.getenv('EMBEDDING_CACHE_MAX_ROWS', '1000000'))
+embedding_caches = {}
+embedding_caches_lock = threading.Lock()
+
+
+class EmbeddingCache:
+    """
+    Vectors stored as float32 blobs, so same text in another collection, build, or chunking is not embedded again
+    """
+
+    def __init__(self, path, max_rows=None):
+        import sqlite3
+        makedirs(os.path.dirname(os.path.abspath(path)))
+        self.lock = threading.Lock()
+        self.max_rows = max_rows
+        # one connection shared by ingestion threads, WAL so other processes can read while one writes
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=60)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings "
+                          "(model TEXT, hash TEXT, vector BLOB, PRIMARY KEY (model, hash))")
+        self.conn.commit()
+
+    def get(self, model, hashes):
+        """
+        :return: dict of hash -> vector for hashes in cache
+        """
+        found = {}
+        with self.lock:
+            # below sqlite default limit of 999 variables per statement
+            for i in range(0, len(hashes), 500):
+                hashes1 = hashes[i:i + 500]
+                rows = self.conn.execute("SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN (%s)" %
+                                         ','.join('?' * len(hashes1)), [model] + hashes1).fetchall()
+                found.update({hash1: np.frombuffer(vector, dtype=np.float32).tolist() for hash1, vector in rows})
+        return found
+
+    def put(self, model, hashes, vectors):
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)",
+                                  [(model, hash1, np.asarray(vector, dtype=np.float32).tobytes())
+                                   for hash1, vector in zip(hashes, vectors)])
+            if self.max_rows is not None:
+                # replaced rows get new rowid, so lowest rowid is least recently written
+                num_evict = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_rows
+                if num_evict > 0:
+                    self.conn.execute("DELETE FROM embeddings WHERE rowid IN "
+                                      "(SELECT rowid FROM embeddings ORDER BY rowid LIMIT ?)", (num_evict,))
+            self.conn.commit()
+
+
+def get_embedding_cache():
+    if not embedding_cache_path:
+        return None
+    with embedding_caches_lock:
+        if embedding_cache_path not in embedding_caches:
+            embedding_caches[embedding_cache_path] = EmbeddingCache(embedding_cache_path,
+                                                                    max_rows=embedding_cache_max_rows)
+        return embedding_caches[embedding_cache_path]
+
+
+def embed_documents_cached(embedding, texts, use_openai_embedding=False, hf_embedding_model=None):
+    """
+    Like embedding.embed_documents(texts), but only texts not already in embedding cache are sent to model
+    """
+    with embedding_user(embedding):
+        embedding_cache = get_embedding_cache()
+        if embedding_cache is None:
+            return embedding.embed_documents(texts)
+        import hashlib
+        model = 'openai:%s' % getattr(embedding, 'model', '') if use_openai_embedding else hf_embedding_model
+        hashes = [hashlib.sha256(x.encode('utf-8', errors='surrogatepass')).hexdigest() for x in texts]
+        found = embedding_cache.get(model, list(set(hashes)))
+        # each missing text once, even if repeated
+        missing = {hash1: text for hash1, text in zip(hashes, texts) if hash1 not in found}
+        if missing:
+            # same float32 values as from cache, so a db does not depend upon which chunks were cached
+            vectors = [np.asarray(x, dtype=np.float32).tolist()
+                       for x in embedding.embed_documents(list(missing.values()))]
+            embedding_cache.put(model, list(missing), vectors)
+            found.update(dict(zip(missing, vectors)))
+        return [found[x] for x in hashes]
+
+
 def get_answer_from_sources(chain, sources, question):
     return chain(
         {
@@ -400,23 +1614,19 @@ class GradioInference(LLM):
 
             job = gr_client.submit(str(dict(client_kwargs)), api_name=api_name)
             text0 = ''
-            while not job.done():
-                outputs_list = job.communicator.job.outputs
-                if outputs_list:
-                    res = job.communicator.job.outputs[-1]
-                    res_dict = ast.literal_eval(res)
-                    text = res_dict['response']
-                    text = self.prompter.get_response(prompt + text, prompt=prompt,
-                                                      sanitize_bot_response=self.sanitize_bot_response)
-                    # FIXME: derive chunk from full for now
-                    text_chunk = text[len(text0):]
-                    # save old
-                    text0 = text
-
-                    if text_callback:
-                        text_callback(text_chunk)
+            # wakes as soon as each output arrives
+            for res in gr_client.stream_outputs(job):
+                res_dict = ast.literal_eval(res)
+                text = res_dict['response']
+                text = self.prompter.get_response_stream(prompt + text, prompt=prompt,
+                                                         sanitize_bot_response=self.sanitize_bot_response)
+                # FIXME: derive chunk from full for now
+                text_chunk = text[len(text0):]
+                # save old
+                text0 = text
 
-                time.sleep(0.01)
+                if text_callback:
+                    text_callback(text_chunk)
 
             # ensure get last output to avoid race
             res_all = job.outputs()
@@ -538,12 +1748,14 @@ class H2OHuggingFaceTextGenInference(HuggingFaceTextGenInference):
             if text_callback:
                 text_callback(prompt)
             text = ""
+            text_raw = ""
             # Note: Streaming ignores return_full_text=True
             for response in self.client.generate_stream(prompt, **gen_server_kwargs):
                 text_chunk = response.token.text
-                text += text_chunk
-                text = self.prompter.get_response(prompt + text, prompt=prompt,
-                                                  sanitize_bot_response=self.sanitize_bot_response)
+                # keep raw text, so only new chunk is cleaned instead of re-cleaning already cleaned text
+                text_raw += text_chunk
+                text = self.prompter.get_response_stream(prompt + text_raw, prompt=prompt,
+                                                         sanitize_bot_response=self.sanitize_bot_response)
                 # stream part
                 is_stop = False
                 for stop_seq in stop:
@@ -746,7 +1958,7 @@ def get_llm(use_openai_model=False,
             skip_prompt = False
             from generate import H2OTextIteratorStreamer
             decoder_kwargs = {}
-            streamer = H2OTextIteratorStreamer(tokenizer, skip_prompt=skip_prompt, block=False, **decoder_kwargs)
+            streamer = H2OTextIteratorStreamer(tokenizer, skip_prompt=skip_prompt, **decoder_kwargs)
             gen_kwargs.update(dict(streamer=streamer))
         else:
             streamer = None
@@ -907,37 +2119,13 @@ def get_dai_docs(from_hf=False, get_pickle=True):
     return sources
 
 
-import distutils.spawn
-
-have_tesseract = distutils.spawn.find_executable("tesseract")
-have_libreoffice = distutils.spawn.find_executable("libreoffice")
+have_tesseract = shutil.which("tesseract")
+have_libreoffice = shutil.which("libreoffice")
 
-import pkg_resources
-
-try:
-    assert pkg_resources.get_distribution('arxiv') is not None
-    assert pkg_resources.get_distribution('pymupdf') is not None
-    have_arxiv = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    have_arxiv = False
-
-try:
-    assert pkg_resources.get_distribution('pymupdf') is not None
-    have_pymupdf = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    have_pymupdf = False
-
-try:
-    assert pkg_resources.get_distribution('selenium') is not None
-    have_selenium = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    have_selenium = False
-
-try:
-    assert pkg_resources.get_distribution('playwright') is not None
-    have_playwright = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    have_playwright = False
+have_arxiv = have_package('arxiv') and have_package('pymupdf')
+have_pymupdf = have_package('pymupdf')
+have_selenium = have_package('selenium')
+have_playwright = have_package('playwright')
 
 # disable, hangs too often
 have_playwright = False
@@ -1194,12 +2382,62 @@ def file_to_doc(file, base_path=None, verbose=False, fail_any_exception=False,
     return docs
 
 
+def get_parse_cache_file(file, parse_cache_dir, chunk=True, chunk_size=512,
+                         enable_captions=True, captions_model=None, enable_ocr=False):
+    """
+    Get cache file for parsed Documents of file, keyed by file content and settings that change the parse
+    :return: filename of cache pickle, or None if file should not be cached
+    """
+    if not parse_cache_dir or not os.path.isfile(file):
+        return None
+    if file.lower().endswith('.zip') or file.lower().endswith('.urls'):
+        # zip extracts to new unique path each time, urls depend upon remote content
+        return None
+    hashid = hash_file(file)
+    if hashid is None:
+        return None
+    settings = str((pathlib.Path(file).suffix.lower(), chunk, chunk_size, enable_captions, captions_model, enable_ocr))
+    import hashlib
+    settings_hash = hashlib.md5(settings.encode('utf-8')).hexdigest()
+    return os.path.join(parse_cache_dir, "%s_%s.pickle" % (hashid, settings_hash))
+
+
+def load_parse_cache(cache_file, file):
+    if cache_file is None or not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'rb') as f:
+            cached_file, docs = pickle.load(f)
+    except BaseException as e:
+        print("Failed to load parse cache %s for %s: %s" % (cache_file, file, str(e)), flush=True)
+        return None
+    # same content may have been parsed from another path, so point sources to this file
+    if cached_file != file:
+        [x.metadata.update(dict(source=file)) for x in docs if x.metadata.get('source') == cached_file]
+    return docs
+
+
+def save_parse_cache(cache_file, file, docs):
+    if cache_file is None:
+        return
+    if any('exception' in x.metadata for x in docs):
+        # allow retry of failures
+        return
+    makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write then rename, so parallel ingestion never reads partial pickle
+    cache_file_tmp = cache_file + "_" + str(uuid.uuid4()) + ".tmp"
+    with open(cache_file_tmp, 'wb') as f:
+        pickle.dump((file, docs), f)
+    os.replace(cache_file_tmp, cache_file)
+
+
 def path_to_doc1(file, verbose=False, fail_any_exception=False, return_file=True,
                  chunk=True, chunk_size=512,
                  is_url=False, is_txt=False,
                  enable_captions=True,
                  captions_model=None,
-                 enable_ocr=False, caption_loader=None):
+                 enable_ocr=False, caption_loader=None,
+                 parse_cache_dir=None):
     if verbose:
         if is_url:
             print("Ingesting URL: %s" % file, flush=True)
@@ -1208,15 +2446,25 @@ def path_to_doc1(file, verbose=False, fail_any_exception=False, return_file=True
         else:
             print("Ingesting file: %s" % file, flush=True)
     res = None
+    cache_file = None
     try:
-        # don't pass base_path=path, would infinitely recurse
-        res = file_to_doc(file, base_path=None, verbose=verbose, fail_any_exception=fail_any_exception,
-                          chunk=chunk, chunk_size=chunk_size,
-                          is_url=is_url, is_txt=is_txt,
-                          enable_captions=enable_captions,
-                          captions_model=captions_model,
-                          enable_ocr=enable_ocr,
-                          caption_loader=caption_loader)
+        if not is_url and not is_txt:
+            cache_file = get_parse_cache_file(file, parse_cache_dir, chunk=chunk, chunk_size=chunk_size,
+                                              enable_captions=enable_captions, captions_model=captions_model,
+                                              enable_ocr=enable_ocr)
+            res = load_parse_cache(cache_file, file)
+            if res is not None and verbose:
+                print("Using parse cache for file: %s" % file, flush=True)
+        if res is None:
+            # don't pass base_path=path, would infinitely recurse
+            res = file_to_doc(file, base_path=None, verbose=verbose, fail_any_exception=fail_any_exception,
+                              chunk=chunk, chunk_size=chunk_size,
+                              is_url=is_url, is_txt=is_txt,
+                              enable_captions=enable_captions,
+                              captions_model=captions_model,
+                              enable_ocr=enable_ocr,
+                              caption_loader=caption_loader)
+            save_parse_cache(cache_file, file, res)
     except BaseException as e:
         print("Failed to ingest %s due to %s" % (file, traceback.format_exc()))
         if fail_any_exception:
@@ -1246,12 +2494,35 @@ def path_to_docs(path_or_paths, verbose=False, fail_any_exception=False, n_jobs=
                  enable_ocr=False,
                  existing_files=[],
                  existing_hash_ids={},
+                 parse_cache_dir=None,
+                 file_manifest=None,
                  ):
+    return [doc for documents in path_to_docs_iter(**locals()) for doc in documents]
+
+
+@track_ingestion
+def path_to_docs_iter(path_or_paths, verbose=False, fail_any_exception=False, n_jobs=-1,
+                      chunk=True, chunk_size=512,
+                      url=None, text=None,
+                      enable_captions=True,
+                      captions_model=None,
+                      caption_loader=None,
+                      enable_ocr=False,
+                      existing_files=[],
+                      existing_hash_ids={},
+                      parse_cache_dir=None,
+                      file_manifest=None,
+                      ):
+    """
+    Like path_to_docs, but yield list of documents of each file as soon as parsed
+    :param file_manifest: dict of file -> stat signature and hashid, see load_file_manifest,
+      so only files changed since last time are hashed, and updated in place with files parsed
+    """
     # path_or_paths could be str, list, tuple, generator
     globs_image_types = []
     globs_non_image_types = []
     if not path_or_paths and not url and not text:
-        return []
+        return
     elif url:
         globs_non_image_types = url if isinstance(url, (list, tuple, types.GeneratorType)) else [url]
     elif text:
@@ -1285,13 +2556,26 @@ def path_to_docs(path_or_paths, verbose=False, fail_any_exception=False, n_jobs=
         set_skip_files = set(existing_files)
         globs_image_types = [x for x in globs_image_types if x not in set_skip_files]
         globs_non_image_types = [x for x in globs_non_image_types if x not in set_skip_files]
+    signatures = {}
+    if file_manifest is not None and not url and not text:
+        # stat only, so unchanged files are not read
+        signatures = {x: get_file_signature(x) for x in globs_image_types + globs_non_image_types}
+
+    def get_hash(file):
+        hashid = get_manifest_hash(file_manifest, file, signatures.get(file)) if signatures else None
+        if hashid is None:
+            hashid = hash_file(file)
+            if signatures.get(file) is not None and hashid is not None:
+                file_manifest[file] = dict(signatures[file], hashid=hashid)
+        return hashid
+
     if existing_hash_ids:
         # assume consistent with add_meta() use of hash_file(file)
         # also assume consistent with get_existing_hash_ids for dict creation
         # assume hashable values
         existing_hash_ids_set = set(existing_hash_ids.items())
-        hash_ids_all_image = set({x: hash_file(x) for x in globs_image_types}.items())
-        hash_ids_all_non_image = set({x: hash_file(x) for x in globs_non_image_types}.items())
+        hash_ids_all_image = set({x: get_hash(x) for x in globs_image_types}.items())
+        hash_ids_all_non_image = set({x: get_hash(x) for x in globs_non_image_types}.items())
         # don't use symmetric diff.  If file is gone, ignore and don't remove or something
         #  just consider existing files (key) having new hash or not (value)
         new_files_image = set(dict(hash_ids_all_image - existing_hash_ids_set).keys())
@@ -1320,42 +2604,46 @@ def path_to_docs(path_or_paths, verbose=False, fail_any_exception=False, n_jobs=
                   captions_model=captions_model,
                   caption_loader=caption_loader,
                   enable_ocr=enable_ocr,
+                  parse_cache_dir=parse_cache_dir,
                   )
 
-    if n_jobs != 1 and len(globs_non_image_types) > 1:
-        # avoid nesting, e.g. upload 1 zip and then inside many files
-        # harder to handle if upload many zips with many files, inner parallel one will be disabled by joblib
-        documents = ProgressParallel(n_jobs=n_jobs, verbose=10 if verbose else 0, backend='multiprocessing')(
-            delayed(path_to_doc1)(file, **kwargs) for file in globs_non_image_types
-        )
-    else:
-        documents = [path_to_doc1(file, **kwargs) for file in tqdm(globs_non_image_types)]
-
     # do images separately since can't fork after cuda in parent, so can't be parallel
-    if n_jobs_image != 1 and len(globs_image_types) > 1:
-        # avoid nesting, e.g. upload 1 zip and then inside many files
-        # harder to handle if upload many zips with many files, inner parallel one will be disabled by joblib
-        image_documents = ProgressParallel(n_jobs=n_jobs, verbose=10 if verbose else 0, backend='multiprocessing')(
-            delayed(path_to_doc1)(file, **kwargs) for file in globs_image_types
-        )
-    else:
-        image_documents = [path_to_doc1(file, **kwargs) for file in tqdm(globs_image_types)]
+    for files, n_jobs1 in [(globs_non_image_types, n_jobs), (globs_image_types, n_jobs_image)]:
+        for fil in parallel_iter(path_to_doc1, files, n_jobs=n_jobs1, joblib_verbose=10 if verbose else 0,
+                                 **kwargs):
+            if return_file:
+                # then documents really are files
+                with open(fil, 'rb') as f:
+                    documents = pickle.load(f)
+                # remove temp pickle
+                os.remove(fil)
+            else:
+                documents = fil
+            if signatures:
+                # record hash found by parse, with stat from before parse so any change during parse is seen next time
+                for doc in documents:
+                    source, hashid = doc.metadata.get('source'), doc.metadata.get('hashid')
+                    if signatures.get(source) is not None and hashid not in ["None", None]:
+                        file_manifest[source] = dict(signatures[source], hashid=hashid)
+            yield documents
 
-    # add image docs in
-    documents += image_documents
 
-    if return_file:
-        # then documents really are files
-        files = documents.copy()
-        documents = []
-        for fil in files:
-            with open(fil, 'rb') as f:
-                documents.extend(pickle.load(f))
-            # remove temp pickle
-            os.remove(fil)
+def parallel_iter(func, items, n_jobs=-1, joblib_verbose=0, **kwargs):
+    """
+    Yield func(item, **kwargs) for each item in order, a few items per worker at a time with same workers,
+    so caller can consume results while rest run
+    """
+    if n_jobs != 1 and len(items) > 1:
+        # avoid nesting, e.g. upload 1 zip and then inside many files
+        # harder to handle if upload many zips with many files, inner parallel one will be disabled by joblib
+        from joblib import effective_n_jobs
+        num_per_call = 4 * max(1, effective_n_jobs(n_jobs))
+        with ProgressParallel(n_jobs=n_jobs, verbose=joblib_verbose, backend='multiprocessing') as parallel:
+            for i in range(0, len(items), num_per_call):
+                yield from parallel(delayed(func)(item, **kwargs) for item in items[i:i + num_per_call])
     else:
-        documents = reduce(concat, documents)
-    return documents
+        for item in tqdm(items):
+            yield func(item, **kwargs)
 
 
 def prep_langchain(persist_directory,
@@ -1369,17 +2657,17 @@ def prep_langchain(persist_directory,
     """
     assert langchain_mode not in ['MyData'], "Should not prep scratch data"
 
-    db_dir_exists = os.path.isdir(persist_directory)
+    db_exists = db_dir_exists(persist_directory)
 
-    if db_dir_exists and user_path is None:
+    if db_exists and user_path is None:
         print("Prep: persist_directory=%s exists, using" % persist_directory, flush=True)
         db = get_existing_db(None, persist_directory, load_db_if_exists, db_type, use_openai_embedding, langchain_mode,
                              hf_embedding_model)
     else:
-        if db_dir_exists and user_path is not None:
+        if db_exists and user_path is not None:
             print("Prep: persist_directory=%s exists, user_path=%s passed, adding any changed or new documents" % (
                 persist_directory, user_path), flush=True)
-        elif not db_dir_exists:
+        elif not db_exists:
             print("Prep: persist_directory=%s does not exist, regenerating" % persist_directory, flush=True)
         db = None
         if langchain_mode in ['All', 'DriverlessAI docs']:
@@ -1434,7 +2722,8 @@ def check_update_chroma_embedding(db, use_openai_embedding, hf_embedding_model,
                    for result in zip(db_get['documents'], db_get['metadatas'])]
         # delete index, has to be redone
         persist_directory = db._persist_directory
-        shutil.move(persist_directory, persist_directory + "_" + str(uuid.uuid4()) + ".bak")
+        invalidate_db_handle(db=db)
+        clear_db_dir(persist_directory, backup=True)
         db_type = 'chroma'
         load_db_if_exists = False
         db = get_db(sources, use_openai_embedding=use_openai_embedding, db_type=db_type,
@@ -1454,13 +2743,105 @@ def check_update_chroma_embedding(db, use_openai_embedding, hf_embedding_model,
     return db, changed_db
 
 
+# process-wide registry of open db handles, so each query does not rebuild chroma client, reload parquet, or embedding
+# keyed by (collection name, persist_directory), value is (db, (use_openai_embedding, hf_embedding_model))
+db_handles = {}
+db_handles_lock = threading.Lock()
+
+
+def get_db_handle_key(langchain_mode, persist_directory):
+    return langchain_mode.replace(' ', '_'), os.path.abspath(persist_directory)
+
+
+def get_db_handle(langchain_mode, persist_directory, use_openai_embedding, hf_embedding_model):
+    """
+    Get already-opened db for this collection, if embedding matches what was verified when registered
+    :return: db or None
+    """
+    key = get_db_handle_key(langchain_mode, persist_directory)
+    with db_handles_lock:
+        db, embed_info = db_handles.get(key, (None, None))
+    if db is not None and embed_info == (use_openai_embedding, hf_embedding_model):
+        return db
+    return None
+
+
+def set_db_handle(db, use_openai_embedding, hf_embedding_model):
+    """
+    Register (or replace) handle for db, e.g. after loading or after add_to_db changed collection
+    """
+    if db is None or not isinstance(db, (Chroma, FAISSMmap)):
+        return
+    if get_collection_name(db) == LangChainMode.MY_DATA.value:
+        # per-user scratch db is already held in gradio state, avoid registry growing with each session
+        return
+    key = get_db_handle_key(get_collection_name(db), db._persist_directory)
+    with db_handles_lock:
+        db_handles[key] = (db, (use_openai_embedding, hf_embedding_model))
+
+
+def drop_db_handles(embeddings):
+    """
+    Drop handles of dbs using any of embeddings, e.g. evicted from embedding pool
+    """
+    with db_handles_lock:
+        for key, (db, embed_info) in list(db_handles.items()):
+            embedding = getattr(db, '_embedding_function', None)
+            if any(getattr(embedding, '__self__', embedding) is x for x in embeddings):
+                db_handles.pop(key)
+
+
+def invalidate_db_handle(langchain_mode=None, persist_directory=None, db=None):
+    """
+    Drop handle so next access reloads from disk, e.g. if persist_directory removed or moved
+    """
+    if db is not None and isinstance(db, (Chroma, FAISSMmap)):
+        langchain_mode, persist_directory = get_collection_name(db), db._persist_directory
+    if langchain_mode is None or persist_directory is None:
+        return
+    key = get_db_handle_key(langchain_mode, persist_directory)
+    with db_handles_lock:
+        db_handles.pop(key, None)
+    drop_persist_db(persist_directory)
+
+
 def get_existing_db(db, persist_directory, load_db_if_exists, db_type, use_openai_embedding, langchain_mode,
                     hf_embedding_model, verbose=False, check_embedding=True):
+    if load_db_if_exists and db_type == 'faiss_mmap' and os.path.isfile(os.path.join(persist_directory, 'faiss_info')):
+        db_handle = get_db_handle(langchain_mode, persist_directory, use_openai_embedding, hf_embedding_model)
+        if db_handle is not None and (db is None or db is db_handle):
+            return db_handle
+        if db is None:
+            if verbose:
+                print("DO Loading db: %s" % langchain_mode, flush=True)
+            flush_persist_db(persist_directory)
+            embedding = get_embedding(use_openai_embedding, hf_embedding_model=hf_embedding_model)
+            db = FAISSMmap.load(embedding, persist_directory)
+        if check_embedding and load_embed(db) != (use_openai_embedding, hf_embedding_model):
+            print("Detected new embedding, updating db: %s" % langchain_mode, flush=True)
+            sources = list(db.docstore.documents())
+            invalidate_db_handle(db=db)
+            clear_db_dir(persist_directory, backup=True)
+            db = get_db(sources, use_openai_embedding=use_openai_embedding, db_type=db_type,
+                        persist_directory=persist_directory, load_db_if_exists=False, langchain_mode=langchain_mode,
+                        hf_embedding_model=hf_embedding_model, faiss_index_factory=db.index_factory)
+        save_embed(db, use_openai_embedding, hf_embedding_model)
+        if check_embedding:
+            set_db_handle(db, use_openai_embedding, hf_embedding_model)
+        return db
     if load_db_if_exists and db_type == 'chroma' and os.path.isdir(persist_directory) and os.path.isdir(
             os.path.join(persist_directory, 'index')):
+        db_handle = get_db_handle(langchain_mode, persist_directory, use_openai_embedding, hf_embedding_model)
+        if db_handle is not None and (db is None or db is db_handle):
+            # embedding already checked and saved when registered, avoid any disk access
+            if verbose:
+                print("USING cached db: %s" % langchain_mode, flush=True)
+            return db_handle
         if db is None:
             if verbose:
                 print("DO Loading db: %s" % langchain_mode, flush=True)
+            # new client reads from disk, so ensure any deferred additions are there
+            flush_persist_db(persist_directory)
             embedding = get_embedding(use_openai_embedding, hf_embedding_model=hf_embedding_model)
             from chromadb.config import Settings
             client_settings = Settings(anonymized_telemetry=False,
@@ -1484,6 +2865,8 @@ def get_existing_db(db, persist_directory, load_db_if_exists, db_type, use_opena
                     db.persist()
                     clear_embedding(db)
         save_embed(db, use_openai_embedding, hf_embedding_model)
+        if check_embedding:
+            set_db_handle(db, use_openai_embedding, hf_embedding_model)
         return db
     return None
 
@@ -1492,6 +2875,7 @@ def clear_embedding(db):
     if db is None:
         return
     # don't keep on GPU, wastes memory, push back onto CPU and only put back on GPU once again embed
+    # model stays resident in embedding_pool, sentence_transformers moves it back to target device on next encode
     db._embedding_function.client.cpu()
     clear_torch_cache()
 
@@ -1503,6 +2887,8 @@ def make_db(**langchain_kwargs):
     for k in missing_kwargs:
         if k in defaults_db:
             langchain_kwargs[k] = defaults_db[k]
+    # ingestion-only option from main, not passed along query path, so off there
+    langchain_kwargs.setdefault('parse_cache_dir', None)
     # final check for missing
     missing_kwargs = [x for x in func_names if x not in langchain_kwargs]
     assert not missing_kwargs, "Missing kwargs: %s" % missing_kwargs
@@ -1544,13 +2930,22 @@ def _make_db(use_openai_embedding=False,
              load_db_if_exists=True,
              db=None,
              n_jobs=-1,
+             parse_cache_dir=None,
              verbose=False):
+    """
+    :param parse_cache_dir: directory to cache parsed documents of user_path files in, None to not cache
+    """
     persist_directory = get_persist_directory(langchain_mode)
     # see if can get persistent chroma db
     db_trial = get_existing_db(db, persist_directory, load_db_if_exists, db_type, use_openai_embedding, langchain_mode,
                                hf_embedding_model, verbose=verbose)
     if db_trial is not None:
         db = db_trial
+    if lexical_index_enabled and isinstance(db, Chroma) and langchain_mode != LangChainMode.MY_DATA.value and \
+            os.path.abspath(db._persist_directory) not in lexical_indexes:
+        # e.g. db made before hybrid_search enabled, so build now instead of by query
+        with db_write_lock(langchain_mode, persist_directory):
+            get_lexical_index(db)
 
     sources = []
     if not db and langchain_mode not in ['MyData'] or \
@@ -1597,11 +2992,16 @@ def _make_db(use_openai_embedding=False,
             sources.extend(sources1)
         if langchain_mode in ['All', 'UserData']:
             if user_path:
+                # files seen last time, so unchanged ones are not read again and deleted ones are purged
+                file_manifest = load_file_manifest(persist_directory) if langchain_mode == 'UserData' else None
                 if db is not None:
-                    # NOTE: Ignore file names for now, only go by hash ids
-                    # existing_files = get_existing_files(db)
-                    existing_files = []
-                    existing_hash_ids = get_existing_hash_ids(db)
+                    with db_write_lock(langchain_mode, persist_directory):
+                        if file_manifest:
+                            purge_deleted_files(db, file_manifest, db_type=db_type, verbose=verbose)
+                        # NOTE: Ignore file names for now, only go by hash ids
+                        # existing_files = get_existing_files(db)
+                        existing_files = []
+                        existing_hash_ids = get_existing_hash_ids(db)
                 else:
                     # pretend no existing files so won't filter
                     existing_files = []
@@ -1609,8 +3009,25 @@ def _make_db(use_openai_embedding=False,
                 # chunk internally for speed over multiple docs
                 # FIXME: If first had old Hash=None and switch embeddings,
                 #  then re-embed, and then hit here and reload so have hash, and then re-embed.
+                if langchain_mode == 'UserData':
+                    # only source, so stream into db instead of holding all documents in memory
+                    db, num_new_sources, new_sources_metadata = \
+                        path_to_db(db, user_path, use_openai_embedding=use_openai_embedding, db_type=db_type,
+                                   persist_directory=persist_directory, langchain_mode=langchain_mode,
+                                   hf_embedding_model=hf_embedding_model, verbose=verbose,
+                                   n_jobs=n_jobs, chunk=chunk, chunk_size=chunk_size,
+                                   existing_files=existing_files, existing_hash_ids=existing_hash_ids,
+                                   parse_cache_dir=parse_cache_dir, file_manifest=file_manifest)
+                    if db is not None:
+                        save_file_manifest(persist_directory, file_manifest)
+                    print("Added %s new chunks from %s new files to UserData" %
+                          (num_new_sources, len(new_sources_metadata)), flush=True)
+                    if verbose:
+                        print("Files added: %s" % '\n'.join([x['source'] for x in new_sources_metadata]), flush=True)
+                    return db, num_new_sources, new_sources_metadata
                 sources1 = path_to_docs(user_path, n_jobs=n_jobs, chunk=chunk, chunk_size=chunk_size,
-                                        existing_files=existing_files, existing_hash_ids=existing_hash_ids)
+                                        existing_files=existing_files, existing_hash_ids=existing_hash_ids,
+                                        parse_cache_dir=parse_cache_dir)
                 new_metadata_sources = set([x.metadata['source'] for x in sources1])
                 if new_metadata_sources:
                     print("Loaded %s new files as sources to add to UserData" % len(new_metadata_sources), flush=True)
@@ -1642,9 +3059,10 @@ def _make_db(use_openai_embedding=False,
                 print("Adding to db", flush=True)
     if not db:
         if sources:
-            db = get_db(sources, use_openai_embedding=use_openai_embedding, db_type=db_type,
-                        persist_directory=persist_directory, langchain_mode=langchain_mode,
-                        hf_embedding_model=hf_embedding_model)
+            with db_write_lock(langchain_mode, persist_directory):
+                db = get_db(sources, use_openai_embedding=use_openai_embedding, db_type=db_type,
+                            persist_directory=persist_directory, langchain_mode=langchain_mode,
+                            hf_embedding_model=hf_embedding_model)
             if verbose:
                 print("Generated db", flush=True)
         else:
@@ -1652,9 +3070,10 @@ def _make_db(use_openai_embedding=False,
         new_sources_metadata = [x.metadata for x in sources]
     elif user_path is not None and langchain_mode in ['UserData']:
         print("Existing db, potentially adding %s sources from user_path=%s" % (len(sources), user_path), flush=True)
-        db, num_new_sources, new_sources_metadata = add_to_db(db, sources, db_type=db_type,
-                                                              use_openai_embedding=use_openai_embedding,
-                                                              hf_embedding_model=hf_embedding_model)
+        with db_write_lock(langchain_mode, persist_directory):
+            db, num_new_sources, new_sources_metadata = add_to_db(db, sources, db_type=db_type,
+                                                                  use_openai_embedding=use_openai_embedding,
+                                                                  hf_embedding_model=hf_embedding_model)
         print("Existing db, added %s new sources from user_path=%s" % (num_new_sources, user_path), flush=True)
     else:
         new_sources_metadata = [x.metadata for x in sources]
@@ -1664,7 +3083,9 @@ def _make_db(use_openai_embedding=False,
 
 def get_metadatas(db):
     from langchain.vectorstores import FAISS
-    if isinstance(db, FAISS):
+    if isinstance(db, FAISSMmap):
+        metadatas = list(db.docstore.metadatas())
+    elif isinstance(db, FAISS):
         metadatas = [v.metadata for k, v in db.docstore._dict.items()]
     elif isinstance(db, Chroma):
         metadatas = db.get()['metadatas']
@@ -1677,7 +3098,9 @@ def get_metadatas(db):
 
 def get_documents(db):
     from langchain.vectorstores import FAISS
-    if isinstance(db, FAISS):
+    if isinstance(db, FAISSMmap):
+        documents = list(db.docstore.documents())
+    elif isinstance(db, FAISS):
         documents = [v for k, v in db.docstore._dict.items()]
     elif isinstance(db, Chroma):
         documents = db.get()
@@ -1695,6 +3118,9 @@ def get_existing_files(db):
 
 
 def get_existing_hash_ids(db):
+    if isinstance(db, Chroma):
+        source_index = get_source_index(db)
+        return {source: hashid for source, hashid in source_index['id2meta'].values()}
     metadatas = get_metadatas(db)
     # assume consistency, that any prior hashed source was single hashed file at the time among all source chunks
     metadata_hash_ids = {x['source']: x.get('hashid') for x in metadatas}
@@ -1754,6 +3180,7 @@ def _run_qa_db(query=None,
                lora_weights='',
                auto_reduce_chunks=True,
                max_chunks=100,
+               hybrid_search=False,
                ):
     """
 
@@ -1891,6 +3318,133 @@ def _run_qa_db(query=None,
     return
 
 
+# token counters by tokenizer family, registered when first used by a query or before ingestion by
+# register_token_counter(), so later ingestion stores counts
+# Registered counters only hold tokenizers, never llm or embedding model, so those can be freed or replaced
+token_counters = {}
+# token counts of chunks that had no stored count, keyed by (family, sha of chunk text)
+token_counts_cache = OrderedDict()
+token_counts_cache_lock = threading.Lock()
+token_counts_cache_max = 100000
+
+
+def get_num_tokens_key(family):
+    return 'num_tokens_%s' % family
+
+
+def get_token_counter(llm, tokenizer, db, inference_server, use_openai_model, db_type, model_name):
+    """
+    Get tokenizer family name and batched token counting function, consistent with what limits the LLM context
+    :return: family, count_tokens(texts) -> list of number of tokens
+    """
+    register = True
+    if hasattr(llm, 'pipeline') and hasattr(llm.pipeline, 'tokenizer'):
+        # more accurate
+        family, count_tokens = get_hf_token_counter(llm.pipeline.tokenizer)
+    elif inference_server in ['openai', 'openai_chat'] or use_openai_model:
+        # same as llm.get_num_tokens(), but without holding llm
+        import tiktoken
+        try:
+            encoding = tiktoken.encoding_for_model(model_name)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+        family, count_tokens = get_tiktoken_counter(encoding)
+    elif db_type in ['faiss', 'weaviate']:
+        # use llm for faiss since embedding called differently,
+        # only for this query since counter holds llm
+        family = 'llm_%s' % model_name
+        count_tokens = lambda texts: [llm.get_num_tokens(x) for x in texts]
+        register = False
+    elif isinstance(tokenizer, FakeTokenizer):
+        family, count_tokens = get_tiktoken_counter(tokenizer.encoding)
+    else:
+        # in case model is not our pipeline with HF tokenizer
+        family, count_tokens = get_embedding_token_counter(db._embedding_function)
+    if register:
+        token_counters.setdefault(family, count_tokens)
+    return family, count_tokens
+
+
+def get_hf_token_counter(tokenizer1):
+    family = 'hf_%s' % tokenizer1.name_or_path
+    count_tokens = lambda texts: [len(x) for x in tokenizer1(texts)['input_ids']]
+    return family, count_tokens
+
+
+def get_tiktoken_counter(encoding):
+    family = 'tiktoken_%s' % encoding.name
+    count_tokens = lambda texts: [len(x) for x in encoding.encode_batch(texts, disallowed_special=())]
+    return family, count_tokens
+
+
+def get_embedding_token_counter(embedding):
+    """
+    Count tokens like embedding model's client.tokenize(), truncated to its max_seq_length,
+    but only hold its HF tokenizer, so embedding model can be evicted
+    """
+    family = 'embedding_%s' % embedding.model_name
+    tokenizer1 = embedding.client.tokenizer
+    max_seq_length = embedding.client.max_seq_length
+    count_tokens = lambda texts: [len(x) for x in
+                                  tokenizer1(texts, truncation=True, max_length=max_seq_length)['input_ids']]
+    return family, count_tokens
+
+
+def register_token_counter(tokenizer_base_model):
+    """
+    Register HF tokenizer before ingestion, e.g. offline by make_db.py, so new chunks store token counts
+    for same family as queries with HF pipeline of that tokenizer use
+    """
+    from transformers import AutoTokenizer
+    family, count_tokens = get_hf_token_counter(AutoTokenizer.from_pretrained(tokenizer_base_model))
+    token_counters.setdefault(family, count_tokens)
+    return family, count_tokens
+
+
+def get_num_tokens_docs(docs, family, count_tokens):
+    """
+    Get number of tokens for each doc, from metadata if stored, else from cache, else one batched count
+    Counted docs get count put into metadata, so if docs are then added to db count is stored
+    """
+    key = get_num_tokens_key(family)
+    tokens = [doc.metadata.get(key) for doc in docs]
+    missing = []
+    with token_counts_cache_lock:
+        for doci, doc in enumerate(docs):
+            if tokens[doci] is not None:
+                continue
+            cache_key = (family, get_sha(doc.page_content))
+            if cache_key in token_counts_cache:
+                token_counts_cache.move_to_end(cache_key)
+                tokens[doci] = token_counts_cache[cache_key]
+            else:
+                missing.append(doci)
+    if missing:
+        counts = count_tokens([docs[doci].page_content for doci in missing])
+        with token_counts_cache_lock:
+            for doci, count in zip(missing, counts):
+                count = int(count)
+                tokens[doci] = count
+                token_counts_cache[(family, get_sha(docs[doci].page_content))] = count
+            while len(token_counts_cache) > token_counts_cache_max:
+                token_counts_cache.popitem(last=False)
+    for doc, count in zip(docs, tokens):
+        doc.metadata[key] = int(count)
+    return [int(x) for x in tokens]
+
+
+def add_num_tokens(sources):
+    """
+    Store token counts in metadata of new chunks for each tokenizer family used so far, so queries need not count
+    """
+    for family, count_tokens in list(token_counters.items()):
+        try:
+            get_num_tokens_docs(sources, family, count_tokens)
+        except BaseException as e:
+            print("Failed to count tokens for %s: %s" % (family, str(e)), flush=True)
+
+
+@track_retrieval
 def get_similarity_chain(query=None,
                          use_openai_model=False, use_openai_embedding=False,
                          first_para=False, text_limit=None, top_k_docs=4, chunk=True, chunk_size=512,
@@ -1918,6 +3472,7 @@ def get_similarity_chain(query=None,
                          # local
                          auto_reduce_chunks=True,
                          max_chunks=100,
+                         hybrid_search=False,
                          ):
     # determine whether use of context out of docs is planned
     if not use_openai_model and prompt_type not in ['plain'] or model_name in non_hf_types:
@@ -1937,6 +3492,9 @@ def get_similarity_chain(query=None,
     else:
         # top_k_docs=100 works ok too
         k_db = 1000 if db_type == 'chroma' else top_k_docs
+    if hybrid_search and db_type == 'chroma':
+        # fused ranking already has best chunks first, so no need to over-fetch
+        k_db = 100 if top_k_docs == -1 or auto_reduce_chunks else max(top_k_docs, 20)
 
     # FIXME: For All just go over all dbs instead of a separate db for All
     if not detect_user_path_changes_every_query and db is not None:
@@ -2001,48 +3559,55 @@ def get_similarity_chain(query=None,
             scores = []
         elif cmd == DocumentChoices.Only_All_Sources.name:
             from langchain.vectorstores import FAISS
-            if isinstance(db, Chroma):
-                db_get = db._collection.get(where=filter_kwargs.get('filter'))
-                db_metadatas = db_get['metadatas']
-                db_documents = db_get['documents']
-            elif isinstance(db, FAISS):
-                import itertools
-                db_metadatas = get_metadatas(db)
-                # FIXME: FAISS has no filter
-                # slice dict first
-                db_documents = list(dict(itertools.islice(db.docstore._dict.items(), top_k_docs)).values())
-            else:
-                db_metadatas = get_metadatas(db)
-                db_documents = get_documents(db)
+            with db_read_lock(db, langchain_mode):
+                if isinstance(db, Chroma):
+                    db_get = db._collection.get(where=filter_kwargs.get('filter'))
+                    db_metadatas = db_get['metadatas']
+                    db_documents = db_get['documents']
+                elif isinstance(db, FAISSMmap):
+                    num_docs = len(db.docstore) if top_k_docs == -1 else min(top_k_docs, len(db.docstore))
+                    docs1 = [db.docstore.get_document(x) for x in range(num_docs)]
+                    db_metadatas = [x.metadata for x in docs1]
+                    db_documents = [x.page_content for x in docs1]
+                elif isinstance(db, FAISS):
+                    import itertools
+                    db_metadatas = get_metadatas(db)
+                    # FIXME: FAISS has no filter
+                    # slice dict first
+                    db_documents = list(dict(itertools.islice(db.docstore._dict.items(), top_k_docs)).values())
+                else:
+                    db_metadatas = get_metadatas(db)
+                    db_documents = get_documents(db)
             # similar to langchain's chroma's _results_to_docs_and_scores
             docs_with_score = [(Document(page_content=result[0], metadata=result[1] or {}), 0)
                                for result in zip(db_documents, db_metadatas)][:top_k_docs]
             docs = [x[0] for x in docs_with_score]
             scores = [x[1] for x in docs_with_score]
         else:
+            # chunks found by keyword are kept even if far by embedding
+            lexical_docs = set()
             if top_k_docs == -1 or auto_reduce_chunks:
                 # docs_with_score = db.similarity_search_with_score(query, k=k_db, **filter_kwargs)[:top_k_docs]
                 top_k_docs_tokenize = 100
-                with filelock.FileLock("sim.lock"):
-                    docs_with_score = db.similarity_search_with_score(query, k=k_db, **filter_kwargs)[
-                                      :top_k_docs_tokenize]
-                if hasattr(llm, 'pipeline') and hasattr(llm.pipeline, 'tokenizer'):
-                    # more accurate
-                    tokens = [len(llm.pipeline.tokenizer(x[0].page_content)['input_ids']) for x in docs_with_score]
-                    template_tokens = len(llm.pipeline.tokenizer(template)['input_ids'])
-                elif inference_server in ['openai', 'openai_chat'] or use_openai_model or db_type in ['faiss',
-                                                                                                      'weaviate']:
-                    # use ticktoken for faiss since embedding called differently
-                    tokens = [llm.get_num_tokens(x[0].page_content) for x in docs_with_score]
-                    template_tokens = llm.get_num_tokens(template)
-                elif isinstance(tokenizer, FakeTokenizer):
-                    tokens = [tokenizer.num_tokens_from_string(x[0].page_content) for x in docs_with_score]
-                    template_tokens = tokenizer.num_tokens_from_string(template)
-                else:
-                    # in case model is not our pipeline with HF tokenizer
-                    tokens = [db._embedding_function.client.tokenize([x[0].page_content])['input_ids'].shape[1] for x in
-                              docs_with_score]
-                    template_tokens = db._embedding_function.client.tokenize([template])['input_ids'].shape[1]
+                with db_read_lock(db, langchain_mode), embedding_user(db._embedding_function):
+                    if hybrid_search and isinstance(db, Chroma):
+                        docs_with_score, lexical_docs = hybrid_search_with_score(db, query, k=k_db,
+                                                                                 filter=filter_kwargs.get('filter'),
+                                                                                 sources=document_choice)
+                    else:
+                        docs_with_score = db.similarity_search_with_score(query, k=k_db, **filter_kwargs)
+                    docs_with_score = docs_with_score[:top_k_docs_tokenize]
+                # copies, since counts are put into metadata and in-memory dbs like faiss return their own documents
+                docs_with_score_copy = [(Document(page_content=x.page_content, metadata=x.metadata.copy()), score)
+                                        for x, score in docs_with_score]
+                lexical_docs = {id(y[0]) for x, y in zip(docs_with_score, docs_with_score_copy)
+                                if id(x[0]) in lexical_docs}
+                docs_with_score = docs_with_score_copy
+                family, count_tokens = get_token_counter(llm, tokenizer, db, inference_server, use_openai_model,
+                                                         db_type, model_name)
+                # use counts stored in chunk metadata at ingestion, batch count any remaining
+                tokens = get_num_tokens_docs([x[0] for x in docs_with_score], family, count_tokens)
+                template_tokens = count_tokens([template])[0]
                 tokens_cumsum = np.cumsum(tokens)
                 if hasattr(llm, 'pipeline') and hasattr(llm.pipeline, 'max_input_tokens'):
                     max_input_tokens = llm.pipeline.max_input_tokens
@@ -2078,16 +3643,24 @@ def get_similarity_chain(query=None,
                     print("Unexpected large chunks and can't add to context, will add 1 anyways", flush=True)
                     top_k_docs = 1
                 docs_with_score = docs_with_score[:top_k_docs]
+            elif hybrid_search and isinstance(db, Chroma):
+                with db_read_lock(db, langchain_mode), embedding_user(db._embedding_function):
+                    docs_with_score, lexical_docs = hybrid_search_with_score(db, query, k=k_db,
+                                                                             filter=filter_kwargs.get('filter'),
+                                                                             sources=document_choice)
+                docs_with_score = docs_with_score[:top_k_docs]
             else:
-                docs_with_score = db.similarity_search_with_score(query, k=k_db, **filter_kwargs)[:top_k_docs]
+                with db_read_lock(db, langchain_mode), embedding_user(db._embedding_function):
+                    docs_with_score = db.similarity_search_with_score(query, k=k_db, **filter_kwargs)[:top_k_docs]
             # put most relevant chunks closest to question,
             # esp. if truncation occurs will be "oldest" or "farthest from response" text that is truncated
             # BUT: for small models, e.g. 6_9 pythia, if sees some stuff related to h2oGPT first, it can connect that and not listen to rest
             if reverse_docs:
                 docs_with_score.reverse()
             # cut off so no high distance docs/sources considered
-            docs = [x[0] for x in docs_with_score if x[1] < cut_distanct]
-            scores = [x[1] for x in docs_with_score if x[1] < cut_distanct]
+            docs_with_score = [x for x in docs_with_score if x[1] < cut_distanct or id(x[0]) in lexical_docs]
+            docs = [x[0] for x in docs_with_score]
+            scores = [x[1] for x in docs_with_score]
             if len(scores) > 0 and verbose:
                 print("Distance: min: %s max: %s mean: %s median: %s" %
                       (scores[0], scores[-1], np.mean(scores), np.median(scores)), flush=True)
@@ -55,12 +55,14 @@ from gradio_themes import H2oTheme, SoftTheme, get_h2o_title, get_simple_title,
 from prompter import prompt_type_to_model_name, prompt_types_strings, inv_prompt_type_to_model_lower, non_hf_types, \
     get_prompt
 from utils import get_githash, flatten_list, zip_data, s3up, clear_torch_cache, get_torch_allocated, system_info_print, \
-    ping, get_short_name, get_url, makedirs, get_kwargs, remove, system_info, ping_gpu
-from generate import get_model, languages_covered, evaluate, eval_func_param_names, score_qa, langchain_modes, \
+    ping, get_short_name, get_url, makedirs, get_kwargs, remove, system_info, ping_gpu, lazy_import
+from utils_metrics import track_event, register_gradio_queue, startup_phase, record_startup_phase, \
+    print_startup_phases
+from generate import get_model, languages_covered, evaluate, eval_func_param_names, langchain_modes, \
     inputs_kwargs_list, scratch_base_dir, evaluate_from_str, no_default_param_names, \
     eval_func_param_names_defaults, get_max_max_new_tokens, get_minmax_top_k_docs, history_to_context
 
-from apscheduler.schedulers.background import BackgroundScheduler
+apscheduler_background = lazy_import('apscheduler.schedulers.background')
 
 
 def fix_text_for_gradio(text, fix_new_lines=False, fix_latex_dollars=True):
@@ -87,6 +89,7 @@ def fix_text_for_gradio(text, fix_new_lines=False, fix_latex_dollars=True):
 
 
 def go_gradio(**kwargs):
+    t0 = time.time()
     allow_api = kwargs['allow_api']
     is_public = kwargs['is_public']
     is_hf = kwargs['is_hf']
@@ -109,6 +112,7 @@ def go_gradio(**kwargs):
     enable_captions = kwargs['enable_captions']
     captions_model = kwargs['captions_model']
     enable_ocr = kwargs['enable_ocr']
+    parse_cache_dir = kwargs['parse_cache_dir']
     caption_loader = kwargs['caption_loader']
 
     # easy update of kwargs needed for evaluate() etc.
@@ -724,6 +728,7 @@ def go_gradio(**kwargs):
                                                 captions_model=captions_model,
                                                 enable_ocr=enable_ocr,
                                                 caption_loader=caption_loader,
+                                                parse_cache_dir=parse_cache_dir,
                                                 verbose=kwargs['verbose'],
                                                 user_path=kwargs['user_path'],
                                                 )
@@ -802,6 +807,7 @@ def go_gradio(**kwargs):
                                               captions_model=captions_model,
                                               enable_ocr=enable_ocr,
                                               caption_loader=caption_loader,
+                                              parse_cache_dir=parse_cache_dir,
                                               verbose=kwargs['verbose'],
                                               user_path=kwargs['user_path'],
                                               )
@@ -920,6 +926,7 @@ def go_gradio(**kwargs):
         for k in inputs_kwargs_list:
             assert k in kwargs_evaluate, "Missing %s" % k
 
+        @track_event('submit_nochat')
         def evaluate_gradio(*args1, **kwargs1):
             for res_dict in evaluate(*args1, **kwargs1):
                 if kwargs['langchain_mode'] == 'Disabled':
@@ -974,38 +981,30 @@ def go_gradio(**kwargs):
                     # then lock way
                     args_list = list(args).copy()
                     outputs = args_list[-num_model_lock:]
-                    score_texts1 = []
+                    args_lists = []
                     for output in outputs:
-                        # same input, put into form good for _score_last_response()
+                        # same input, put into form good for _score_last_responses()
                         args_list[-1] = output
-                        score_texts1.append(
-                            _score_last_response(*tuple(args_list), nochat=nochat,
-                                                 num_model_lock=num_model_lock, prefix=''))
+                        args_lists.append(args_list.copy())
+                    # all models scored together in same batch
+                    score_texts1 = _score_last_responses(args_lists, nochat=nochat, prefix='')
                     if len(score_texts1) > 1:
                         return "Response Scores: %s" % ' '.join(score_texts1)
                     else:
                         return "Response Scores: %s" % score_texts1[0]
                 else:
-                    return _score_last_response(*args, nochat=nochat, num_model_lock=num_model_lock)
+                    return _score_last_responses([list(args)], nochat=nochat)[0]
             finally:
                 clear_torch_cache()
 
-        def _score_last_response(*args, nochat=False, num_model_lock=0, prefix='Response Score: '):
-            """ Similar to user() """
-            args_list = list(args)
+        def _get_score_qa(args_list, nochat=False):
+            """ Similar to user()
+            :return: question, answer, and None, or None, None, and text to show instead of score
+            """
             smodel = score_model_state0['model']
             stokenizer = score_model_state0['tokenizer']
             sdevice = score_model_state0['device']
 
-            if memory_restriction_level > 0:
-                max_length_tokenize = 768 - 256 if memory_restriction_level <= 2 else 512 - 256
-            elif hasattr(stokenizer, 'model_max_length'):
-                max_length_tokenize = stokenizer.model_max_length
-            else:
-                # limit to 1024, not worth OOMing on reward score
-                max_length_tokenize = 2048 - 1024
-            cutoff_len = max_length_tokenize * 4  # restrict deberta related to max for LLM
-
             if not nochat:
                 history = args_list[-1]
                 if history is None:
@@ -1022,23 +1021,47 @@ def go_gradio(**kwargs):
 
                     answer = history[-1][1]
                 else:
-                    return '%sNA' % prefix
+                    return None, None, 'NA'
             else:
                 answer = args_list[-1]
                 instruction_nochat_arg_id = eval_func_param_names.index('instruction_nochat')
                 question = args_list[instruction_nochat_arg_id]
 
             if question is None:
-                return '%sBad Question' % prefix
+                return None, None, 'Bad Question'
             if answer is None:
-                return '%sBad Answer' % prefix
-            try:
-                score = score_qa(smodel, stokenizer, max_length_tokenize, question, answer, cutoff_len)
-            finally:
-                clear_torch_cache()
-            if isinstance(score, str):
-                return '%sNA' % prefix
-            return '{}{:.1%}'.format(prefix, score)
+                return None, None, 'Bad Answer'
+            return question, answer, None
+
+        def _score_last_responses(args_lists, nochat=False, prefix='Response Score: '):
+            smodel = score_model_state0['model']
+            stokenizer = score_model_state0['tokenizer']
+
+            if memory_restriction_level > 0:
+                max_length_tokenize = 768 - 256 if memory_restriction_level <= 2 else 512 - 256
+            elif hasattr(stokenizer, 'model_max_length'):
+                max_length_tokenize = stokenizer.model_max_length
+            else:
+                # limit to 1024, not worth OOMing on reward score
+                max_length_tokenize = 2048 - 1024
+            cutoff_len = max_length_tokenize * 4  # restrict deberta related to max for LLM
+
+            score_qas = [_get_score_qa(args_list, nochat=nochat) for args_list in args_lists]
+            score_texts = ['%s%s' % (prefix, text) if text is not None else None for _, _, text in score_qas]
+            todo = [i for i, (_, _, text) in enumerate(score_qas) if text is None]
+            if not todo:
+                return score_texts
+            # batched with any other concurrent scoring for same score model
+            from batching import get_score_scheduler
+            futures = get_score_scheduler(smodel, stokenizer).submit([score_qas[i][:2] for i in todo],
+                                                                     max_length_tokenize, cutoff_len)
+            for i, future in zip(todo, futures):
+                score = future.result()
+                if isinstance(score, str):
+                    score_texts[i] = '%sNA' % prefix
+                else:
+                    score_texts[i] = '{}{:.1%}'.format(prefix, score)
+            return score_texts
 
         def noop_score_last_response(*args, **kwargs):
             return "Response Score: Disabled"
@@ -1135,13 +1158,17 @@ def go_gradio(**kwargs):
             else:
                 return history_list[0]
 
-        def get_model_max_length(model_state1):
+        def get_model_tokenizer(model_state1):
             if model_state1 and not isinstance(model_state1["tokenizer"], str):
                 tokenizer = model_state1["tokenizer"]
             elif model_state0 and not isinstance(model_state0["tokenizer"], str):
                 tokenizer = model_state0["tokenizer"]
             else:
                 tokenizer = None
+            return tokenizer
+
+        def get_model_max_length(model_state1):
+            tokenizer = get_model_tokenizer(model_state1)
             if tokenizer is not None:
                 return tokenizer.model_max_length
             else:
@@ -1194,9 +1221,10 @@ def go_gradio(**kwargs):
 
             chat1 = args_list[eval_func_param_names.index('chat')]
             model_max_length1 = get_model_max_length(model_state1)
+            tokenizer1 = get_model_tokenizer(model_state1)
             context1 = history_to_context(history, langchain_mode1, prompt_type1, prompt_dict1, chat1,
                                           model_max_length1, memory_restriction_level,
-                                          kwargs['keep_sources_in_context'])
+                                          kwargs['keep_sources_in_context'], tokenizer1=tokenizer1)
             args_list[0] = instruction1  # override original instruction with history from user
             args_list[2] = context1
 
@@ -1250,7 +1278,7 @@ def go_gradio(**kwargs):
 
         def clear_embeddings(langchain_mode1, my_db):
             # clear any use of embedding that sits on GPU, else keeps accumulating GPU usage even if clear torch cache
-            if db_type == 'chroma' and langchain_mode1 not in ['ChatLLM', 'LLM', 'Disabled', None, '']:
+            if db_type in ['chroma', 'faiss_mmap'] and langchain_mode1 not in ['ChatLLM', 'LLM', 'Disabled', None, '']:
                 from gpt_langchain import clear_embedding
                 db = dbs.get('langchain_mode1')
                 if db is not None and not isinstance(db, str):
@@ -1258,6 +1286,7 @@ def go_gradio(**kwargs):
                 if langchain_mode1 == LangChainMode.MY_DATA.value and my_db is not None:
                     clear_embedding(my_db[0])
 
+        @track_event('bot')
         def bot(*args, retry=False):
             history, fun1, langchain_mode1, my_db_state1 = prep_bot(*args, retry=retry)
             try:
@@ -1266,6 +1295,7 @@ def go_gradio(**kwargs):
             finally:
                 clear_embeddings(langchain_mode1, my_db_state1)
 
+        @track_event('all_bot')
         def all_bot(*args, retry=False, model_states1=None):
             args_list = list(args).copy()
             chatbots = args_list[-len(model_states1):]
@@ -2021,7 +2051,8 @@ def go_gradio(**kwargs):
                 model_max_length1 = tokenizer.model_max_length
                 context1 = history_to_context(chat1, langchain_mode1, prompt_type1, prompt_dict1, chat1,
                                               model_max_length1,
-                                              memory_restriction_level1, keep_sources_in_context1)
+                                              memory_restriction_level1, keep_sources_in_context1,
+                                              tokenizer1=tokenizer)
                 return str(tokenizer(context1, return_tensors="pt")['input_ids'].shape[1])
             else:
                 return "N/A"
@@ -2036,9 +2067,10 @@ def go_gradio(**kwargs):
         demo.load(None, None, None, _js=get_dark_js() if kwargs['h2ocolors'] and False else None)  # light best
 
     demo.queue(concurrency_count=kwargs['concurrency_count'], api_open=kwargs['api_open'])
+    register_gradio_queue(demo)
     favicon_path = "h2o-logo.svg"
 
-    scheduler = BackgroundScheduler()
+    scheduler = apscheduler_background.BackgroundScheduler()
     scheduler.add_job(func=clear_torch_cache, trigger="interval", seconds=20)
     if is_public and \
             kwargs['base_model'] not in non_hf_types:
@@ -2055,9 +2087,12 @@ def go_gradio(**kwargs):
         assert 'gpt_langchain' not in sys.modules, "Dev bug, import of langchain when should not have"
         assert 'langchain' not in sys.modules, "Dev bug, import of langchain when should not have"
 
-    demo.launch(share=kwargs['share'], server_name="0.0.0.0", show_error=True,
-                favicon_path=favicon_path, prevent_thread_lock=True,
-                auth=kwargs['auth'])
+    record_startup_phase('gradio build', t0)
+    with startup_phase('gradio launch'):
+        demo.launch(share=kwargs['share'], server_name="0.0.0.0", show_error=True,
+                    favicon_path=favicon_path, prevent_thread_lock=True,
+                    auth=kwargs['auth'])
+    print_startup_phases(kwargs['startup_time'])
     if kwargs['verbose']:
         print("Started GUI", flush=True)
     if kwargs['block_gradio_exit']:
@@ -2109,14 +2144,16 @@ def get_sources(db1, langchain_mode, dbs=None, docs_state0=None):
                              "  Ask jon.mckinney@h2o.ai for file if required."
         source_list = []
     elif langchain_mode == 'MyData' and len(db1) > 0 and db1[0] is not None:
-        from gpt_langchain import get_metadatas
-        metadatas = get_metadatas(db1[0])
+        from gpt_langchain import get_metadatas, db_read_lock
+        with db_read_lock(db1[0], langchain_mode):
+            metadatas = get_metadatas(db1[0])
         source_list = sorted(set([x['source'] for x in metadatas]))
         source_files_added = '\n'.join(source_list)
     elif langchain_mode in dbs and dbs[langchain_mode] is not None:
-        from gpt_langchain import get_metadatas
+        from gpt_langchain import get_metadatas, db_read_lock
         db1 = dbs[langchain_mode]
-        metadatas = get_metadatas(db1)
+        with db_read_lock(db1, langchain_mode):
+            metadatas = get_metadatas(db1)
         source_list = sorted(set([x['source'] for x in metadatas]))
         source_files_added = '\n'.join(source_list)
     else:
@@ -2131,6 +2168,7 @@ def get_sources(db1, langchain_mode, dbs=None, docs_state0=None):
     return sources_file, source_list
 
 
+@track_event('add_docs')
 def update_user_db(file, db1, x, y, *args, dbs=None, langchain_mode='UserData', **kwargs):
     try:
         return _update_user_db(file, db1, x, y, *args, dbs=dbs, langchain_mode=langchain_mode, **kwargs)
@@ -2166,6 +2204,7 @@ def _update_user_db(file, db1, x, y, chunk, chunk_size, dbs=None, db_type=None,
                     enable_captions=None,
                     captions_model=None,
                     enable_ocr=None,
+                    parse_cache_dir=None,
                     verbose=None,
                     is_url=None, is_txt=None):
     assert use_openai_embedding is not None
@@ -2215,11 +2254,28 @@ def _update_user_db(file, db1, x, y, chunk, chunk_size, dbs=None, db_type=None,
                            captions_model=captions_model,
                            enable_ocr=enable_ocr,
                            caption_loader=caption_loader,
+                           parse_cache_dir=parse_cache_dir,
                            )
     exceptions = [x for x in sources if x.metadata.get('exception')]
     sources = [x for x in sources if 'exception' not in x.metadata]
 
-    with filelock.FileLock("db_%s.lock" % langchain_mode.replace(' ', '_')):
+    from gpt_langchain import db_write_lock, get_persist_directory
+    if langchain_mode == 'MyData':
+        if db1[0] is not None:
+            persist_directory = getattr(db1[0], '_persist_directory', None)
+        else:
+            # in testing expect:
+            # assert len(db1) == 2 and db1[1] is None, "Bad MyData db: %s" % db1
+            # for production hit, when user gets clicky:
+            assert len(db1) == 2, "Bad MyData db: %s" % db1
+            # assign fresh hash for this user session, so not shared
+            # if added has to original state and didn't change, then would be shared db for all users
+            db1[1] = str(uuid.uuid4())
+            persist_directory = os.path.join(scratch_base_dir, 'db_dir_%s_%s' % (langchain_mode, db1[1]))
+    else:
+        persist_directory = get_persist_directory(langchain_mode)
+    # file lock across processes, write lock blocks this db's similarity searches only while adding
+    with db_write_lock(langchain_mode, persist_directory):
         if langchain_mode == 'MyData':
             if db1[0] is not None:
                 # then add
@@ -2227,15 +2283,7 @@ def _update_user_db(file, db1, x, y, chunk, chunk_size, dbs=None, db_type=None,
                                                                       use_openai_embedding=use_openai_embedding,
                                                                       hf_embedding_model=hf_embedding_model)
             else:
-                # in testing expect:
-                # assert len(db1) == 2 and db1[1] is None, "Bad MyData db: %s" % db1
-                # for production hit, when user gets clicky:
-                assert len(db1) == 2, "Bad MyData db: %s" % db1
                 # then create
-                # assign fresh hash for this user session, so not shared
-                # if added has to original state and didn't change, then would be shared db for all users
-                db1[1] = str(uuid.uuid4())
-                persist_directory = os.path.join(scratch_base_dir, 'db_dir_%s_%s' % (langchain_mode, db1[1]))
                 db = get_db(sources, use_openai_embedding=use_openai_embedding,
                             db_type=db_type,
                             persist_directory=persist_directory,
@@ -2248,8 +2296,6 @@ def _update_user_db(file, db1, x, y, chunk, chunk_size, dbs=None, db_type=None,
             source_files_added = get_source_files(db=db1[0], exceptions=exceptions)
             return None, langchain_mode, db1, x, y, source_files_added
         else:
-            from gpt_langchain import get_persist_directory
-            persist_directory = get_persist_directory(langchain_mode)
             if langchain_mode in dbs and dbs[langchain_mode] is not None:
                 # then add
                 db, num_new_sources, new_sources_metadata = add_to_db(dbs[langchain_mode], sources, db_type=db_type,
@@ -2288,7 +2334,9 @@ def get_source_files_given_langchain_mode(db1, langchain_mode='UserData', dbs=No
     db = get_db(db1, langchain_mode, dbs=dbs)
     if langchain_mode in ['ChatLLM', 'LLM'] or db is None:
         return "Sources: N/A"
-    return get_source_files(db=db, exceptions=None)
+    from gpt_langchain import db_read_lock
+    with db_read_lock(db, langchain_mode):
+        return get_source_files(db=db, exceptions=None)
 
 
 def get_source_files(db=None, exceptions=None, metadatas=None):
@@ -1,9 +1,48 @@
 from typing import Any
+import concurrent.futures
+import json
 import os
+import threading
+import time
 
 os.environ['HF_HUB_DISABLE_TELEMETRY'] = '1'
 
+import gradio_client
+import requests
 from gradio_client import Client
+from gradio_client.client import Endpoint
+
+from gradio_utils.stream_queue import StreamQueue
+
+# gradio_client versions, as pinned in requirements.txt, whose private parts are used:
+# Endpoint and _get_config() to rebuild endpoints and send plain HTTP calls through one requests.Session,
+# and Communicator.prediction_processor and lock to stream outputs as they arrive.
+# Other versions only use public API: no refresh of endpoints, own HTTP connections, and job iteration to stream
+private_api_versions = ('0.2.',)
+
+
+def can_use_private_api():
+    return gradio_client.__version__.startswith(private_api_versions)
+
+
+class SessionEndpoint(Endpoint):
+    """
+    Endpoint whose calls without gradio queue go through client's requests.Session, so connection is reused
+    """
+
+    def make_predict(self, helper=None):
+        if self.use_ws:
+            return super().make_predict(helper)
+
+        def _predict(*data) -> tuple:
+            data = json.dumps(dict(data=data, fn_index=self.fn_index, session_hash=self.client.session_hash))
+            response = self.client.session.post(self.client.api_url, headers=self.client.headers, data=data)
+            result = json.loads(response.content.decode("utf-8"))
+            if "data" not in result:
+                raise ValueError(result.get("error", result))
+            return tuple(result["data"])
+
+        return _predict
 
 
 class GradioClient(Client):
@@ -12,31 +51,73 @@ class GradioClient(Client):
     To handle automatically refreshing client if detect gradio server changed
     """
 
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, check_hash_interval: float = None, **kwargs):
+        """
+        :param check_hash_interval: seconds between checks of server hash, 0 checks before every call,
+               None uses env GRADIO_CLIENT_CHECK_HASH_INTERVAL or 60.
+               Hash is also checked (and call retried once) if api_name or fn_index is not found before call is
+               submitted, e.g. if server restarted with new code.  Calls that fail once submitted are not retried
+        """
         super().__init__(*args, **kwargs)
+        self.session = requests.Session()
+        if can_use_private_api():
+            self.endpoints = [SessionEndpoint(self, fn_index, dependency)
+                              for fn_index, dependency in enumerate(self.config["dependencies"])]
+        if check_hash_interval is None:
+            check_hash_interval = float(os.getenv('GRADIO_CLIENT_CHECK_HASH_INTERVAL', '60'))
+        self.check_hash_interval = check_hash_interval
+        self.hash_lock = threading.Lock()
         self.server_hash = self.get_server_hash()
+        self.last_hash_check = time.time()
 
     def get_server_hash(self):
         """
         Get server hash using super without any refresh action triggered
         Returns: git hash of gradio server
         """
-        return super().predict(api_name='/system_hash')
+        return super().submit(api_name='/system_hash').result()
 
-    def refresh_client(self):
+    def refresh_client(self, force=False):
         """
-        Ensure every client call is independent
-        Also ensure map between api_name and fn_index is updated in case server changed (e.g. restarted with new code)
-        Returns:
+        Ensure map between api_name and fn_index is updated in case server changed (e.g. restarted with new code)
+        Server hash is only checked every check_hash_interval seconds unless forced, so calls don't pay extra round-trip
+        Returns: True if server changed and client was refreshed
         """
-
-        self.reset_session()
-
-        # get current hash in order to update api_name -> fn_index map in case gradio server changed
-        server_hash = self.get_server_hash()
-        if self.server_hash != server_hash:
-            self._get_config()
+        if not can_use_private_api():
+            return False
+        if not force and time.time() - self.last_hash_check < self.check_hash_interval:
+            return False
+        with self.hash_lock:
+            # another thread may have just checked
+            if not force and time.time() - self.last_hash_check < self.check_hash_interval:
+                return False
+            # get current hash in order to update api_name -> fn_index map in case gradio server changed
+            server_hash = self.get_server_hash()
+            self.last_hash_check = time.time()
+            if self.server_hash == server_hash:
+                return False
+            self.config = self._get_config()
+            self.endpoints = [SessionEndpoint(self, fn_index, dependency)
+                              for fn_index, dependency in enumerate(self.config["dependencies"])]
             self.server_hash = server_hash
+            return True
+
+    def submit(
+            self,
+            *args,
+            api_name: str = None,
+            fn_index: int = None,
+            result_callbacks=None,
+    ):
+        # same session_hash for all calls, gradio keeps no state between nochat API calls
+        self.refresh_client()
+        try:
+            return super().submit(*args, api_name=api_name, fn_index=fn_index, result_callbacks=result_callbacks)
+        except (ValueError, IndexError):
+            # api_name or fn_index not found, nothing sent yet, so safe to retry if server changed
+            if not self.refresh_client(force=True):
+                raise
+            return super().submit(*args, api_name=api_name, fn_index=fn_index, result_callbacks=result_callbacks)
 
     def predict(
             self,
@@ -44,5 +125,48 @@ class GradioClient(Client):
             api_name: str = None,
             fn_index: int = None,
     ) -> Any:
-        self.refresh_client()
-        return super().predict(*args, api_name=api_name, fn_index=fn_index)
+        # retries in submit() only before call is sent, failures of call itself are not retried
+        return self.submit(*args, api_name=api_name, fn_index=fn_index).result()
+
+    def stream_outputs(self, job):
+        """
+        Iterate over intermediate outputs of submitted job as soon as each arrives, without polling the job
+        Only latest output is given if several arrived since last one, since each is full output so far
+        Ends once job is done, then job.outputs() has final output
+        """
+        communicator = job.communicator
+        if communicator is None:
+            # no websocket, so no intermediate outputs, just wait for job
+            concurrent.futures.wait([job])
+            return
+        if not can_hook_communicator(communicator):
+            # public per-output iteration, result_callbacks only get final output
+            yield from job
+            return
+        stream = StreamQueue()
+        with communicator.lock:
+            # outputs are processed and appended by websocket thread under this lock, so none lost or duplicated
+            prediction_processor = communicator.prediction_processor
+
+            def prediction_processor_stream(*output):
+                result = prediction_processor(*output)
+                stream.put(result)
+                return result
+
+            communicator.prediction_processor = prediction_processor_stream
+            [stream.put(x) for x in communicator.job.outputs]
+        job.add_done_callback(lambda future: stream.close())
+        try:
+            while True:
+                yield stream.get(latest=True)
+        except StopIteration:
+            return
+        finally:
+            stream.stop()
+            with communicator.lock:
+                communicator.prediction_processor = prediction_processor
+
+
+def can_hook_communicator(communicator):
+    return can_use_private_api() and \
+        hasattr(communicator, 'prediction_processor') and hasattr(communicator, 'lock')
@@ -0,0 +1,76 @@
+import collections
+import queue
+import threading
+
+
+class StreamQueue:
+    """Queue from producer thread to streaming consumer that wakes consumer as soon as item arrives, no polling.
+
+    close() ends stream after items already put, stop() cancels both sides.
+    maxsize > 0 gives backpressure, put() blocks producer until consumer catches up.
+    """
+
+    def __init__(self, maxsize=0):
+        self._cond = threading.Condition(threading.Lock())
+        self._items = collections.deque()
+        self.maxsize = maxsize
+        self.closed = False
+        self.stopped = False
+
+    def put(self, item, timeout=None):
+        """
+        :return: False if stream was already closed or stopped, so item dropped
+        """
+        with self._cond:
+            if self.maxsize > 0:
+                if not self._cond.wait_for(lambda: len(self._items) < self.maxsize or self.stopped,
+                                           timeout=timeout):
+                    raise queue.Full
+            if self.closed or self.stopped:
+                return False
+            self._items.append(item)
+            self._cond.notify_all()
+            return True
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def stop(self):
+        with self._cond:
+            self.stopped = True
+            self._items.clear()
+            self._cond.notify_all()
+
+    def clear(self):
+        """Drop queued items and re-open stream, e.g. for next LLM call in same chain"""
+        with self._cond:
+            self._items.clear()
+            self.closed = False
+            self._cond.notify_all()
+
+    def get(self, timeout=None, latest=False):
+        """
+        :param timeout: raise queue.Empty if nothing arrived in time
+        :param latest: return only latest item and drop older ones, for when each item is full output so far
+        :return: next item, raises StopIteration once closed and drained or stopped
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self.closed or self.stopped, timeout=timeout):
+                raise queue.Empty
+            if self.stopped or not self._items:
+                raise StopIteration()
+            if latest:
+                item = self._items[-1]
+                self._items.clear()
+            else:
+                item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
@@ -4,7 +4,7 @@ from transformers import TextGenerationPipeline
 from transformers.pipelines.text_generation import ReturnType
 
 from stopping import get_stopping
-from prompter import Prompter, PromptType
+from prompter import Prompter
 
 
 class H2OTextGenerationPipeline(TextGenerationPipeline):
@@ -53,62 +53,95 @@ class H2OTextGenerationPipeline(TextGenerationPipeline):
 
     @staticmethod
     def limit_prompt(prompt_text, tokenizer, max_prompt_length=None):
+        (prompt_text,), num_prompt_tokens = H2OTextGenerationPipeline.limit_prompts([prompt_text], tokenizer,
+                                                                                    max_prompt_length=max_prompt_length)
+        return prompt_text, num_prompt_tokens
+
+    @staticmethod
+    def limit_prompts(prompt_texts, tokenizer, max_prompt_length=None):
+        """
+        Cut prompt parts, e.g. instruction, context, and input, to fit together into one token budget
+        Each part is tokenized once, and cut on a token's character boundary using offsets of fast tokenizers
+        :param prompt_texts: list of prompt parts, each None or str
+        :param tokenizer: tokenizer, if no model_max_length then nothing cut and None returned for number of tokens
+        :param max_prompt_length: further limit on token budget
+        :return: list of cut parts, total number of tokens
+        """
         verbose = bool(int(os.getenv('VERBOSE_PIPELINE', '0')))
 
-        if hasattr(tokenizer, 'model_max_length'):
+        if not hasattr(tokenizer, 'model_max_length'):
             # model_max_length only defined for generate.py, not raw use of h2oai_pipeline.py
-            model_max_length = tokenizer.model_max_length
-            if max_prompt_length is not None:
-                model_max_length = min(model_max_length, max_prompt_length)
-            # cut at some upper likely limit to avoid excessive tokenization etc
-            # upper bound of 10 chars/token, e.g. special chars sometimes are long
-            if len(prompt_text) > model_max_length * 10:
+            return prompt_texts, None
+        model_max_length = tokenizer.model_max_length
+        if max_prompt_length is not None:
+            model_max_length = min(model_max_length, max_prompt_length)
+
+        prompt_texts = list(prompt_texts)
+        # cut at some upper likely limit to avoid excessive tokenization etc
+        # upper bound of 10 chars/token, e.g. special chars sometimes are long
+        for parti, prompt_text in enumerate(prompt_texts):
+            if prompt_text and len(prompt_text) > model_max_length * 10:
                 len0 = len(prompt_text)
-                prompt_text = prompt_text[-model_max_length * 10:]
+                prompt_texts[parti] = prompt_text[-model_max_length * 10:]
                 if verbose:
-                    print("Cut of input: %s -> %s" % (len0, len(prompt_text)), flush=True)
-        else:
-            # unknown
-            model_max_length = None
-
-        num_prompt_tokens = None
-        if model_max_length is not None:
-            # can't wait for "hole" if not plain prompt_type, since would lose prefix like <human>:
-            # For https://github.com/h2oai/h2ogpt/issues/192
-            for trial in range(0, 3):
-                prompt_tokens = tokenizer(prompt_text)['input_ids']
-                num_prompt_tokens = len(prompt_tokens)
-                if num_prompt_tokens > model_max_length:
-                    # conservative by using int()
-                    chars_per_token = int(len(prompt_text) / num_prompt_tokens)
-                    # keep tail, where question is if using langchain
-                    prompt_text = prompt_text[-model_max_length * chars_per_token:]
-                    if verbose:
-                        print("reducing %s tokens, assuming average of %s chars/token for %s characters" % (
-                            num_prompt_tokens, chars_per_token, len(prompt_text)), flush=True)
-                else:
-                    if verbose:
-                        print("using %s tokens with %s chars" % (num_prompt_tokens, len(prompt_text)), flush=True)
-                    break
-
-            # Why Below False: don't limit max_new_tokens more, just rely upon stopping to reach limit of model
-            if False:
-                # if input prompt is some number of tokens, despite user request, can't have max_new_tokens more
-                #
-                assert num_prompt_tokens is not None
-                if self.prompt_type not in [PromptType.plain.name, PromptType.plain.value]:
-                    # then give room for prompt
-                    fudge = 20
+                    print("Cut of input: %s -> %s" % (len0, len(prompt_texts[parti])), flush=True)
+
+        # tokenize each part once
+        use_offsets = getattr(tokenizer, 'is_fast', False)
+        encodings = []
+        for prompt_text in prompt_texts:
+            if not prompt_text:
+                encodings.append(None)
+            elif use_offsets:
+                encodings.append(tokenizer(prompt_text, return_offsets_mapping=True, return_special_tokens_mask=True))
+            else:
+                encodings.append(tokenizer(prompt_text))
+        num_tokens = [len(x['input_ids']) if x is not None else 0 for x in encodings]
+        if sum(num_tokens) <= model_max_length:
+            if verbose:
+                print("using %s tokens with %s chars" % (
+                    sum(num_tokens), sum([len(x or '') for x in prompt_texts])), flush=True)
+            return prompt_texts, sum(num_tokens)
+
+        # split budget so parts under their fair share keep all tokens, rest shared evenly among longer parts
+        budgets = [0] * len(prompt_texts)
+        budget = model_max_length
+        remaining = sorted([parti for parti in range(len(prompt_texts)) if num_tokens[parti]],
+                           key=lambda parti: num_tokens[parti])
+        while remaining:
+            share = budget // len(remaining)
+            parti = remaining.pop(0)
+            budgets[parti] = min(num_tokens[parti], share)
+            budget -= budgets[parti]
+
+        # can't wait for "hole" if not plain prompt_type, since would lose prefix like <human>:
+        # For https://github.com/h2oai/h2ogpt/issues/192
+        for parti, (prompt_text, encoding) in enumerate(zip(prompt_texts, encodings)):
+            if num_tokens[parti] <= budgets[parti]:
+                continue
+            if use_offsets:
+                # keep tail, where question is if using langchain, starting at a token's first character
+                content = [i for i, special in enumerate(encoding['special_tokens_mask']) if not special]
+                num_keep = max(0, budgets[parti] - (num_tokens[parti] - len(content)))
+                if num_keep == 0:
+                    prompt_texts[parti] = ''
                 else:
-                    fudge = 0
-                max_new_tokens = max(0, min(generate_kwargs['max_new_tokens'],
-                                            model_max_length - (num_prompt_tokens + fudge)))
-                if max_new_tokens < generate_kwargs['max_new_tokens']:
-                    if verbose:
-                        print("Reduced max_new_tokens from %s -> %s" % (
-                        generate_kwargs['max_new_tokens'], max_new_tokens))
-                    generate_kwargs['max_new_tokens'] = max_new_tokens
-        return prompt_text, num_prompt_tokens
+                    prompt_texts[parti] = prompt_text[encoding['offset_mapping'][content[-num_keep]][0]:]
+                num_tokens[parti] = budgets[parti]
+            else:
+                # no offsets, so estimate from average chars/token
+                for trial in range(0, 3):
+                    # conservative by using int()
+                    chars_per_token = max(1, int(len(prompt_text) / num_tokens[parti]))
+                    prompt_text = prompt_text[-budgets[parti] * chars_per_token:] if budgets[parti] else ''
+                    num_tokens[parti] = len(tokenizer(prompt_text)['input_ids']) if prompt_text else 0
+                    if num_tokens[parti] <= budgets[parti]:
+                        break
+                prompt_texts[parti] = prompt_text
+            if verbose:
+                print("reduced prompt part %s to %s tokens with %s chars" % (
+                    parti, num_tokens[parti], len(prompt_texts[parti])), flush=True)
+        return prompt_texts, sum(num_tokens)
 
     def preprocess(self, prompt_text, prefix="", handle_long_generation=None, **generate_kwargs):
         prompt_text, num_prompt_tokens = H2OTextGenerationPipeline.limit_prompt(prompt_text, self.tokenizer)
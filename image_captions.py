@@ -13,15 +13,9 @@ import requests
 from langchain.docstore.document import Document
 from langchain.document_loaders import ImageCaptionLoader
 
-from utils import get_device, NullContext
+from utils import get_device, NullContext, have_package
 
-import pkg_resources
-
-try:
-    assert pkg_resources.get_distribution('bitsandbytes') is not None
-    have_bitsandbytes = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    have_bitsandbytes = False
+have_bitsandbytes = have_package('bitsandbytes')
 
 
 class H2OImageCaptionLoader(ImageCaptionLoader):
@@ -1,8 +1,9 @@
 import os
 import fire
 
+import gpt_langchain
 from gpt_langchain import path_to_docs, get_db, get_some_dbs_from_hf, all_db_zips, some_db_zips, \
-    get_embedding, add_to_db, create_or_update_db
+    get_embedding, add_to_db, create_or_update_db, register_token_counter
 from utils import get_ngpus_vis
 
 
@@ -45,6 +46,12 @@ def make_db_main(use_openai_embedding: bool = False,
                  caption_gpu: bool = True,
                  enable_ocr: bool = False,
                  db_type: str = 'chroma',
+                 embed_workers: int = 1,
+                 embed_batch_size: int = 256,
+                 faiss_index_factory: str = None,
+                 parse_cache_dir: str = None,
+                 tokenizer_base_model: str = None,
+                 hybrid_search: bool = False,
                  ):
     """
     # To make UserData db for generate.py, put pdfs, etc. into path user_path and run:
@@ -85,7 +92,17 @@ def make_db_main(use_openai_embedding: bool = False,
     :param pre_load_caption_model: See generate.py
     :param caption_gpu: Caption images on GPU if present
     :param enable_ocr: Whether to enable OCR on images
-    :param db_type: Type of db to create. Currently only 'chroma' and 'weaviate' is supported.
+    :param db_type: Type of db to create. Currently only 'chroma', 'faiss_mmap', and 'weaviate' is supported.
+           'faiss_mmap' persists faiss index and documents to persist_directory, memory-mapped when loaded
+    :param embed_workers: Number of threads embedding batches of chunks while files are still being parsed
+    :param embed_batch_size: Number of chunks embedded and added to db at once
+    :param faiss_index_factory: For new 'faiss_mmap' db, faiss index factory string,
+           e.g. 'Flat', 'SQ8' for int8 quantized, or 'IVF4096,PQ32' for IVF with product quantization.
+           Default is ENV FAISS_INDEX_FACTORY, else 'Flat'
+    :param parse_cache_dir: If not None, directory to cache parsed documents in, so re-running on same files skips parsing
+    :param tokenizer_base_model: HF tokenizer of model db will be used with, e.g. generate.py --base_model,
+           to store token counts of chunks in db so queries need not tokenize them
+    :param hybrid_search: Whether to also build BM25 keyword index of chunks, for generate.py --hybrid_search
     :return: None
     """
     db = None
@@ -141,23 +158,26 @@ def make_db_main(use_openai_embedding: bool = False,
     assert user_path is not None or url is not None, "Can't have both user_path and url as None"
     if not url:
         assert os.path.isdir(user_path), "user_path=%s does not exist" % user_path
-    sources = glob_to_db(user_path, chunk=chunk, chunk_size=chunk_size, verbose=verbose,
-                         fail_any_exception=fail_any_exception, n_jobs=n_jobs, url=url,
-                         enable_captions=enable_captions,
-                         captions_model=captions_model,
-                         caption_loader=caption_loader,
-                         enable_ocr=enable_ocr,
-                         )
-    exceptions = [x for x in sources if x.metadata.get('exception')]
-    print("Exceptions: %s" % exceptions, flush=True)
-    sources = [x for x in sources if 'exception' not in x.metadata]
-
-    assert len(sources) > 0, "No sources found"
+    if tokenizer_base_model:
+        register_token_counter(tokenizer_base_model)
+    gpt_langchain.lexical_index_enabled = hybrid_search
+    # stream files through parsing, embedding, and adding to db, so memory does not grow with number of files
+    path_kwargs = dict(path_or_paths=user_path, chunk=chunk, chunk_size=chunk_size,
+                       fail_any_exception=fail_any_exception, n_jobs=n_jobs, url=url,
+                       enable_captions=enable_captions,
+                       captions_model=captions_model,
+                       caption_loader=caption_loader,
+                       enable_ocr=enable_ocr,
+                       embed_workers=embed_workers,
+                       embed_batch_size=embed_batch_size,
+                       faiss_index_factory=faiss_index_factory,
+                       parse_cache_dir=parse_cache_dir,
+                       )
     db = create_or_update_db(db_type, persist_directory, collection_name,
-                             sources, use_openai_embedding, add_if_exists, verbose,
-                             hf_embedding_model)
+                             None, use_openai_embedding, add_if_exists, verbose,
+                             hf_embedding_model, path_kwargs=path_kwargs)
 
-    assert db is not None
+    assert db is not None, "No sources found"
     if verbose:
         print("DONE", flush=True)
     return db, collection_name
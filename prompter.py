@@ -633,6 +633,7 @@ class Prompter(object):
             self.generates_leading_space = \
             get_prompt(self.prompt_type, self.prompt_dict, chat, context, reduced, making_context)
         self.pre_response = self.PreResponse
+        self.stream_state = None
 
     def generate_prompt(self, data_point, reduced=None):
         """
@@ -752,3 +753,111 @@ class Prompter(object):
         if self.debug:
             print("outputclean:\n%s" % '\n\n'.join(outputs), flush=True)
         return output
+
+    meaningless_words = ['<pad>', '</s>', '<|endoftext|>']
+
+    def get_response_stream(self, output, prompt=None, sanitize_bot_response=False):
+        """
+        Same result as get_response(output, prompt=prompt), but for streaming where each output extends the last,
+        so only the new part of output is cleaned, checked for repeated lines, and searched for termination.
+        Falls back to get_response() for cases that cannot be done incrementally.
+        :param output: prompt + generated text so far
+        """
+        if isinstance(output, (list, tuple)):
+            if len(output) != 1:
+                return self.get_response(output, prompt=prompt, sanitize_bot_response=sanitize_bot_response)
+            output = output[0]
+        if prompt is None or sanitize_bot_response or \
+                self.prompt_type in [PromptType.plain.value, str(PromptType.plain.value), PromptType.plain.name]:
+            self.stream_state = None
+            return self.get_response(output, prompt=prompt, sanitize_bot_response=sanitize_bot_response)
+
+        state = self.stream_state
+        if state is None or state['prompt'] != prompt or not output.startswith(state['output']):
+            state = self.new_stream_state(output, prompt)
+            if state is None:
+                # e.g. prompt mutated by tokenizer, use full parsing
+                self.stream_state = None
+                return self.get_response(output, prompt=prompt, sanitize_bot_response=sanitize_bot_response)
+            self.stream_state = state
+        state['output'] = output
+
+        # hold back end that could be start of meaningless word split across tokens, or word that spans cut
+        holdback = max(len(x) for x in self.meaningless_words) - 1
+        stable_end = max(state['raw_done'], len(output) - holdback)
+        word_starts = [output.find(x[0], max(state['raw_done'], stable_end - holdback), stable_end)
+                       for x in self.meaningless_words]
+        word_starts = [x for x in word_starts if x >= 0]
+        if word_starts:
+            stable_end = min(word_starts)
+        self.add_stream_text(state, self.clean_stream_text(state, output[state['raw_done']:stable_end]))
+        state['raw_done'] = stable_end
+
+        # tentative part, from current line and held back text, not committed since may change
+        tail = state['line'] + self.clean_stream_text(state, output[stable_end:], commit=False)
+        lines = [state['committed']] if state['has_committed'] else []
+        tail_lines = []
+        for line in tail.split('\n'):
+            if not self.repeat_penalty or len(line) < self.allowed_repeat_line_length or \
+                    (line not in state['seen'] and line not in tail_lines):
+                tail_lines.append(line)
+        response = '\n'.join(lines + tail_lines)
+
+        if self.terminate_response:
+            # only search committed text once, tail each time
+            committed_len = len(state['committed'])
+            finds = []
+            for term in self.terminate_response:
+                termi = state['term_finds'].get(term, -1)
+                if termi < 0:
+                    start = max(0, state['term_searched'] - len(term) + 1)
+                    termi = state['committed'].find(term, start, committed_len)
+                    if termi >= 0:
+                        state['term_finds'][term] = termi
+                    else:
+                        termi = response.find(term, max(0, committed_len - len(term) + 1))
+                finds.append(termi)
+            state['term_searched'] = committed_len
+            finds = [x for x in finds if x >= 0]
+            if len(finds) > 0:
+                response = response[:finds[0]]
+        return response
+
+    def new_stream_state(self, output, prompt):
+        if self.pre_response:
+            outputi = output.find(prompt)
+            if outputi < 0:
+                return None
+            start = outputi + len(prompt)
+        else:
+            start = len(prompt)
+        return dict(prompt=prompt, output=output, raw_done=start,
+                    lead_done=not self.generates_leading_space,
+                    line='', committed='', has_committed=False, seen=set(),
+                    term_finds={}, term_searched=0)
+
+    def clean_stream_text(self, state, text, commit=True):
+        for word in self.meaningless_words:
+            text = text.replace(word, "")
+        if not state['lead_done'] and not state['line'] and not state['has_committed'] and text:
+            # like get_response(), only very first character of response may be leading space to remove
+            if text[0] == ' ':
+                text = text[1:]
+            if commit:
+                state['lead_done'] = True
+        return text
+
+    def add_stream_text(self, state, text):
+        if '\n' not in text:
+            state['line'] += text
+            return
+        lines = (state['line'] + text).split('\n')
+        state['line'] = lines[-1]
+        for line in lines[:-1]:
+            if not self.repeat_penalty or len(line) < self.allowed_repeat_line_length or line not in state['seen']:
+                state['seen'].add(line)
+                if state['has_committed']:
+                    state['committed'] += '\n' + line
+                else:
+                    state['committed'] = line
+                    state['has_committed'] = True
@@ -2,6 +2,7 @@
 import ast
 import glob
 import pickle
+import shutil
 import uuid
 from typing import List, Optional
 import os
@@ -30,17 +31,114 @@ def unescape(x):
     return x
 
 
-def get_views():
-    # views = pd.read_csv('wiki_page_views_more_1000month.csv')
-    views = pd.read_csv('wiki_page_views_more_5000month.csv')
-    views.index = views['title']
-    views = views['views']
-    views = views.to_dict()
-    views = {str(unescape(str(k))): v for k, v in views.items()}
-    views2 = {k.replace('_', ' '): v for k, v in views.items()}
-    # views has _ but pages has " "
-    views.update(views2)
-    return views
+def get_views(views_filename='wiki_page_views_more_5000month.csv'):
+    """
+    :return: read-only map from title to monthly views, backed by on-disk table built once from views_filename
+    """
+    views_path = views_filename + '_index'
+    if not os.path.isdir(views_path):
+        # views = pd.read_csv('wiki_page_views_more_1000month.csv')
+        views = pd.read_csv(views_filename)
+        views.index = views['title']
+        views = views['views']
+        views = views.to_dict()
+        views = {str(unescape(str(k))): v for k, v in views.items()}
+        views2 = {k.replace('_', ' '): v for k, v in views.items()}
+        # views has _ but pages has " "
+        views.update(views2)
+        SortedStringTable.save(views_path, views.items())
+    return SortedStringTable(views_path)
+
+
+global_views = None
+
+
+def get_global_views():
+    # shared by all loaders in process, and only pages of table looked up are read from disk
+    global global_views
+    if global_views is None:
+        global_views = get_views()
+    return global_views
+
+
+def rename_or_remove(path_tmp, path):
+    try:
+        os.rename(path_tmp, path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+        # another process built it first
+        shutil.rmtree(path_tmp, ignore_errors=True)
+
+
+class SortedStringTable:
+    """
+    Read-only map from str to int, stored on disk as utf-8 keys sorted by bytes and their values.
+    Memory-mapped and looked up by binary search, so O(log n) and only pages touched are read.
+    """
+
+    def __init__(self, path):
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.starts = np.load(os.path.join(path, 'starts.npy'), mmap_mode='r')
+        self.values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+
+    @staticmethod
+    def save(path, items):
+        """
+        :param items: iterable of (str, int), first value kept if key repeated
+        """
+        items = sorted(((str(k).encode('utf-8'), int(v)) for k, v in items), key=lambda x: x[0])
+        keys = []
+        values = []
+        for k, v in items:
+            if keys and keys[-1] == k:
+                continue
+            keys.append(k)
+            values.append(v)
+        starts = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum([len(k) for k in keys], out=starts[1:])
+        path_tmp = path + '.tmp.%s' % uuid.uuid4()
+        os.makedirs(path_tmp, exist_ok=True)
+        np.save(os.path.join(path_tmp, 'keys.npy'), np.frombuffer(b''.join(keys), dtype=np.uint8))
+        np.save(os.path.join(path_tmp, 'starts.npy'), starts)
+        np.save(os.path.join(path_tmp, 'values.npy'), np.array(values, dtype=np.int64))
+        # atomic, so partial table never used
+        rename_or_remove(path_tmp, path)
+
+    def __len__(self):
+        return len(self.values)
+
+    def key(self, i):
+        return self.keys[self.starts[i]:self.starts[i + 1]].tobytes()
+
+    def find(self, key):
+        """
+        :return: index of key, or -1 if missing
+        """
+        key = key.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.key(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self) and self.key(lo) == key:
+            return lo
+        return -1
+
+    def get(self, key, default=None):
+        i = self.find(key)
+        return int(self.values[i]) if i >= 0 else default
+
+    def __contains__(self, key):
+        return self.find(key) >= 0
+
+    def __getitem__(self, key):
+        i = self.find(key)
+        if i < 0:
+            raise KeyError(key)
+        return int(self.values[i])
 
 
 class MWDumpDirectLoader(MWDumpLoader):
@@ -54,7 +152,7 @@ class MWDumpDirectLoader(MWDumpLoader):
         if use_views:
             # self.views = get_views()
             # faster to use global shared values
-            self.views = global_views
+            self.views = get_global_views()
         else:
             self.views = None
 
@@ -102,30 +200,96 @@ class MWDumpDirectLoader(MWDumpLoader):
         return docs
 
 
+class WikiIndex:
+    """
+    Random access into multistream dump, using compact on-disk index built once from multistream index file
+    of lines of start_byte:page_id:title.
+    Start bytes of streams are sorted, and page ids and titles map to start byte of their stream,
+    all memory-mapped so O(log n) lookups without reading index file again
+    """
+
+    def __init__(self, index_filename):
+        self.path = index_filename + '_index'
+        if not os.path.isdir(self.path):
+            self.build(index_filename, self.path)
+        self.start_bytes = np.load(os.path.join(self.path, 'start_bytes.npy'), mmap_mode='r')
+        self.page_ids = np.load(os.path.join(self.path, 'page_ids.npy'), mmap_mode='r')
+        self.page_start_bytes = np.load(os.path.join(self.path, 'page_start_bytes.npy'), mmap_mode='r')
+        self.titles = SortedStringTable(os.path.join(self.path, 'titles'))
+
+    @staticmethod
+    def build(index_filename, path):
+        print("Building wiki index %s" % path, flush=True)
+        from array import array
+        start_bytes = array('q')
+        page_ids = array('q')
+        titles = []
+        open_func = bz2.open if index_filename.endswith('.bz2') else open
+        with open_func(index_filename, 'rt', encoding='utf-8') as index_file:
+            for line in index_file:
+                # title may itself have :
+                start_byte, page_id, title = line.rstrip('\n').split(':', 2)
+                start_bytes.append(int(start_byte))
+                page_ids.append(int(page_id))
+                titles.append(title)
+        start_bytes = np.frombuffer(start_bytes, dtype=np.int64)
+        page_ids = np.frombuffer(page_ids, dtype=np.int64)
+        order = np.argsort(page_ids, kind='stable')
+
+        path_tmp = path + '.tmp.%s' % uuid.uuid4()
+        os.makedirs(path_tmp, exist_ok=True)
+        np.save(os.path.join(path_tmp, 'start_bytes.npy'), np.unique(start_bytes))
+        np.save(os.path.join(path_tmp, 'page_ids.npy'), page_ids[order])
+        np.save(os.path.join(path_tmp, 'page_start_bytes.npy'), start_bytes[order])
+        SortedStringTable.save(os.path.join(path_tmp, 'titles'), zip(titles, start_bytes.tolist()))
+        # atomic, so partial index never used
+        rename_or_remove(path_tmp, path)
+        print("Done building wiki index %s" % path, flush=True)
+
+    def get_data_length(self, start_byte):
+        """
+        :return: bytes in stream starting at start_byte, 0 if last stream
+        """
+        i = np.searchsorted(self.start_bytes, start_byte, side='right')
+        if i >= len(self.start_bytes):
+            return 0
+        return int(self.start_bytes[i]) - start_byte
+
+    def search_title(self, title):
+        """
+        :return: start byte and length of stream with page of title, 0, 0 if not found
+        """
+        start_byte = self.titles.get(title)
+        if start_byte is None:
+            return 0, 0
+        return start_byte, self.get_data_length(start_byte)
+
+    def search_page_id(self, page_id):
+        """
+        :return: start byte and length of stream with page of page_id, 0, 0 if not found
+        """
+        i = np.searchsorted(self.page_ids, page_id)
+        if i >= len(self.page_ids) or self.page_ids[i] != page_id:
+            return 0, 0
+        start_byte = int(self.page_start_bytes[i])
+        return start_byte, self.get_data_length(start_byte)
+
+
+wiki_indexes = {}
+
+
+def get_wiki_index(index_filename):
+    if index_filename not in wiki_indexes:
+        wiki_indexes[index_filename] = WikiIndex(index_filename)
+    return wiki_indexes[index_filename]
+
+
 def search_index(search_term, index_filename):
-    byte_flag = False
-    data_length = start_byte = 0
-    index_file = open(index_filename, 'r')
-    csv_reader = csv.reader(index_file, delimiter=':')
-    for line in csv_reader:
-        if not byte_flag and search_term == line[2]:
-            start_byte = int(line[0])
-            byte_flag = True
-        elif byte_flag and int(line[0]) != start_byte:
-            data_length = int(line[0]) - start_byte
-            break
-    index_file.close()
-    return start_byte, data_length
+    return get_wiki_index(index_filename).search_title(search_term)
 
 
 def get_start_bytes(index_filename):
-    index_file = open(index_filename, 'r')
-    csv_reader = csv.reader(index_file, delimiter=':')
-    start_bytes = set()
-    for line in csv_reader:
-        start_bytes.add(int(line[0]))
-    index_file.close()
-    return sorted(start_bytes)
+    return get_wiki_index(index_filename).start_bytes.tolist()
 
 
 def get_wiki_filenames():
@@ -174,13 +338,14 @@ def get_one_chunk(wiki_filename, start_byte, end_byte, return_file=True,
 
 from joblib import Parallel, delayed
 
-global_views = get_views()
-
 
 def get_all_documents(small_test=2, n_jobs=None, use_views=True):
     print("DO get all wiki docs: %s" % small_test, flush=True)
     index_filename, wiki_filename = get_wiki_filenames()
     start_bytes = get_start_bytes(index_filename)
+    if use_views:
+        # load or build once before workers fork
+        get_global_views()
     end_bytes = start_bytes[1:]
     start_bytes = start_bytes[:-1]
 
@@ -233,6 +398,39 @@ def test_start_bytes():
     assert len(get_start_bytes(index_filename)) == 227850
 
 
+def test_wiki_index(tmp_path):
+    index_filename = os.path.join(tmp_path, 'multistream-index.txt')
+    lines = ['600:10:AccessibleComputing', '600:12:Anarchism', '600:13:AfghanistanHistory',
+             '1200:25:Autism', '1200:39:Albedo', '1500:290:A', '1500:303:Wikipedia:Manual of Style']
+    with open(index_filename, 'wt') as f:
+        f.write('\n'.join(lines) + '\n')
+    assert get_start_bytes(index_filename) == [600, 1200, 1500]
+    assert search_index('Anarchism', index_filename) == (600, 600)
+    assert search_index('Albedo', index_filename) == (1200, 300)
+    # title with : and last stream with unknown length
+    assert search_index('Wikipedia:Manual of Style', index_filename) == (1500, 0)
+    assert search_index('Missing', index_filename) == (0, 0)
+    wiki_index = get_wiki_index(index_filename)
+    assert wiki_index.search_page_id(25) == (1200, 300)
+    assert wiki_index.search_page_id(11) == (0, 0)
+    # reloaded from disk, not rebuilt
+    assert WikiIndex(index_filename).search_title('AfghanistanHistory') == (600, 600)
+
+    views_filename = os.path.join(tmp_path, 'views.csv')
+    pd.DataFrame(dict(title=['Albert_Einstein', 'Zurich', 'A'], views=[9000, 6000, 5001])).to_csv(views_filename)
+    views = get_views(views_filename)
+    assert views['Albert Einstein'] == views['Albert_Einstein'] == 9000
+    assert views['Zurich'] == 6000
+    assert 'A' in views and 'B' not in views
+
+    # sorted by utf-8 bytes, so non-ascii found too
+    table_path = os.path.join(tmp_path, 'table')
+    SortedStringTable.save(table_path, [('Zürich', 1), ('Zurich', 2), ('Ärzte', 3), ('a', 4), ('Zürich', 5)])
+    table = SortedStringTable(table_path)
+    assert len(table) == 4
+    assert [table[x] for x in ['Zürich', 'Zurich', 'Ärzte', 'a']] == [1, 2, 3, 4]
+
+
 def test_get_all_documents():
     small_test = 20  # 227850
     n_jobs = os.cpu_count() // 4
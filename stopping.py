@@ -1,78 +1,237 @@
+import threading
+
 import torch
 from transformers import StoppingCriteria, StoppingCriteriaList
 
 from prompter import PromptType
 
 
+class StopMatcher:
+    """
+    Aho-Corasick automaton over stop sequences, of token ids or of characters,
+    so each new token or character advances state in O(1) no matter how many stops
+    Built once and shared, state of each sequence being matched is just an int kept by caller
+    """
+
+    def __init__(self, stops):
+        """
+        :param stops: list of sequences of hashable symbols, e.g. lists of token ids or strings
+        """
+        self.stops = [tuple(x) for x in stops]
+        self.max_len = max([len(x) for x in self.stops], default=0)
+        # state 0 is root
+        self.goto = [{}]
+        self.fail = [0]
+        # for each state, indices of stops that end there, including via fail links
+        self.outputs = [[]]
+        for stopi, stop in enumerate(self.stops):
+            state = 0
+            for symbol in stop:
+                if symbol not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.outputs.append([])
+                    self.goto[state][symbol] = len(self.goto) - 1
+                state = self.goto[state][symbol]
+            if stop:
+                self.outputs[state].append(stopi)
+        # breadth first, so fail state of shorter prefixes done first
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for symbol, next_state in self.goto[state].items():
+                queue.append(next_state)
+                if state != 0:
+                    fail = self.fail[state]
+                    while fail and symbol not in self.goto[fail]:
+                        fail = self.fail[fail]
+                    self.fail[next_state] = self.goto[fail].get(symbol, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def step(self, state, symbol):
+        """
+        :return: new state, indices of stops that end at this symbol
+        """
+        while state and symbol not in self.goto[state]:
+            state = self.fail[state]
+        state = self.goto[state].get(symbol, 0)
+        return state, self.outputs[state]
+
+
 class StoppingCriteriaSub(StoppingCriteria):
+    """
+    Stop once any stop sequence seen enough times in generated tokens, separately for each batch row
+    Since transformers generate() stops whole batch, returns True once every row has stopped
+    """
 
-    def __init__(self, stops=[], encounters=[], device="cuda", model_max_length=None):
+    def __init__(self, stops=[], encounters=[], device="cuda", model_max_length=None,
+                 matcher=None, stop_strings=[], string_matcher=None, tokenizer=None):
+        """
+        :param stops: token id tensors of stop words, or instead pass matcher built from them
+        :param encounters: stop i needs encounters[i % len(encounters)] matches
+        :param device: unused, matching is done on cpu
+        :param stop_strings: strings to stop at on first match in decoded text, or instead pass string_matcher
+        :param tokenizer: required if stop_strings, to get text of each new token
+        """
         super().__init__()
-        assert len(stops) % len(encounters) == 0, "Number of stops and encounters must match"
+        self.matcher = matcher or StopMatcher([stop.tolist() for stop in stops])
+        assert len(self.matcher.stops) % max(1, len(encounters)) == 0, "Number of stops and encounters must match"
         self.encounters = encounters
-        self.stops = [stop.to(device) for stop in stops]
-        self.num_stops = [0] * len(stops)
+        self.string_matcher = string_matcher or (StopMatcher(stop_strings) if stop_strings else None)
+        assert self.string_matcher is None or tokenizer is not None, "Need tokenizer for stop strings"
+        self.tokenizer = tokenizer
         self.model_max_length = model_max_length
+        # per batch row, set on first call
+        self.num_seen = None
+        self.states = None
+        self.string_states = None
+        self.num_stops = None
+        self.stopped = None
 
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for stopi, stop in enumerate(self.stops):
-            if torch.all((stop == input_ids[0][-len(stop):])).item():
-                self.num_stops[stopi] += 1
-                if self.num_stops[stopi] >= self.encounters[stopi % len(self.encounters)]:
-                    # print("Stopped", flush=True)
-                    return True
-        if self.model_max_length is not None and input_ids[0].shape[0] >= self.model_max_length:
-            # critical limit
-            return True
-        # print("Tokens: %s" % input_ids[0].cpu().numpy(), flush=True)
-        # print("Stop Tokens: %s" % [x.cpu().numpy() for x in self.stops], flush=True)
-        return False
-
-
-def get_stopping(prompt_type, prompt_dict, tokenizer, device, human='<human>:', bot="<bot>:", model_max_length=None):
-    # FIXME: prompt_dict unused currently
-    if prompt_type in [PromptType.human_bot.name, PromptType.instruct_vicuna.name, PromptType.instruct_with_end.name]:
-        if prompt_type == PromptType.human_bot.name:
-            # encounters = [prompt.count(human) + 1, prompt.count(bot) + 1]
-            # stopping only starts once output is beyond prompt
-            # 1 human is enough to trigger, but need 2 bots, because very first view back will be bot we added
-            stop_words = [human, bot, '\n' + human, '\n' + bot]
-            encounters = [1, 2]
-        elif prompt_type == PromptType.instruct_vicuna.name:
-            # even below is not enough, generic strings and many ways to encode
-            stop_words = [
-                '### Human:',
-                """
+        batch_size, length = input_ids.shape
+        if self.num_seen is None:
+            # like checking tail of sequence, stop can span end of prompt and first new token
+            self.num_seen = [max(0, length - max(1, self.matcher.max_len))] * batch_size
+            self.states = [0] * batch_size
+            self.string_states = [0] * batch_size
+            self.num_stops = [[0] * len(self.matcher.stops) for _ in range(batch_size)]
+            self.stopped = [False] * batch_size
+            num_count_from = length - 1
+        else:
+            num_count_from = min(self.num_seen)
+        # one transfer of new tokens of all rows
+        offset = min(self.num_seen)
+        new_ids = input_ids[:, offset:].tolist()
+        for row in range(batch_size):
+            if self.stopped[row]:
+                continue
+            for position in range(self.num_seen[row], length):
+                token_id = new_ids[row][position - offset]
+                self.states[row], stopis = self.matcher.step(self.states[row], token_id)
+                if position < num_count_from:
+                    # only priming state from prompt
+                    continue
+                for stopi in stopis:
+                    self.num_stops[row][stopi] += 1
+                    if self.num_stops[row][stopi] >= self.encounters[stopi % len(self.encounters)]:
+                        self.stopped[row] = True
+                if self.string_matcher is not None:
+                    for char in get_token_text(self.tokenizer, token_id):
+                        self.string_states[row], stopis = self.string_matcher.step(self.string_states[row], char)
+                        if stopis:
+                            self.stopped[row] = True
+                if self.stopped[row]:
+                    break
+            self.num_seen[row] = length
+            if self.model_max_length is not None and length >= self.model_max_length:
+                # critical limit
+                self.stopped[row] = True
+        return all(self.stopped)
+
+
+token_texts = {}
+token_texts_lock = threading.Lock()
+
+
+def get_token_text(tokenizer, token_id):
+    """
+    Text of single token as it appears within decoded text, e.g. with its leading space, cached per tokenizer
+    """
+    key = (tokenizer.name_or_path, type(tokenizer).__name__)
+    texts = token_texts.get(key)
+    if texts is None:
+        with token_texts_lock:
+            texts = token_texts.setdefault(key, {})
+    text = texts.get(token_id)
+    if text is None:
+        token = tokenizer.convert_ids_to_tokens(token_id)
+        text = tokenizer.convert_tokens_to_string([token]) if token is not None else ''
+        if token is not None and token.startswith('▁') and not text.startswith(' '):
+            # sentencepiece drops leading space of first token
+            text = ' ' + text
+        texts[token_id] = text
+    return text
+
+
+# compiled stop matchers, keyed by tokenizer and stop settings, since tokenizing stop words each request is wasteful
+stop_matchers = {}
+stop_matchers_lock = threading.Lock()
+
+
+def get_stop_words(prompt_type, human='<human>:', bot="<bot>:"):
+    """
+    :return: stop words and their encounters needed, or None if prompt_type has no stopping
+    """
+    if prompt_type == PromptType.human_bot.name:
+        # encounters = [prompt.count(human) + 1, prompt.count(bot) + 1]
+        # stopping only starts once output is beyond prompt
+        # 1 human is enough to trigger, but need 2 bots, because very first view back will be bot we added
+        stop_words = [human, bot, '\n' + human, '\n' + bot]
+        encounters = [1, 2]
+    elif prompt_type == PromptType.instruct_vicuna.name:
+        # even below is not enough, generic strings and many ways to encode
+        stop_words = [
+            '### Human:',
+            """
 ### Human:""",
-                """
+            """
 ### Human:
 """,
-                '### Assistant:',
-                """
+            '### Assistant:',
+            """
 ### Assistant:""",
-                """
+            """
 ### Assistant:
 """,
-            ]
-            encounters = [1, 2]
-        else:
-            # some instruct prompts have this as end, doesn't hurt to stop on it since not common otherwise
-            stop_words = ['### End']
-            encounters = [1]
-        stop_words_ids = [
-            tokenizer(stop_word, return_tensors='pt')['input_ids'].squeeze() for stop_word in stop_words]
-        # handle single token case
-        stop_words_ids = [x if len(x.shape) > 0 else torch.tensor([x]) for x in stop_words_ids]
-        stop_words_ids = [x for x in stop_words_ids if x.shape[0] > 0]
-        # avoid padding in front of tokens
-        if tokenizer._pad_token:  # use hidden variable to avoid annoying properly logger bug
-            stop_words_ids = [x[1:] if x[0] == tokenizer.pad_token_id and len(x) > 1 else x for x in stop_words_ids]
-        # handle fake \n added
-        stop_words_ids = [x[1:] if y[0] == '\n' else x for x, y in zip(stop_words_ids, stop_words)]
-        # build stopper
-        stopping_criteria = StoppingCriteriaList(
-            [StoppingCriteriaSub(stops=stop_words_ids, encounters=encounters, device=device,
-                                 model_max_length=model_max_length)])
+        ]
+        encounters = [1, 2]
+    elif prompt_type == PromptType.instruct_with_end.name:
+        # some instruct prompts have this as end, doesn't hurt to stop on it since not common otherwise
+        stop_words = ['### End']
+        encounters = [1]
     else:
-        stopping_criteria = StoppingCriteriaList()
+        return None, None
+    return stop_words, encounters
+
+
+def get_stop_words_ids(stop_words, tokenizer):
+    stop_words_ids = [
+        tokenizer(stop_word, return_tensors='pt')['input_ids'].squeeze() for stop_word in stop_words]
+    # handle single token case
+    stop_words_ids = [x if len(x.shape) > 0 else torch.tensor([x]) for x in stop_words_ids]
+    stop_words_ids = [x for x in stop_words_ids if x.shape[0] > 0]
+    # avoid padding in front of tokens
+    if tokenizer._pad_token:  # use hidden variable to avoid annoying properly logger bug
+        stop_words_ids = [x[1:] if x[0] == tokenizer.pad_token_id and len(x) > 1 else x for x in stop_words_ids]
+    # handle fake \n added
+    stop_words_ids = [x[1:] if y[0] == '\n' else x for x, y in zip(stop_words_ids, stop_words)]
+    return stop_words_ids
+
+
+def get_stopping(prompt_type, prompt_dict, tokenizer, device, human='<human>:', bot="<bot>:", model_max_length=None,
+                 stop_strings=[]):
+    """
+    :param stop_strings: extra strings to stop at, matched in decoded text so any tokenization of them stops
+    :return: new StoppingCriteriaList, since stopping criteria hold per-generation state, but sharing compiled matchers
+    """
+    # FIXME: prompt_dict unused currently
+    stop_words, encounters = get_stop_words(prompt_type, human=human, bot=bot)
+    if stop_words is None and not stop_strings:
+        return StoppingCriteriaList()
+    key = (tokenizer.name_or_path, type(tokenizer).__name__, len(tokenizer), prompt_type, human, bot,
+           tuple(stop_strings))
+    with stop_matchers_lock:
+        matchers = stop_matchers.get(key)
+    if matchers is None:
+        stop_words_ids = get_stop_words_ids(stop_words or [], tokenizer)
+        matchers = (StopMatcher([x.tolist() for x in stop_words_ids]),
+                    StopMatcher(stop_strings) if stop_strings else None)
+        with stop_matchers_lock:
+            stop_matchers[key] = matchers
+    matcher, string_matcher = matchers
+    # build stopper
+    stopping_criteria = StoppingCriteriaList(
+        [StoppingCriteriaSub(encounters=encounters or [1], device=device, model_max_length=model_max_length,
+                             matcher=matcher, string_matcher=string_matcher, tokenizer=tokenizer)])
     return stopping_criteria
@@ -0,0 +1,111 @@
+import time
+
+import pytest
+
+from tests.utils import wrap_test_forked
+
+
+@pytest.mark.parametrize("do_sample", [False, True])
+@wrap_test_forked
+def test_continuous_batching(do_sample):
+    import torch
+    from transformers import AutoModelForCausalLM, AutoTokenizer, GenerationConfig
+    from batching import get_batch_scheduler, can_continuous_batch
+    from generate import H2OTextIteratorStreamer
+
+    base_model = 'distilgpt2'
+    tokenizer = AutoTokenizer.from_pretrained(base_model)
+    model = AutoModelForCausalLM.from_pretrained(base_model).eval()
+    assert can_continuous_batch(model)
+    generation_config = GenerationConfig(do_sample=do_sample, top_k=1, repetition_penalty=1.07,
+                                         renormalize_logits=True, remove_invalid_values=True,
+                                         eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.eos_token_id)
+    prompts = ["The capital of France is", "Once upon a time", "Hello", "Python is a programming language that"]
+    max_new_tokens = [20, 5, 30, 12]
+
+    # top_k=1 makes sampling greedy too, so batched output must match unbatched generate
+    expected = []
+    for prompt, max_new_tokens1 in zip(prompts, max_new_tokens):
+        input_ids = tokenizer(prompt, return_tensors='pt')['input_ids']
+        with torch.no_grad():
+            outputs = model.generate(input_ids=input_ids, generation_config=generation_config,
+                                     max_new_tokens=max_new_tokens1)
+        expected.append(tokenizer.decode(outputs[0], skip_special_tokens=True))
+
+    scheduler = get_batch_scheduler(model, device='cpu', max_batch_size=3)
+    streamers = [H2OTextIteratorStreamer(tokenizer, skip_special_tokens=True) for _ in prompts]
+    requests = [scheduler.submit(tokenizer(prompt, return_tensors='pt')['input_ids'], generation_config,
+                                 max_new_tokens=max_new_tokens1, streamer=streamer)
+                for prompt, max_new_tokens1, streamer in zip(prompts, max_new_tokens, streamers)]
+    for request, streamer, expected1 in zip(requests, streamers, expected):
+        streamed = ''.join(streamer)
+        request.wait()
+        assert request.exc is None
+        assert tokenizer.decode(request.sequence, skip_special_tokens=True) == expected1
+        assert streamed == expected1
+
+    # worker exits once idle
+    t0 = time.time()
+    while scheduler.thread is not None and time.time() - t0 < 10:
+        time.sleep(0.01)
+    assert scheduler.thread is None
+
+
+@wrap_test_forked
+def test_batch_error_finishes_once():
+    import torch
+    from transformers import GenerationConfig
+    from batching import BatchScheduler
+
+    class CountStreamer:
+        def __init__(self):
+            self.num_end = 0
+
+        def put(self, value):
+            pass
+
+        def end(self):
+            self.num_end += 1
+
+    scheduler = BatchScheduler(None, device='cpu')
+    # prefill joins running batch, then step fails for whole batch
+    scheduler.prefill = lambda request: scheduler.requests.append(request)
+
+    def step():
+        raise RuntimeError("step failed")
+
+    scheduler.step = step
+    streamers = [CountStreamer() for _ in range(2)]
+    with scheduler.cond:
+        requests = [scheduler.submit(torch.tensor([[1, 2]]), GenerationConfig(), streamer=streamer)
+                    for streamer in streamers]
+    for request, streamer in zip(requests, streamers):
+        assert request.done.wait(timeout=10)
+        assert isinstance(request.exc, RuntimeError)
+        assert streamer.num_end == 1
+
+
+@wrap_test_forked
+def test_score_qa_batch():
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+    from generate import score_qa, score_qa_batch
+    from batching import get_score_scheduler
+
+    score_model = 'OpenAssistant/reward-model-deberta-v3-base'
+    stokenizer = AutoTokenizer.from_pretrained(score_model)
+    smodel = AutoModelForSequenceClassification.from_pretrained(score_model).eval()
+    questions = ["Who are you?", "What is the capital of France?", "Tell me a joke about computers."]
+    answers = ["I am h2oGPT, a large language model.", "Paris.", "Why did the computer go to the doctor? " * 5]
+    max_length_tokenize = 512
+    cutoff_len = max_length_tokenize * 4
+
+    expected = [score_qa(smodel, stokenizer, max_length_tokenize, question, answer, cutoff_len)
+                for question, answer in zip(questions, answers)]
+    # small token budget so padded batches of different sizes
+    scores = score_qa_batch(smodel, stokenizer, max_length_tokenize, questions, answers, cutoff_len,
+                            max_batch_tokens=64)
+    assert all(abs(x - y) < 1e-4 for x, y in zip(scores, expected))
+
+    futures = get_score_scheduler(smodel, stokenizer).submit(list(zip(questions, answers)),
+                                                            max_length_tokenize, cutoff_len)
+    assert all(abs(x.result() - y) < 1e-4 for x, y in zip(futures, expected))
@@ -0,0 +1,76 @@
+import concurrent.futures
+import json
+import os
+
+import pytest
+
+from tests.utils import wrap_test_forked
+
+
+def make_local_tokenizer(tokenizer_dir):
+    # word-level tokenizer saved locally, so no download like tiktoken or HF hub
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast
+    tokenizer = Tokenizer(models.WordLevel(vocab={'[UNK]': 0, '</s>': 1}, unk_token='[UNK]'))
+    tokenizer.pre_tokenizer = pre_tokenizers.WhitespaceSplit()
+    PreTrainedTokenizerFast(tokenizer_object=tokenizer, unk_token='[UNK]', eos_token='</s>',
+                            model_max_length=2048).save_pretrained(tokenizer_dir)
+    return str(tokenizer_dir)
+
+
+def check_results(benchmark, output_file, num_results, num_requests, stream_output=True):
+    with open(output_file, 'rt') as f:
+        assert json.load(f) == json.loads(json.dumps(benchmark))
+    assert len(benchmark['results']) == num_results
+    for result in benchmark['results']:
+        assert result['num_requests'] == num_requests
+        assert result['ttft']['p50'] > 0
+        if stream_output:
+            assert result['itl']['p50'] > 0
+        assert result['total_tokens_per_second'] > 0
+
+
+@wrap_test_forked
+def test_benchmark_tgi_stub(tmp_path):
+    from benchmark import run_benchmark
+    output_file = os.path.join(tmp_path, 'benchmark.json')
+    benchmark = run_benchmark(backends=['tgi'], targets=['evaluate', 'get_llm', 'run_qa_db'], concurrency=[1, 4],
+                              num_requests=4, max_new_tokens=8, tokens_per_second=100, num_docs=20,
+                              tokenizer_base_model=make_local_tokenizer(tmp_path / 'tokenizer'),
+                              output_file=output_file)
+    check_results(benchmark, output_file, 6, 4)
+
+
+@wrap_test_forked
+def test_benchmark_run_qa_db_concurrent(tmp_path):
+    from benchmark import start_stub_tgi_server, get_benchmark_db, get_benchmark_tokenizer, get_client, \
+        get_prompt_text, measure_request, iter_run_qa_db
+    tokenizer = get_benchmark_tokenizer(make_local_tokenizer(tmp_path / 'tokenizer'))
+    db = get_benchmark_db(num_docs=20, persist_directory=str(tmp_path / 'db'))
+    server, url = start_stub_tgi_server(tokens_per_second=200, ttft=0.01)
+    try:
+        client = get_client('tgi', url)
+        # concurrent queries of same chroma db all get documents, so all generate
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+            futures = [executor.submit(measure_request, iter_run_qa_db, tokenizer, client=client, url=url,
+                                       prompt=get_prompt_text(200, request_id), stream_output=True,
+                                       max_new_tokens=8, db=db)
+                       for request_id in range(16)]
+            measures = [x.result() for x in futures]
+    finally:
+        server.shutdown()
+    num_empty = len([x for x in measures if x['num_tokens'] == 0])
+    assert num_empty == 0
+
+
+@pytest.mark.parametrize("stream_output", [False, True])
+@wrap_test_forked
+def test_benchmark_gradio_stub(tmp_path, stream_output):
+    from benchmark import run_benchmark
+    output_file = os.path.join(tmp_path, 'benchmark.json')
+    # streaming needs gradio queue, so websocket, else plain HTTP
+    benchmark = run_benchmark(backends=['gradio'], targets=['evaluate', 'get_llm'], concurrency=[1, 2],
+                              num_requests=2, stream_output=stream_output, max_new_tokens=8, tokens_per_second=100,
+                              tokenizer_base_model=make_local_tokenizer(tmp_path / 'tokenizer'),
+                              gradio_port=7870, gradio_queue=stream_output, output_file=output_file)
+    check_results(benchmark, output_file, 4, 2, stream_output=stream_output)
@@ -537,3 +537,118 @@ def test_text_generation_inference_server1():
     text = ast.literal_eval(output)['generated_text']
     assert 'Deep learning is a subfield of machine learning' in text or \
            'Deep learning refers to a class of machine learning' in text
+
+
+def launch_local_gradio(state, queue=False, port=7897):
+    """
+    Minimal gradio app like h2oGPT's, with system_hash from state and echo counting calls in state
+    """
+    import gradio as gr
+
+    def echo(x):
+        state['calls'] += 1
+        if x == 'fail':
+            raise RuntimeError("failed echo")
+        return 'echo ' + x
+
+    with gr.Blocks() as demo:
+        text = gr.Textbox()
+        out = gr.Textbox()
+        hash_button = gr.Button()
+        echo_button = gr.Button()
+        hash_button.click(lambda: state['hash'], inputs=None, outputs=out, api_name='system_hash')
+        echo_button.click(echo, inputs=text, outputs=out, api_name='echo')
+    if queue:
+        demo.queue()
+    demo.launch(prevent_thread_lock=True, server_name='127.0.0.1', server_port=port)
+    return demo, 'http://127.0.0.1:%d' % port
+
+
+@wrap_test_forked
+def test_grclient_refresh_retry():
+    from gradio_utils.grclient import GradioClient
+    state = dict(hash='hash1', calls=0)
+    demo, url = launch_local_gradio(state)
+    try:
+        client = GradioClient(url, check_hash_interval=1000)
+        assert client.server_hash == 'hash1'
+        session_hash = client.session_hash
+        # plain HTTP calls go through client's session, so connection is reused
+        posts = []
+        session_post = client.session.post
+        client.session.post = lambda *args, **kwargs: posts.append(1) or session_post(*args, **kwargs)
+        assert client.predict('a', api_name='/echo') == 'echo a'
+        assert client.predict('a2', api_name='/echo') == 'echo a2'
+        assert client.session_hash == session_hash
+        assert len(posts) == 2
+
+        # server changed, e.g. restarted with new code, so stale api_name map is refreshed and call retried
+        [x.update(api_name='echo_old') for x in client.config['dependencies'] if x.get('api_name') == 'echo']
+        state['hash'] = 'hash2'
+        assert client.predict('b', api_name='/echo') == 'echo b'
+        assert client.server_hash == 'hash2'
+        assert state['calls'] == 3
+
+        # server unchanged, so unknown api_name is not retried
+        try:
+            client.predict('c', api_name='/echo_missing')
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Expected unknown api_name to fail")
+
+        # call that failed once sent is not retried, even if server changed
+        state['hash'] = 'hash3'
+        try:
+            client.predict('fail', api_name='/echo')
+        except Exception:
+            pass
+        else:
+            raise AssertionError("Expected failure of call")
+        assert state['calls'] == 4
+        assert client.server_hash == 'hash2'
+    finally:
+        demo.close()
+
+
+@pytest.mark.parametrize("hook", [True, False])
+@wrap_test_forked
+def test_grclient_stream_outputs(hook):
+    import time
+    import gradio as gr
+    from gradio_utils import grclient
+    from gradio_utils.grclient import GradioClient
+
+    def count(x):
+        for i in range(int(x)):
+            time.sleep(0.1)
+            yield str(i)
+
+    with gr.Blocks() as demo:
+        text = gr.Textbox()
+        out = gr.Textbox()
+        hash_button = gr.Button()
+        count_button = gr.Button()
+        hash_button.click(lambda: 'hash1', inputs=None, outputs=out, api_name='system_hash')
+        count_button.click(count, inputs=text, outputs=out, api_name='count')
+    demo.queue()
+    demo.launch(prevent_thread_lock=True, server_name='127.0.0.1', server_port=7898)
+    try:
+        if not hook:
+            # e.g. gradio_client version whose private Communicator is not known
+            grclient.private_api_versions = ('unknown',)
+        client = GradioClient('http://127.0.0.1:7898')
+        job = client.submit('5', api_name='/count')
+        outputs = list(client.stream_outputs(job))
+        assert outputs and outputs == sorted(set(outputs))
+        assert job.outputs()[-1] == '4'
+        # stream stopped early still leaves job's own processing as it was
+        job = client.submit('5', api_name='/count')
+        prediction_processor = job.communicator.prediction_processor
+        stream = client.stream_outputs(job)
+        next(stream)
+        stream.close()
+        assert job.communicator.prediction_processor == prediction_processor
+        assert job.result() == '4'
+    finally:
+        demo.close()
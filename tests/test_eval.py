@@ -3,7 +3,6 @@ import pytest
 
 from tests.utils import wrap_test_forked
 from enums import DocumentChoices
-from utils import remove
 
 
 @pytest.mark.parametrize("base_model", ['h2oai/h2ogpt-oig-oasst1-512-6_9b', 'junelee/wizard-vicuna-13b'])
@@ -17,7 +16,7 @@ def test_eval1(cpu, bits, base_model):
 
 
 @wrap_test_forked
-def test_eval_json():
+def test_eval_json(tmp_path):
     base_model = 'h2oai/h2ogpt-oig-oasst1-512-6_9b'
     cpu = False
     bits = 8
@@ -26,8 +25,7 @@ def test_eval_json():
     prompts = [dict(instruction="Who are you?", output="I'm h2oGPT"),
                dict(instruction="What is 2+2?", output="4"),
                ]
-    eval_filename = 'test_prompts.json'
-    remove(eval_filename)
+    eval_filename = str(tmp_path / 'test_prompts.json')
     import json
     with open(eval_filename, "wt") as f:
         f.write(json.dumps(prompts, indent=2))
@@ -42,6 +40,71 @@ def test_eval_json():
     assert df['score'].values[1] > 0.95
 
 
+@wrap_test_forked
+def test_eval_resume(tmp_path):
+    prompts = [dict(instruction="Who are you?", output="I'm h2oGPT"),
+               dict(instruction="What is 2+2?", output="4"),
+               dict(instruction="What is the capital of France?", output="Paris"),
+               ]
+    eval_filename = str(tmp_path / 'test_prompts_resume.json')
+    import json
+    with open(eval_filename, "wt") as f:
+        f.write(json.dumps(prompts, indent=2))
+
+    from generate import main
+    kwargs = dict(base_model='', gradio=False, eval_filename=eval_filename, eval_prompts_only_num=3,
+                  eval_as_output=True, eval_prompts_only_seed=1235, eval_concurrency=2, eval_save_every=1)
+    eval_out_filename = main(eval_resume=False, **kwargs)
+    df = pd.read_parquet(eval_out_filename)
+    checkpoint_filename = eval_out_filename.replace('.parquet', '.jsonl')
+    with open(checkpoint_filename, 'rt') as f:
+        lines = f.readlines()
+    assert len(lines) == 3
+
+    # as if crashed after first example
+    with open(checkpoint_filename, 'wt') as f:
+        f.write(lines[0])
+    eval_out_filename2 = main(eval_resume=True, **kwargs)
+    assert eval_out_filename2 == eval_out_filename
+    df2 = pd.read_parquet(eval_out_filename2)
+    assert df2['response'].tolist() == df['response'].tolist()
+    assert df2['score'].tolist() == pytest.approx(df['score'].tolist(), rel=1e-4)
+    with open(checkpoint_filename, 'rt') as f:
+        assert len(f.readlines()) == 3
+
+    # other prompts with same count and seed, so same checkpoint file, not mixed with old rows
+    for prompt in prompts:
+        prompt['instruction'] += " Why?"
+    with open(eval_filename, "wt") as f:
+        f.write(json.dumps(prompts, indent=2))
+    eval_out_filename3 = main(eval_resume=True, **kwargs)
+    assert eval_out_filename3 == eval_out_filename
+    df3 = pd.read_parquet(eval_out_filename3)
+    assert all(x.endswith(" Why?") for x in df3['instruction_nochat'])
+
+
+@wrap_test_forked
+def test_eval_resume_no_score_model(tmp_path):
+    import json
+    prompts = [dict(instruction="Who are you?", output="I'm h2oGPT"),
+               dict(instruction="What is 2+2?", output="4"),
+               ]
+    eval_filename = str(tmp_path / 'test_prompts_resume.json')
+    with open(eval_filename, "wt") as f:
+        f.write(json.dumps(prompts, indent=2))
+
+    from generate import main
+    kwargs = dict(base_model='', gradio=False, score_model='', eval_filename=eval_filename,
+                  eval_prompts_only_num=2, eval_as_output=True, eval_prompts_only_seed=1235, eval_concurrency=2)
+    eval_out_filename = main(eval_resume=False, **kwargs)
+    # progress kept even without scores
+    checkpoint_filename = eval_out_filename.replace('.parquet', '.jsonl')
+    with open(checkpoint_filename, 'rt') as f:
+        lines = f.readlines()
+    assert len(lines) == 2
+    assert all(json.loads(x)[-1] is None for x in lines)
+
+
 def run_eval1(cpu=False, bits=None, base_model='h2oai/h2ogpt-oig-oasst1-512-6_9b', eval_filename=None,
               eval_prompts_only_num=1):
     if base_model == 'junelee/wizard-vicuna-13b' and (bits != 8 or cpu):
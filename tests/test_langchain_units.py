@@ -484,6 +484,634 @@ def test_zip_add(db_type):
             assert os.path.normpath(docs[0].metadata['source']) == os.path.normpath(test_file1)
 
 
+@wrap_test_forked
+def test_db_handle_reuse():
+    from make_db import make_db_main
+    from gpt_langchain import get_existing_db, db_handles
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        with tempfile.TemporaryDirectory() as tmp_user_path:
+            msg1 = "Hello World"
+            test_file1 = os.path.join(tmp_user_path, 'test.txt')
+            with open(test_file1, "wt") as f:
+                f.write(msg1)
+            db, collection_name = make_db_main(persist_directory=tmp_persistent_directory, user_path=tmp_user_path,
+                                               fail_any_exception=True, db_type='chroma',
+                                               add_if_exists=False)
+            assert db is not None
+            hf_embedding_model = db._embedding_function.model_name
+            kwargs = dict(persist_directory=tmp_persistent_directory, load_db_if_exists=True, db_type='chroma',
+                          use_openai_embedding=False, langchain_mode=collection_name,
+                          hf_embedding_model=hf_embedding_model)
+            db1 = get_existing_db(None, **kwargs)
+            assert db1 is not None
+            assert len(db_handles) == 1
+            # second query re-uses same handle instead of re-loading collection
+            db2 = get_existing_db(None, **kwargs)
+            assert db2 is db1
+            docs = db2.similarity_search("World")
+            assert len(docs) == 1
+            assert docs[0].page_content == msg1
+
+
+@pytest.mark.parametrize("db_type", db_types)
+@wrap_test_forked
+def test_make_db_stream(db_type):
+    from make_db import make_db_main
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        with tempfile.TemporaryDirectory() as tmp_user_path:
+            num_files = 10
+            for filei in range(num_files):
+                with open(os.path.join(tmp_user_path, 'test%d.txt' % filei), "wt") as f:
+                    f.write("File %d says hello. " % filei * 200)
+            # small batches so files span several parse/embed/write batches
+            db, collection_name = make_db_main(persist_directory=tmp_persistent_directory, user_path=tmp_user_path,
+                                               fail_any_exception=True, db_type=db_type,
+                                               embed_workers=2, embed_batch_size=3)
+            assert db is not None
+            docs = db.similarity_search("File 7 says hello.", k=1)
+            assert docs[0].metadata['source'] == os.path.join(tmp_user_path, 'test7.txt')
+            if db_type == 'chroma':
+                sources = set(x['source'] for x in db.get()['metadatas'])
+                assert len(sources) == num_files
+
+
+@wrap_test_forked
+def test_embedding_pool():
+    from gpt_langchain import get_embedding, embedding_pool
+    hf_embedding_model = "sentence-transformers/all-MiniLM-L6-v2"
+    embedding1 = get_embedding(False, hf_embedding_model=hf_embedding_model)
+    embedding2 = get_embedding(False, hf_embedding_model=hf_embedding_model)
+    assert embedding1 is embedding2
+    assert len(embedding_pool) == 1
+
+
+@wrap_test_forked
+def test_embedding_pool_evict():
+    import threading
+    import torch
+    import gpt_langchain
+
+    class FakeClient:
+        def __init__(self):
+            self.weight = torch.zeros(1024)
+
+        def parameters(self):
+            return [self.weight]
+
+    class FakeEmbedding:
+        def __init__(self, name):
+            self.name = name
+            self.client = FakeClient()
+
+    loading = threading.Event()
+    release = threading.Event()
+
+    def get_hf_embedding(hf_embedding_model, device):
+        if hf_embedding_model == 'slow':
+            loading.set()
+            release.wait()
+        return FakeEmbedding(hf_embedding_model)
+
+    gpt_langchain.get_hf_embedding = get_hf_embedding
+    # room for one model
+    gpt_langchain.embedding_pool_max_bytes = 4096
+    thread = threading.Thread(target=gpt_langchain.get_embedding, args=(False, 'slow'))
+    thread.start()
+    loading.wait()
+    # slow load of one model does not block getting another
+    held = gpt_langchain.get_embedding(False, hf_embedding_model='a')
+    assert held.name == 'a'
+    with gpt_langchain.embedding_user(held):
+        release.set()
+        thread.join()
+        # 'a' is still used, so kept even though over budget
+        assert [x[0] for x in gpt_langchain.embedding_pool] == ['slow', 'a']
+        gpt_langchain.get_embedding(False, hf_embedding_model='b')
+        assert [x[0] for x in gpt_langchain.embedding_pool] == ['a', 'b']
+        assert gpt_langchain.get_embedding(False, hf_embedding_model='a') is held
+    # not used anymore, so evicted even though still referenced
+    gpt_langchain.get_embedding(False, hf_embedding_model='c')
+    assert [x[0] for x in gpt_langchain.embedding_pool] == ['c']
+    assert not gpt_langchain.embedding_users
+
+
+@wrap_test_forked
+def test_embedding_pool_evict_db_handle(tmp_path):
+    import gc
+    import weakref
+    from typing import Any
+    import torch
+    from langchain.docstore.document import Document
+    from langchain.embeddings import FakeEmbeddings
+    import gpt_langchain
+    from gpt_langchain import get_db, get_db_handle, invalidate_db_handle
+
+    class FakeClient:
+        def __init__(self):
+            self.weight = torch.zeros(1024)
+
+        def parameters(self):
+            return [self.weight]
+
+        def cpu(self):
+            pass
+
+    class PoolEmbeddings(FakeEmbeddings):
+        client: Any = None
+
+    gpt_langchain.get_hf_embedding = lambda hf_embedding_model, device: PoolEmbeddings(size=4, client=FakeClient())
+    # room for one model
+    gpt_langchain.embedding_pool_max_bytes = 4096
+    sources = [Document(page_content="hello", metadata=dict(source='a.txt'))]
+    dbs = {}
+    for name in ['UserData1', 'UserData2']:
+        persist_directory = str(tmp_path / name)
+        dbs[name] = get_db(sources, db_type='chroma', persist_directory=persist_directory, langchain_mode=name,
+                           hf_embedding_model=name)
+        assert get_db_handle(name, persist_directory, False, name) is dbs[name]
+    # first model was idle, so evicted along with its db handle, but db kept by caller still works
+    assert [x[0] for x in gpt_langchain.embedding_pool] == ['UserData2']
+    assert get_db_handle('UserData1', str(tmp_path / 'UserData1'), False, 'UserData1') is None
+    assert len(dbs['UserData1'].similarity_search("hello", k=1)) == 1
+
+    # once db handle is closed and db no longer used, evicted model is freed
+    model_ref = weakref.ref(dbs['UserData2']._embedding_function)
+    invalidate_db_handle(db=dbs['UserData2'])
+    dbs.clear()
+    get_db(sources, db_type='chroma', persist_directory=str(tmp_path / 'UserData3'),
+           langchain_mode='UserData3', hf_embedding_model='UserData3')
+    assert [x[0] for x in gpt_langchain.embedding_pool] == ['UserData3']
+    gc.collect()
+    assert model_ref() is None
+
+
+@wrap_test_forked
+def test_parse_cache():
+    from gpt_langchain import path_to_docs
+    with tempfile.TemporaryDirectory() as tmp_cache_dir:
+        with tempfile.TemporaryDirectory() as tmp_user_path:
+            msg1 = "Hello World"
+            test_file1 = os.path.join(tmp_user_path, 'test.txt')
+            with open(test_file1, "wt") as f:
+                f.write(msg1)
+            docs = path_to_docs(test_file1, n_jobs=1, parse_cache_dir=tmp_cache_dir)
+            assert len(docs) == 1
+            assert len(os.listdir(tmp_cache_dir)) == 1
+
+            # same content at other path re-uses cache, with source pointing to new file
+            test_file2 = os.path.join(tmp_user_path, 'test2.txt')
+            shutil.copy(test_file1, test_file2)
+            docs = path_to_docs(test_file2, n_jobs=1, parse_cache_dir=tmp_cache_dir)
+            assert len(docs) == 1
+            assert docs[0].page_content == msg1
+            assert docs[0].metadata['source'] == test_file2
+            assert len(os.listdir(tmp_cache_dir)) == 1
+
+            # changed content or settings parse again
+            with open(test_file2, "wt") as f:
+                f.write(msg1 + "!")
+            docs = path_to_docs(test_file2, n_jobs=1, parse_cache_dir=tmp_cache_dir)
+            assert docs[0].page_content == msg1 + "!"
+            path_to_docs(test_file1, n_jobs=1, parse_cache_dir=tmp_cache_dir, chunk_size=256)
+            assert len(os.listdir(tmp_cache_dir)) == 3
+
+
+@wrap_test_forked
+def test_file_manifest():
+    import gpt_langchain
+    from gpt_langchain import path_to_docs, purge_deleted_files, save_file_manifest, load_file_manifest
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        with tempfile.TemporaryDirectory() as tmp_user_path:
+            for filei in range(3):
+                with open(os.path.join(tmp_user_path, 'test%d.txt' % filei), "wt") as f:
+                    f.write("Hello World %d" % filei)
+            file_manifest = {}
+            docs = path_to_docs(tmp_user_path, n_jobs=1, parse_cache_dir=None, file_manifest=file_manifest)
+            assert len(docs) == 3
+            assert len(file_manifest) == 3
+            existing_hash_ids = {x.metadata['source']: x.metadata['hashid'] for x in docs}
+            save_file_manifest(tmp_persistent_directory, file_manifest)
+            file_manifest = load_file_manifest(tmp_persistent_directory)
+            assert len(file_manifest) == 3
+
+            # only changed file is read again
+            test_file1 = [x for x in file_manifest if x.endswith('test1.txt')][0]
+            with open(test_file1, "wt") as f:
+                f.write("Hello World changed")
+            hashed = []
+            hash_file = gpt_langchain.hash_file
+            gpt_langchain.hash_file = lambda x: hashed.append(x) or hash_file(x)
+            try:
+                docs = path_to_docs(tmp_user_path, n_jobs=1, parse_cache_dir=None, file_manifest=file_manifest,
+                                    existing_hash_ids=existing_hash_ids)
+            finally:
+                gpt_langchain.hash_file = hash_file
+            assert set(hashed) == {test_file1}
+            assert [x.metadata['source'] for x in docs] == [test_file1]
+            assert file_manifest[test_file1]['hashid'] == docs[0].metadata['hashid']
+
+            os.remove(test_file1)
+            assert purge_deleted_files(None, file_manifest) == [test_file1]
+            assert len(file_manifest) == 2
+
+
+@wrap_test_forked
+def test_source_index():
+    import time
+    from typing import Any
+    from chromadb.config import Settings
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.vectorstores import Chroma
+    import gpt_langchain
+    from gpt_langchain import path_to_docs, add_to_db, purge_deleted_files, get_source_index, \
+        get_source_index_file
+
+    class CpuEmbeddings(FakeEmbeddings):
+        # like HF embedding, that add_to_db moves back to cpu
+        client: Any = type('Client', (), dict(cpu=lambda self: None))()
+
+    def check_source_index(db):
+        collection = db.get(include=['metadatas'])
+        source_index = get_source_index(db)
+        assert set(source_index['id2meta']) == set(collection['ids'])
+        source2ids = {}
+        for id1, metadata in zip(collection['ids'], collection['metadatas']):
+            source2ids.setdefault(metadata['source'], set()).add(id1)
+        assert source_index['source2ids'] == source2ids
+        return source2ids
+
+    def add(db, docs):
+        return add_to_db(db, docs, db_type='chroma', hf_embedding_model='fake',
+                         embeddings=embedding.embed_documents([x.page_content for x in docs]))[1]
+
+    embedding = CpuEmbeddings(size=8)
+    gpt_langchain.db_persist_max_delay = 2
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        with tempfile.TemporaryDirectory() as tmp_user_path:
+            for filei in range(3):
+                with open(os.path.join(tmp_user_path, 'test%d.txt' % filei), "wt") as f:
+                    f.write("Hello World %d" % filei)
+            client_settings = Settings(anonymized_telemetry=False, chroma_db_impl="duckdb+parquet",
+                                       persist_directory=tmp_persistent_directory)
+            db = Chroma(collection_name='UserData', embedding_function=embedding,
+                        persist_directory=tmp_persistent_directory, client_settings=client_settings)
+            file_manifest = {}
+            assert add(db, path_to_docs(tmp_user_path, n_jobs=1, file_manifest=file_manifest)) == 3
+            assert len(check_source_index(db)) == 3
+            # persist deferred, then done by background thread though nothing more added
+            assert os.path.abspath(tmp_persistent_directory) in gpt_langchain.db_persist_pending
+            assert not os.path.isfile(get_source_index_file(tmp_persistent_directory))
+
+            # re-add of same content skipped, changed file replaces its old chunks
+            assert add(db, path_to_docs(tmp_user_path, n_jobs=1)) == 0
+            # same path as found in user_path
+            test_file1 = [x for x in file_manifest if x.endswith('test1.txt')][0]
+            with open(test_file1, "wt") as f:
+                f.write("Hello World changed")
+            assert add(db, path_to_docs(test_file1, n_jobs=1, file_manifest=file_manifest)) == 1
+            source2ids = check_source_index(db)
+            assert len(source2ids) == 3 and len(db.get()['ids']) == 3
+            assert db._collection.get(ids=list(source2ids[test_file1]))["documents"] == ["Hello World changed"]
+
+            # delete of removed file in one batch
+            os.remove(test_file1)
+            assert purge_deleted_files(db, file_manifest, db_type='chroma') == [test_file1]
+            assert test_file1 not in check_source_index(db)
+            assert len(db.get()['ids']) == 2
+
+            # delete persisted immediately, later adds by background thread
+            with open(test_file1, "wt") as f:
+                f.write("Hello World again")
+            assert add(db, path_to_docs(test_file1, n_jobs=1)) == 1
+            for _ in range(100):
+                if os.path.abspath(tmp_persistent_directory) not in gpt_langchain.db_persist_pending:
+                    break
+                time.sleep(0.1)
+            assert os.path.abspath(tmp_persistent_directory) not in gpt_langchain.db_persist_pending
+            assert os.path.isfile(get_source_index_file(tmp_persistent_directory))
+
+            # index on disk matches persisted collection
+            gpt_langchain.source_indexes.clear()
+            db = Chroma(collection_name='UserData', embedding_function=embedding,
+                        persist_directory=tmp_persistent_directory, client_settings=client_settings)
+            assert len(check_source_index(db)) == 3
+
+
+@wrap_test_forked
+def test_db_lock():
+    import threading
+    from typing import Any
+    from chromadb.config import Settings
+    from langchain.docstore.document import Document
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.vectorstores import Chroma
+    from gpt_langchain import add_to_db, get_db_lock, db_read_lock, db_write_lock
+
+    # each user's MyData db has own lock
+    assert get_db_lock('UserData') is get_db_lock('UserData', 'db_dir_UserData')
+    lock1 = get_db_lock('MyData', 'db_dir_MyData_1')
+    assert lock1 is get_db_lock('MyData', 'db_dir_MyData_1')
+    assert lock1 is not get_db_lock('MyData', 'db_dir_MyData_2')
+
+    class CpuEmbeddings(FakeEmbeddings):
+        client: Any = type('Client', (), dict(cpu=lambda self: None))()
+
+    def get_docs(name, num):
+        docs = [Document(page_content="%s %d" % (name, i), metadata=dict(source='%s%d' % (name, i),
+                                                                           hashid='%s%d' % (name, i)))
+                for i in range(num)]
+        return docs, embedding.embed_documents([x.page_content for x in docs])
+
+    embedding = CpuEmbeddings(size=8)
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        db = Chroma(collection_name='UserData', embedding_function=embedding,
+                    persist_directory=tmp_persistent_directory,
+                    client_settings=Settings(anonymized_telemetry=False, chroma_db_impl="duckdb+parquet",
+                                             persist_directory=tmp_persistent_directory))
+        docs, embeddings = get_docs('old', 50)
+        add_to_db(db, docs, db_type='chroma', hf_embedding_model='fake', embeddings=embeddings)
+        num_empty = []
+        num_wrong = []
+        exceptions = []
+        # searches of chroma db hold read lock at same time
+        barrier = threading.Barrier(4, timeout=10)
+
+        def search():
+            try:
+                for i in range(50):
+                    with db_read_lock(db, 'UserData'):
+                        if i == 0:
+                            barrier.wait()
+                        num_empty.extend([1] if not db.similarity_search_with_score("old", k=10) else [])
+                        # each thread's own query result, not another's
+                        got = db._collection.get(where=dict(source='old%d' % i))['documents']
+                        num_wrong.extend([1] if got != ['old %d' % i] else [])
+            except BaseException as e:
+                exceptions.append(e)
+
+        def add():
+            for i in range(10):
+                docs1, embeddings1 = get_docs('new%d_' % i, 2)
+                with db_write_lock('UserData', tmp_persistent_directory):
+                    add_to_db(db, docs1, db_type='chroma', hf_embedding_model='fake', embeddings=embeddings1)
+
+        threads = [threading.Thread(target=search) for _ in range(4)] + [threading.Thread(target=add)]
+        [x.start() for x in threads]
+        [x.join() for x in threads]
+        assert not exceptions
+        assert not num_empty
+        assert not num_wrong
+        assert len(db.get()['ids']) == 70
+        # lock file of db itself, not shared by all dbs of that name in current directory
+        assert os.path.isfile(os.path.join(tmp_persistent_directory, '.db.lock'))
+        assert not os.path.isfile('db_UserData.lock')
+
+
+@wrap_test_forked
+def test_lexical_index():
+    from gpt_langchain import LexicalIndex
+    lexical_index = LexicalIndex()
+    lexical_index.add(['a', 'b', 'c'], ["Use get_db to load the database",
+                                        "The database is loaded from disk",
+                                        "Nothing relevant here"])
+    assert len(lexical_index) == 3
+    # identifier matched whole and by parts
+    assert lexical_index.search("get_db")[0][0] == 'a'
+    assert [x[0] for x in lexical_index.search("database", ids={'b', 'c'})] == ['b']
+    assert lexical_index.search("unknownword") == []
+    lexical_index.remove(['a'])
+    assert len(lexical_index) == 2
+    assert [x[0] for x in lexical_index.search("get_db load")] == []
+    # re-adding same id replaces
+    lexical_index.add(['b'], ["get_db again"])
+    assert [x[0] for x in lexical_index.search("get_db")] == ['b']
+    assert len(lexical_index) == 2
+
+
+@wrap_test_forked
+def test_lexical_index_ingestion():
+    from typing import Any
+    from chromadb.config import Settings
+    from langchain.docstore.document import Document
+    from langchain.embeddings.fake import FakeEmbeddings
+    from langchain.vectorstores import Chroma
+    import gpt_langchain
+    from gpt_langchain import add_to_db, hybrid_search_with_score, get_lexical_index_file
+
+    class CpuEmbeddings(FakeEmbeddings):
+        client: Any = type('Client', (), dict(cpu=lambda self: None))()
+
+    def add(db, texts):
+        docs = [Document(page_content=x, metadata=dict(source=x, hashid=x)) for x in texts]
+        add_to_db(db, docs, db_type='chroma', hf_embedding_model='fake',
+                  embeddings=embedding.embed_documents(texts))
+
+    embedding = CpuEmbeddings(size=8)
+    gpt_langchain.lexical_index_enabled = True
+    for langchain_mode in ['UserData', 'MyData']:
+        with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+            persist_directory = os.path.abspath(tmp_persistent_directory)
+            db = Chroma(collection_name=langchain_mode, embedding_function=embedding,
+                        persist_directory=tmp_persistent_directory,
+                        client_settings=Settings(anonymized_telemetry=False, chroma_db_impl="duckdb+parquet",
+                                                 persist_directory=tmp_persistent_directory))
+            add(db, ["Use get_db to load the database", "Nothing relevant here"])
+            add(db, ["The database is loaded from disk"])
+            if langchain_mode == 'MyData':
+                # persisted right away, and not kept in memory for each user
+                assert persist_directory not in gpt_langchain.lexical_indexes
+                assert os.path.isfile(get_lexical_index_file(persist_directory))
+            else:
+                # built at ingestion, so query only uses it
+                assert len(gpt_langchain.lexical_indexes[persist_directory]) == 3
+            docs_with_score, lexical_docs = hybrid_search_with_score(db, "get_db", k=2)
+            lexical_contents = [doc.page_content for doc, score in docs_with_score if id(doc) in lexical_docs]
+            assert lexical_contents == ["Use get_db to load the database"]
+            if langchain_mode == 'MyData':
+                assert persist_directory not in gpt_langchain.lexical_indexes
+
+
+@wrap_test_forked
+def test_embedding_cache():
+    import numpy as np
+    import gpt_langchain
+    from gpt_langchain import embed_documents_cached
+    from langchain.embeddings.fake import FakeEmbeddings
+    embedded = []
+
+    class CountEmbeddings(FakeEmbeddings):
+        def embed_documents(self, texts):
+            embedded.extend(texts)
+            return super().embed_documents(texts)
+
+    embedding = CountEmbeddings(size=8)
+    with tempfile.TemporaryDirectory() as tmp_cache_dir:
+        gpt_langchain.embedding_cache_path = os.path.join(tmp_cache_dir, 'embedding_cache.sqlite')
+        vectors1 = embed_documents_cached(embedding, ["a", "b", "a"], hf_embedding_model='model1')
+        assert embedded == ["a", "b"]
+        assert vectors1[0] == vectors1[2]
+        # only new text embedded, others from cache with same values
+        vectors2 = embed_documents_cached(embedding, ["b", "c", "a"], hf_embedding_model='model1')
+        assert embedded == ["a", "b", "c"]
+        # same float32 values whether fresh or from cache
+        assert vectors2[0] == vectors1[1]
+        assert vectors2[2] == vectors1[0]
+        assert vectors1[0] == np.asarray(vectors1[0], dtype=np.float32).tolist()
+        # other model embeds again
+        embed_documents_cached(embedding, ["a"], hf_embedding_model='model2')
+        assert embedded == ["a", "b", "c", "a"]
+
+        # size capped by dropping oldest written
+        embedding_cache = gpt_langchain.EmbeddingCache(os.path.join(tmp_cache_dir, 'capped.sqlite'), max_rows=2)
+        embedding_cache.put('model1', ["a", "b", "c"], [[1.0], [2.0], [3.0]])
+        assert embedding_cache.get('model1', ["a", "b", "c"]) == {"b": [2.0], "c": [3.0]}
+
+
+@wrap_test_forked
+def test_columnar_docstore():
+    from langchain.docstore.document import Document
+    from gpt_langchain import ColumnarDocstore
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        docstore = ColumnarDocstore(tmp_persistent_directory)
+        assert len(docstore) == 0
+        docs = [Document(page_content="Hello %d Zürich" % i, metadata=dict(source='file%d.txt' % i, chunk_id=i))
+                for i in range(5)]
+        docstore.add({str(i): doc for i, doc in enumerate(docs[:3])})
+        docstore.save()
+        docstore.add({str(i + 3): doc for i, doc in enumerate(docs[3:])})
+        # saved and pending both found
+        assert [docstore.search(str(i)) for i in range(5)] == docs
+        assert docstore.search("5") == "ID 5 not found."
+        docstore.save()
+        docstore = ColumnarDocstore(tmp_persistent_directory)
+        assert list(docstore.documents()) == docs
+        assert [x['source'] for x in docstore.metadatas()] == ['file%d.txt' % i for i in range(5)]
+
+
+@pytest.mark.parametrize("index_factory", ['Flat', 'SQ8', 'IVF4,Flat'])
+@pytest.mark.skipif(not have_faiss, reason="requires FAISS")
+@wrap_test_forked
+def test_faiss_mmap(index_factory):
+    from langchain.docstore.document import Document
+    from langchain.embeddings.fake import FakeEmbeddings
+    from gpt_langchain import FAISSMmap, add_embedded_documents, get_metadatas
+    embedding = FakeEmbeddings(size=16)
+    with tempfile.TemporaryDirectory() as tmp_persistent_directory:
+        db = FAISSMmap.create(embedding, tmp_persistent_directory, 'UserData', 16, index_factory=index_factory)
+        docs = [Document(page_content="Hello %d" % i, metadata=dict(source='file%d.txt' % i)) for i in range(200)]
+        embeddings = embedding.embed_documents([x.page_content for x in docs])
+        # IVF not trainable on first 2 vectors, so searched by brute force until rest added
+        add_embedded_documents(db, docs[:2], embeddings[:2])
+        assert db.similarity_search_by_vector(embeddings[1], k=1)[0] == docs[1]
+        add_embedded_documents(db, docs[2:], embeddings[2:])
+        db.persist()
+
+        db = FAISSMmap.load(embedding, tmp_persistent_directory)
+        assert db.index.ntotal == len(docs)
+        assert db.similarity_search_by_vector(embeddings[100], k=1)[0] == docs[100]
+        assert len(get_metadatas(db)) == len(docs)
+        # add after load
+        add_embedded_documents(db, [Document(page_content="New", metadata=dict(source='new.txt'))], [embeddings[0]])
+        db.persist()
+        db = FAISSMmap.load(embedding, tmp_persistent_directory)
+        assert db.index.ntotal == len(docs) + 1
+
+        # persist interrupted after vectors written, before documents
+        add_embedded_documents(db, [Document(page_content="Lost", metadata=dict(source='lost.txt'))], [embeddings[1]])
+        db.docstore.save = lambda: None
+        db.persist()
+        db = FAISSMmap.load(embedding, tmp_persistent_directory)
+        assert db.index.ntotal == len(db.docstore) == len(docs) + 1
+        # documents without vectors, e.g. from before vectors were written first
+        db.docstore.add({str(len(docs) + 1): Document(page_content="Lost", metadata=dict(source='lost.txt'))})
+        db.docstore.save()
+        db = FAISSMmap.load(embedding, tmp_persistent_directory)
+        assert db.index.ntotal == len(db.docstore) == len(docs) + 1
+        assert db.similarity_search_by_vector(embeddings[100], k=1)[0] == docs[100]
+
+
+@wrap_test_forked
+def test_num_tokens_docs():
+    from langchain.docstore.document import Document
+    from gpt_langchain import get_num_tokens_docs, get_num_tokens_key
+    calls = []
+
+    def count_tokens(texts):
+        calls.append(len(texts))
+        return [len(x.split()) for x in texts]
+
+    docs = [Document(page_content="a b c", metadata={}),
+            Document(page_content="d e", metadata={get_num_tokens_key('words'): 7})]
+    assert get_num_tokens_docs(docs, 'words', count_tokens) == [3, 7]
+    # only chunk without stored count tokenized, in one batch
+    assert calls == [1]
+    assert docs[0].metadata[get_num_tokens_key('words')] == 3
+
+    # same text again is from cache
+    docs = [Document(page_content="a b c", metadata={})]
+    assert get_num_tokens_docs(docs, 'words', count_tokens) == [3]
+    assert calls == [1]
+
+    # registered family, e.g. by make_db.py --tokenizer_base_model, is stored at ingestion
+    import gpt_langchain
+    gpt_langchain.token_counters['words'] = count_tokens
+    docs = [Document(page_content="f g h i", metadata={})]
+    gpt_langchain.add_num_tokens(docs)
+    assert docs[0].metadata[get_num_tokens_key('words')] == 4
+
+
+@wrap_test_forked
+def test_token_counters_hold_no_model(tmp_path):
+    import gc
+    import weakref
+    from transformers import AutoTokenizer
+    from tests.test_benchmark import make_local_tokenizer
+    import gpt_langchain
+    from gpt_langchain import get_token_counter
+
+    class Client:
+        max_seq_length = 3
+
+        def __init__(self):
+            self.tokenizer = AutoTokenizer.from_pretrained(make_local_tokenizer(tmp_path / 'tokenizer'))
+
+    class Embedding:
+        model_name = 'fake'
+
+        def __init__(self):
+            self.client = Client()
+
+    class DB:
+        def __init__(self):
+            self._embedding_function = Embedding()
+
+    class LLM:
+        def get_num_tokens(self, text):
+            return len(text.split())
+
+    db = DB()
+    client_ref = weakref.ref(db._embedding_function.client)
+    family, count_tokens = get_token_counter(None, None, db, '', False, 'chroma', 'model')
+    assert family == 'embedding_fake'
+    assert gpt_langchain.token_counters[family] is count_tokens
+    # embedding model can be freed, e.g. evicted from pool, while its family still counts for ingestion
+    del db
+    gc.collect()
+    assert client_ref() is None
+    # truncated like embedding model's client.tokenize()
+    assert count_tokens(["a b", "a b c d e"]) == [2, 3]
+
+    # llm counter only for this query, not kept for later ingestion
+    llm = LLM()
+    llm_ref = weakref.ref(llm)
+    family, count_tokens = get_token_counter(llm, None, None, '', False, 'faiss', 'model')
+    assert count_tokens(["a b"]) == [2]
+    assert family not in gpt_langchain.token_counters
+    del llm, count_tokens
+    gc.collect()
+    assert llm_ref() is None
+
+
 @pytest.mark.parametrize("db_type", db_types)
 @wrap_test_forked
 def test_url_add(db_type):
@@ -120,3 +120,31 @@ def test_pipeline3():
     print(res[0]["generated_text"])
 
     assert 'Drinking water is so healthy because it is a natural source of hydration' in res[0]['generated_text']
+
+
+@wrap_test_forked
+def test_limit_prompts():
+    from transformers import AutoTokenizer
+    from h2oai_pipeline import H2OTextGenerationPipeline
+    tokenizer = AutoTokenizer.from_pretrained('distilgpt2')
+    tokenizer.model_max_length = 100
+    instruction = "What is the answer?"
+    context = " ".join(["Context sentence number %s." % i for i in range(100)])
+    iinput = " ".join(["Input word%s" % i for i in range(100)])
+
+    # fits, unchanged
+    texts, num_tokens = H2OTextGenerationPipeline.limit_prompts([instruction, '', None], tokenizer)
+    assert texts == [instruction, '', None]
+    assert num_tokens == len(tokenizer(instruction)['input_ids'])
+
+    # short instruction kept whole, rest of budget split, tails kept
+    texts, num_tokens = H2OTextGenerationPipeline.limit_prompts([instruction, context, iinput], tokenizer)
+    assert texts[0] == instruction
+    assert context.endswith(texts[1]) and iinput.endswith(texts[2])
+    counts = [len(tokenizer(x)['input_ids']) for x in texts]
+    assert num_tokens == 100
+    assert sum(counts) <= 100
+    assert abs(counts[1] - counts[2]) <= 1
+
+    text, num_tokens = H2OTextGenerationPipeline.limit_prompt(context, tokenizer, max_prompt_length=10)
+    assert num_tokens == 10 and len(tokenizer(text)['input_ids']) == 10
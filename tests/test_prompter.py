@@ -141,3 +141,63 @@ def test_prompt_with_no_context(prompt_type, expected):
 def test_source():
     prompt = "Who are you?%s\nFOO\n%s" % (source_prefix, source_postfix)
     assert prompt.find(source_prefix) >= 0
+
+
+@pytest.mark.parametrize("prompt_type", ['human_bot', 'vicuna11', 'prompt_answer', 'instruct', 'plain'])
+@wrap_test_forked
+def test_get_response_stream(prompt_type):
+    import random
+    from prompter import Prompter
+    random.seed(1234)
+    pieces = [' ', 'Hello', ' world', '\n', 'This line repeats', '\n', 'ok', '<', '/s', '>', '<pad>', ' ',
+              '<human>:', '<bot>:', 'USER:', '<|prompt|>', '<|endoftext|>', '### Instruction:']
+    for trial in range(50):
+        prompter = Prompter(prompt_type, None, chat=True, stream_output=True)
+        prompt = prompter.generate_prompt(dict(context='', instruction="Go to the market?", input=''))
+        text = ''
+        for token in [random.choice(pieces) for _ in range(random.randint(1, 60))]:
+            text += token
+            # fresh prompter to check full parsing
+            expected = Prompter(prompt_type, None, chat=True).get_response(prompt + text, prompt=prompt)
+            assert prompter.get_response_stream(prompt + text, prompt=prompt) == expected
+
+
+@wrap_test_forked
+def test_history_to_context_incremental():
+    from generate import history_to_context, HistoryContext
+
+    formatted = []
+    format_turn0 = HistoryContext.format_turn
+
+    def format_turn(self, instruction, output):
+        formatted.append(instruction)
+        return format_turn0(self, instruction, output)
+
+    HistoryContext.format_turn = format_turn
+
+    class WordTokenizer:
+        def __call__(self, x):
+            return dict(input_ids=x.split())
+
+    history = [["Question %s?" % i, "Answer %s. %sdoc%s%s" % (i, source_prefix, i, source_postfix)]
+               for i in range(100)] + [["Last question?", None]]
+    # 768 - 256 tokens for memory restriction level 1, about 0.8 of that left for context
+    args = ('ChatLLM', 'human_bot', None, True, 2048, 1, False)
+    context = history_to_context(history, *args, tokenizer1=WordTokenizer())
+    assert len(formatted) == 100
+    # trimmed from front by tokens, sources stripped
+    assert "Question 99?" in context and "Question 0?" not in context
+    assert source_prefix not in context
+    num_words = len(context.split())
+    assert 300 < num_words <= 392
+
+    # only newest turn formatted
+    formatted.clear()
+    history = history[:-1] + [["Last question?", "Last answer."], ["Another question?", None]]
+    context2 = history_to_context(history, *args, tokenizer1=WordTokenizer())
+    assert formatted == ["Last question?"]
+    assert context2.endswith("<human>: Last question?\n<bot>: Last answer.\n")
+
+    # without tokenizer, limit by characters
+    context3 = history_to_context(history, *args)
+    assert "Question 99?" in context3 and len(context3) <= 392 * 4
@@ -0,0 +1,66 @@
+import torch
+
+from tests.utils import wrap_test_forked
+from stopping import StopMatcher, StoppingCriteriaSub
+
+
+@wrap_test_forked
+def test_stop_matcher():
+    matcher = StopMatcher(['he', 'she', 'his', 'hers'])
+    state = 0
+    found = []
+    for i, char in enumerate('ushers'):
+        state, stopis = matcher.step(state, char)
+        found.extend([(i, matcher.stops[x]) for x in stopis])
+    assert sorted(found) == [(3, tuple('he')), (3, tuple('she')), (5, tuple('hers'))]
+
+
+@wrap_test_forked
+def test_stopping_criteria_rows():
+    # stops 0 and 1 need 1 encounter, stops 2 and 3 need 2 encounters
+    stops = [torch.tensor(x) for x in [[7, 8], [9], [5, 6], [4]]]
+    stopper = StoppingCriteriaSub(stops=stops, encounters=[1, 2])
+    prompt = [[1, 2, 7], [1, 2, 3]]
+    input_ids = torch.tensor(prompt)
+    # prompt itself never counts, only stop completed by generated token
+    for new_ids, expected in [([3, 3], [False, False]),
+                              ([4, 4], [False, False]),
+                              ([7, 4], [False, True]),
+                              ([8, 1], [True, True])]:
+        input_ids = torch.cat([input_ids, torch.tensor(new_ids)[:, None]], dim=1)
+        stop = stopper(input_ids, None)
+        assert stopper.stopped == expected
+        assert stop == all(expected)
+
+    # stop spanning end of prompt and first new token
+    stopper = StoppingCriteriaSub(stops=stops, encounters=[1, 2])
+    assert stopper(torch.tensor([prompt[0] + [8]]), None)
+
+    # several tokens added at once between calls are all checked
+    stopper = StoppingCriteriaSub(stops=stops, encounters=[1, 2])
+    assert not stopper(torch.tensor([[1, 2, 3]]), None)
+    assert stopper(torch.tensor([[1, 2, 3, 7, 8, 1]]), None)
+
+
+@wrap_test_forked
+def test_get_stopping():
+    from transformers import AutoTokenizer
+    from stopping import get_stopping
+    tokenizer = AutoTokenizer.from_pretrained('distilgpt2')
+    stopping1 = get_stopping('human_bot', {}, tokenizer, 'cpu')
+    stopping2 = get_stopping('human_bot', {}, tokenizer, 'cpu')
+    # compiled once, but state per generation
+    assert stopping1[0].matcher is stopping2[0].matcher
+    assert stopping1[0] is not stopping2[0]
+
+    prompt = tokenizer('<human>: Hi <bot>:', return_tensors='pt')['input_ids']
+    output = tokenizer(' Hello there.\n<human>:', return_tensors='pt')['input_ids']
+    stopped = []
+    for i in range(1, output.shape[1] + 1):
+        stopped.append(stopping1[0](torch.cat([prompt, output[:, :i]], dim=1), None))
+    assert stopped == [False] * (len(stopped) - 1) + [True]
+
+    stopping = get_stopping('plain', {}, tokenizer, 'cpu', stop_strings=['there'])
+    ids = torch.cat([prompt, output], dim=1)
+    stopped = [stopping[0](ids[:, :i], None) for i in range(prompt.shape[1] + 1, ids.shape[1] + 1)]
+    assert stopped[0] is False and stopped[-1] is True
@@ -32,3 +32,106 @@ merged_list = sorted(list1 + list2)<br>print(merged_list)
 [1, 2, 3, 4, 5, 6, 7, 8, 9, 10]
 ```<br><br>As you can see, the `sorted()` function has merged the two sorted lists into a single sorted list."""
     assert fixed == expected
+
+
+@wrap_test_forked
+def test_model_lock_load_concurrent():
+    import threading
+    import time
+    import generate
+    import gradio_runner
+
+    loading = []
+    max_loading = []
+    loading_lock = threading.Lock()
+
+    def load(name):
+        with loading_lock:
+            loading.append(name)
+            max_loading.append(len(loading))
+        time.sleep(0.2)
+        with loading_lock:
+            loading.remove(name)
+        if name == 'bad':
+            raise RuntimeError("Failed to load %s" % name)
+        return 'model_%s' % name, 'tokenizer_%s' % name, 'cpu'
+
+    def get_model(base_model='', inference_server='', reward_type=None):
+        return load(inference_server or base_model)
+
+    def get_score_model(score_model='', reward_type=None):
+        return load(score_model)
+
+    got_kwargs = {}
+    generate.get_model = get_model
+    generate.get_score_model = get_score_model
+    gradio_runner.go_gradio = lambda **kwargs: got_kwargs.update(kwargs)
+    model_lock = [dict(base_model='model1'), dict(base_model='model2'),
+                  dict(base_model='model3', inference_server='server3')]
+    generate.main(gradio=True, model_lock=model_lock, score_model='score', model_load_workers=1,
+                  langchain_mode='Disabled', prompt_type='plain')
+    # local models and score model one at a time, inference server alongside
+    assert max(max_loading) == 2
+    assert [x['model'] for x in got_kwargs['model_states']] == ['model_model1', 'model_model2', 'model_server3']
+    assert got_kwargs['score_model_state0']['model'] == 'model_score'
+
+    # failed load raised after all loads finished
+    max_loading.clear()
+    try:
+        generate.main(gradio=True, model_lock=[dict(base_model='model1'), dict(base_model='bad')],
+                      score_model='score', model_load_workers=2, langchain_mode='Disabled', prompt_type='plain')
+    except RuntimeError as e:
+        assert 'bad' in str(e)
+    else:
+        raise AssertionError("Expected load failure")
+    assert not loading
+
+
+@wrap_test_forked
+def test_model_lock_load_memory():
+    import threading
+    import time
+    import generate
+    import gradio_runner
+
+    gb = 1024 ** 3
+    sizes = dict(model1=6 * gb, model2=3 * gb, model3=3 * gb, model4=None, score=2 * gb)
+    loaded = []
+    loading = []
+    overlaps = []
+    loading_lock = threading.Lock()
+
+    def load(name):
+        with loading_lock:
+            loading.append(name)
+            overlaps.append(list(loading))
+        time.sleep(0.2)
+        with loading_lock:
+            loading.remove(name)
+            loaded.append(name)
+        return 'model_%s' % name, 'tokenizer_%s' % name, 'cpu'
+
+    def get_model(base_model='', inference_server='', reward_type=None):
+        return load(base_model)
+
+    def get_score_model(score_model='', reward_type=None):
+        return load(score_model)
+
+    def get_free_memory():
+        # models done loading use memory
+        with loading_lock:
+            return 10 * gb - sum(sizes[x] or 0 for x in loaded)
+
+    generate.get_model = get_model
+    generate.get_score_model = get_score_model
+    generate.get_model_bytes = lambda base_model, **kwargs: sizes[base_model]
+    generate.get_free_memory = get_free_memory
+    gradio_runner.go_gradio = lambda **kwargs: None
+    model_lock = [dict(base_model=x) for x in ['model1', 'model2', 'model3', 'model4']]
+    generate.main(gradio=True, model_lock=model_lock, score_model='score', langchain_mode='Disabled',
+                  prompt_type='plain')
+    assert sorted(loaded) == sorted(sizes)
+    # models that fit in free memory load at the same time, model of unknown size loads alone
+    assert max(len(x) for x in overlaps) > 1
+    for names in overlaps:
+        assert len(names) == 1 or ('model4' not in names and sum(sizes[x] for x in names) <= 10 * gb)
@@ -0,0 +1,174 @@
+import queue
+import threading
+import time
+
+from tests.utils import wrap_test_forked
+from gradio_utils.stream_queue import StreamQueue
+from utils import ReadWriteLock
+
+
+@wrap_test_forked
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    events = []
+
+    def reader(name):
+        with lock.read():
+            events.append('start %s' % name)
+            time.sleep(0.5)
+            events.append('end %s' % name)
+
+    def writer():
+        with lock.write():
+            events.append('start writer')
+            events.append('end writer')
+
+    readers = [threading.Thread(target=reader, args=(i,)) for i in range(2)]
+    [x.start() for x in readers]
+    time.sleep(0.1)
+    # readers overlap
+    assert events == ['start 0', 'start 1'] or events == ['start 1', 'start 0']
+    writer_thread = threading.Thread(target=writer)
+    writer_thread.start()
+    [x.join() for x in readers]
+    writer_thread.join()
+    # writer waited for both readers
+    assert events[-2:] == ['start writer', 'end writer']
+
+
+@wrap_test_forked
+def test_stream_queue():
+    stream = StreamQueue(maxsize=2)
+    got = []
+
+    def consumer():
+        for item in stream:
+            got.append(item)
+            time.sleep(0.05)
+
+    thread = threading.Thread(target=consumer)
+    thread.start()
+    for i in range(5):
+        # backpressure, producer never more than maxsize ahead
+        assert stream.put(i)
+        assert len(got) >= i - 2
+    stream.close()
+    thread.join()
+    assert got == list(range(5))
+    assert not stream.put(5)
+
+    # latest only, then end after items already put
+    stream = StreamQueue()
+    [stream.put(x) for x in ['a', 'ab', 'abc']]
+    stream.close()
+    assert stream.get(latest=True) == 'abc'
+    assert list(stream) == []
+
+    # stop wakes waiting consumer and blocked producer
+    stream = StreamQueue(maxsize=1)
+    stream.put('a')
+    results = []
+    producer = threading.Thread(target=lambda: results.append(stream.put('b')))
+    producer.start()
+    time.sleep(0.1)
+    stream.stop()
+    producer.join()
+    assert results == [False]
+    assert list(stream) == []
+
+    stream = StreamQueue()
+    try:
+        stream.get(timeout=0.01)
+        raise AssertionError("should time out")
+    except queue.Empty:
+        pass
+
+
+@wrap_test_forked
+def test_metrics_server():
+    import json
+    import os
+    import tempfile
+    import urllib.request
+    import utils_metrics
+    from utils_metrics import Counter, Histogram, start_metrics_server, dump_metrics_json, track_generation
+
+    counter = Counter('test_requests_total', 'Test requests', ['kind'])
+    counter.inc(kind='a')
+    counter.inc(2, kind='a"b')
+    histogram = Histogram('test_latency_seconds', 'Test latency', buckets=(0.1, 1.0))
+    for value in [0.05, 0.5, 5]:
+        histogram.observe(value)
+
+    @track_generation(num_tokens=lambda args, kwargs, response: len(response.split()))
+    def gen(num):
+        yield dict(response='')
+        for i in range(num):
+            yield dict(response=' '.join(['word'] * (i + 1)))
+
+    # not counted unless metrics served or dumped
+    assert len(list(gen(3))) == 4
+    utils_metrics.count_tokens_enabled = True
+    assert len(list(gen(5))) == 6
+    g = gen(5)
+    next(g)
+    next(g)
+    g.close()
+
+    server = start_metrics_server(0)
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%s/metrics' % server.server_port) as f:
+            text = f.read().decode('utf-8')
+        with urllib.request.urlopen('http://127.0.0.1:%s/metrics.json' % server.server_port) as f:
+            snapshot = json.loads(f.read().decode('utf-8'))
+    finally:
+        server.shutdown()
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{kind="a"} 1' in text
+    assert 'test_requests_total{kind="a\\"b"} 2' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="1.0"} 2' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 3' in text
+    assert 'test_latency_seconds_count 3' in text
+    assert 'h2ogpt_generate_requests_total{status="ok"} 2' in text
+    assert 'h2ogpt_generate_requests_total{status="cancelled"} 1' in text
+    assert 'h2ogpt_generate_output_tokens_total 5' in text
+    assert 'h2ogpt_generate_time_to_first_token_seconds_count 3' in text
+    assert snapshot['metrics']['test_latency_seconds']['samples'][0]['value']['count'] == 3
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        filename = os.path.join(tmpdir, 'metrics.json')
+        dump_metrics_json(filename)
+        with open(filename) as f:
+            snapshot = json.load(f)
+    assert snapshot['metrics']['test_requests_total']['samples'] == [dict(labels=dict(kind='a'), value=1),
+                                                                     dict(labels=dict(kind='a"b'), value=2)]
+
+
+@wrap_test_forked
+def test_lazy_import():
+    import sys
+    from utils import lazy_import, have_package, LazyModule
+    from utils_metrics import startup_seconds
+
+    assert lazy_import('os') is sys.modules['os']
+    assert have_package('numpy')
+    assert have_package('NumPy')
+    assert not have_package('no_such_package_h2ogpt')
+
+    sys.modules.pop('tabulate', None)
+    tabulate = lazy_import('tabulate')
+    assert isinstance(tabulate, LazyModule)
+    assert 'tabulate' not in sys.modules
+    assert 'a' in tabulate.tabulate([['a']])
+    assert 'tabulate' in sys.modules
+    tabulate.PRESERVE_WHITESPACE = True
+    assert sys.modules['tabulate'].PRESERVE_WHITESPACE is True
+    assert dict(phase='import tabulate') in [labels for labels, value in startup_seconds.get_samples()]
+
+    missing = lazy_import('no_such_package_h2ogpt')
+    try:
+        missing.anything
+        raise AssertionError("should have failed")
+    except ModuleNotFoundError:
+        pass
@@ -1,6 +1,7 @@
 import contextlib
 import functools
 import hashlib
+import importlib
 import inspect
 import os
 import gc
@@ -12,6 +13,7 @@ import sys
 import threading
 import time
 import traceback
+import types
 import zipfile
 from datetime import datetime
 
@@ -304,6 +306,50 @@ class NullContext(threading.local):
         pass
 
 
+class ReadWriteLock:
+    """Many concurrent readers or one exclusive writer, writers preferred so they are not starved.
+
+    Not re-entrant, so do not take write() inside read() or write() in same thread.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextlib.contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writer or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
 def wrapped_partial(func, *args, **kwargs):
     """
     Give partial properties of normal function, like __name__ attribute etc.
@@ -825,25 +871,60 @@ def get_kwargs(func, exclude_names=None, **kwargs):
     return kwargs
 
 
-import pkg_resources
+def have_package(name):
+    """
+    Whether distribution is installed, from package metadata only, so the package itself is not imported
+    and no pkg_resources working set is built
+    """
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(name) is not None
+    except PackageNotFoundError:
+        return False
 
-have_faiss = False
 
-try:
-    assert pkg_resources.get_distribution('faiss') is not None
-    have_faiss = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    pass
-try:
-    assert pkg_resources.get_distribution('faiss_gpu') is not None
-    have_faiss = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    pass
-try:
-    assert pkg_resources.get_distribution('faiss_cpu') is not None
-    have_faiss = True
-except (pkg_resources.DistributionNotFound, AssertionError):
-    pass
+have_faiss = have_package('faiss') or have_package('faiss_gpu') or have_package('faiss_cpu')
+
+
+class LazyModule(types.ModuleType):
+    """
+    Stand-in for module, only imported on first attribute access, so optional dependency costs nothing at startup
+    if the feature needing it is never used
+    """
+
+    def __init__(self, name):
+        super().__init__(name)
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            from utils_metrics import startup_phase
+            with startup_phase('import %s' % self.__name__):
+                module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, item):
+        return getattr(self._load(), item)
+
+    def __setattr__(self, key, value):
+        setattr(self._load(), key, value)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self):
+        return "<lazy module %r%s>" % (self.__name__, '' if self.__dict__['_module'] is None else ' (loaded)')
+
+
+def lazy_import(name):
+    """
+    :param name: module name, e.g. 'apscheduler.schedulers.background'
+    :return: module if already imported, else LazyModule that imports it on first use
+    """
+    module = sys.modules.get(name)
+    return module if module is not None else LazyModule(name)
 
 
 def hash_file(file):
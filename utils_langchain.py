@@ -1,46 +1,52 @@
 from typing import Any, Dict, List, Union, Optional
-import time
 import queue
 
 from langchain.callbacks.base import BaseCallbackHandler
 from langchain.schema import LLMResult
 
+from gradio_utils.stream_queue import StreamQueue
+
 
 class StreamingGradioCallbackHandler(BaseCallbackHandler):
     """
     Similar to H2OTextIteratorStreamer that is for HF backend, but here LangChain backend
     """
-    def __init__(self, timeout: Optional[float] = None, block=True):
+    def __init__(self, timeout: Optional[float] = None, maxsize=0):
         super().__init__()
-        self.text_queue = queue.SimpleQueue()
+        self.text_queue = StreamQueue(maxsize=maxsize)
         self.stop_signal = None
         self.do_stop = False
         self.timeout = timeout
-        self.block = block
+
+    @property
+    def do_stop(self):
+        return self.text_queue.stopped
+
+    @do_stop.setter
+    def do_stop(self, value):
+        # e.g. set by EThread if chain fails, wakes consumer and any blocked producer
+        if value:
+            self.text_queue.stop()
 
     def on_llm_start(
         self, serialized: Dict[str, Any], prompts: List[str], **kwargs: Any
     ) -> None:
         """Run when LLM starts running. Clean the queue."""
-        while not self.text_queue.empty():
-            try:
-                self.text_queue.get(block=False)
-            except queue.Empty:
-                continue
+        self.text_queue.clear()
 
     def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
         """Run on new LLM token. Only available when streaming is enabled."""
-        self.text_queue.put(token)
+        self.text_queue.put(token, timeout=self.timeout)
 
     def on_llm_end(self, response: LLMResult, **kwargs: Any) -> None:
         """Run when LLM ends running."""
-        self.text_queue.put(self.stop_signal)
+        self.text_queue.close()
 
     def on_llm_error(
         self, error: Union[Exception, KeyboardInterrupt], **kwargs: Any
     ) -> None:
         """Run when LLM errors."""
-        self.text_queue.put(self.stop_signal)
+        self.text_queue.close()
 
     def __iter__(self):
         return self
@@ -48,17 +54,11 @@ class StreamingGradioCallbackHandler(BaseCallbackHandler):
     def __next__(self):
         while True:
             try:
-                value = self.stop_signal  # value looks unused in pycharm, not true
                 if self.do_stop:
                     print("hit stop", flush=True)
                     # could raise or break, maybe best to raise and make parent see if any exception in thread
                     raise StopIteration()
-                    # break
-                value = self.text_queue.get(block=self.block, timeout=self.timeout)
-                break
+                # raises StopIteration once LLM ended or stopped
+                return self.text_queue.get(timeout=self.timeout)
             except queue.Empty:
-                time.sleep(0.01)
-        if value == self.stop_signal:
-            raise StopIteration()
-        else:
-            return value
+                continue
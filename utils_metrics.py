@@ -0,0 +1,449 @@
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# default histogram buckets, in seconds
+default_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+# output tokens counted by track_generation only if metrics are served or dumped, since counting re-tokenizes output
+count_tokens_enabled = False
+
+# all metrics by name, in order of registration, rendered by /metrics
+metrics_registry = OrderedDict()
+metrics_registry_lock = threading.Lock()
+
+
+class Metric:
+    """
+    Prometheus-like metric, with one value per combination of label values
+    """
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        with metrics_registry_lock:
+            metrics_registry[name] = self
+
+    def get_key(self, labels):
+        assert set(labels) <= set(self.labelnames), "Unknown labels %s for %s" % (labels, self.name)
+        return tuple(str(labels.get(x, '')) for x in self.labelnames)
+
+    def get_samples(self):
+        """
+        :return: list of (labels dict, value)
+        """
+        with self.lock:
+            return [(dict(zip(self.labelnames, key)), value) for key, value in self.values.items()]
+
+    def clear(self):
+        with self.lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        """
+        :param func: if not None, called when collected, returns value, or dict of label values tuple -> value
+        """
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get_samples(self):
+        if self.func is None:
+            return super().get_samples()
+        try:
+            values = self.func()
+        except Exception as e:
+            print("Metric %s failed: %s" % (self.name, str(e)), flush=True)
+            return []
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [(dict(zip(self.labelnames, key)), value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=default_buckets):
+        super().__init__(name, documentation, labelnames=labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self.get_key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = dict(buckets=[0] * len(self.buckets), sum=0.0, count=0)
+            state = self.values[key]
+            for bucketi, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    state['buckets'][bucketi] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def get_samples(self):
+        samples = []
+        for labels, state in super().get_samples():
+            counts = []
+            total = 0
+            # cumulative, like prometheus
+            for bucket, count in zip(self.buckets, state['buckets']):
+                total += count
+                counts.append((format_value(bucket), total))
+            samples.append((labels, dict(buckets=OrderedDict(counts), sum=state['sum'], count=state['count'])))
+        return samples
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, float) and value.is_integer():
+        return '%s.0' % int(value)
+    return str(value)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in labels.items()]
+    return '{%s}' % ','.join(escaped)
+
+
+def get_metrics_text():
+    """
+    :return: all metrics in prometheus text exposition format
+    """
+    with metrics_registry_lock:
+        metrics = list(metrics_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation.replace('\n', ' ')))
+        lines.append('# TYPE %s %s' % (metric.name, metric.type_name))
+        for labels, value in metric.get_samples():
+            if metric.type_name == 'histogram':
+                for le, count in value['buckets'].items():
+                    lines.append('%s_bucket%s %s' % (metric.name, format_labels(dict(labels, le=le)), count))
+                lines.append('%s_sum%s %s' % (metric.name, format_labels(labels), format_value(value['sum'])))
+                lines.append('%s_count%s %s' % (metric.name, format_labels(labels), value['count']))
+            else:
+                lines.append('%s%s %s' % (metric.name, format_labels(labels), format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def get_metrics_snapshot():
+    """
+    :return: dict of all metrics, JSON serializable, e.g. for offline runs without scraping
+    """
+    with metrics_registry_lock:
+        metrics = list(metrics_registry.values())
+    snapshot = OrderedDict(time=time.time(), metrics=OrderedDict())
+    for metric in metrics:
+        snapshot['metrics'][metric.name] = dict(type=metric.type_name, help=metric.documentation,
+                                                samples=[dict(labels=labels, value=value)
+                                                         for labels, value in metric.get_samples()])
+    return snapshot
+
+
+def dump_metrics_json(filename):
+    """
+    Write snapshot of all metrics to filename, atomically so readers never see partial file
+    """
+    dirname = os.path.dirname(filename)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    filename_tmp = filename + '.tmp'
+    with open(filename_tmp, 'wt') as f:
+        json.dump(get_metrics_snapshot(), f, indent=2)
+    os.replace(filename_tmp, filename)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path in ['/metrics', '/']:
+            body = get_metrics_text().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        elif path == '/metrics.json':
+            body = json.dumps(get_metrics_snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes are frequent, avoid filling logs
+        pass
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """
+    Serve /metrics (prometheus text) and /metrics.json (snapshot) from daemon thread
+    :param port: port, 0 picks free port, see server.server_port
+    :param host: local only by default
+    :return: server, call shutdown() to stop
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True)
+    thread.start()
+    print("Serving metrics on http://%s:%s/metrics" % (host, server.server_port), flush=True)
+    return server
+
+
+def get_gpu_memory(reserved=False):
+    import sys
+    # don't import torch just for metrics
+    torch = sys.modules.get('torch')
+    if torch is None or not torch.cuda.is_available():
+        return None
+    if reserved:
+        return {(str(i),): torch.cuda.memory_reserved(i) for i in range(torch.cuda.device_count())}
+    return {(str(i),): torch.cuda.memory_allocated(i) for i in range(torch.cuda.device_count())}
+
+
+generate_requests = Counter('h2ogpt_generate_requests_total', 'Generation requests by final status', ['status'])
+generate_in_progress = Gauge('h2ogpt_generate_in_progress', 'Generation requests currently running')
+generate_time_to_first_token = Histogram('h2ogpt_generate_time_to_first_token_seconds',
+                                         'Time from request to first non-empty output')
+generate_duration = Histogram('h2ogpt_generate_duration_seconds', 'Time from request to last output')
+generate_output_tokens = Counter('h2ogpt_generate_output_tokens_total', 'Tokens of final outputs')
+generate_tokens_per_second = Histogram('h2ogpt_generate_tokens_per_second',
+                                       'Output tokens per second after first token',
+                                       buckets=(1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200, 500, 1000))
+retrieval_duration = Histogram('h2ogpt_retrieval_duration_seconds',
+                               'Time to get documents for query from db', ['langchain_mode'])
+retrieval_docs = Counter('h2ogpt_retrieval_docs_total', 'Documents returned for queries', ['langchain_mode'])
+ingest_files = Counter('h2ogpt_ingest_files_total', 'Files, urls or texts parsed into documents')
+ingest_docs = Counter('h2ogpt_ingest_docs_total', 'Documents (chunks) parsed')
+ingest_duration = Histogram('h2ogpt_ingest_duration_seconds', 'Time to parse a set of paths into documents')
+gradio_events = Counter('h2ogpt_gradio_events_total', 'Gradio queue events processed by final status',
+                        ['event', 'status'])
+gradio_event_duration = Histogram('h2ogpt_gradio_event_duration_seconds', 'Time processing gradio events',
+                                  ['event'])
+gpu_memory_allocated = Gauge('h2ogpt_gpu_memory_allocated_bytes', 'Torch GPU memory allocated', ['device'],
+                             func=get_gpu_memory)
+gpu_memory_reserved = Gauge('h2ogpt_gpu_memory_reserved_bytes', 'Torch GPU memory reserved', ['device'],
+                            func=functools.partial(get_gpu_memory, reserved=True))
+startup_seconds = Gauge('h2ogpt_startup_seconds', 'Time spent in each startup phase, including deferred imports',
+                        ['phase'])
+
+
+def get_status(exc):
+    if exc is None:
+        return 'ok'
+    if isinstance(exc, GeneratorExit):
+        # consumer stopped, e.g. user pressed stop
+        return 'cancelled'
+    return 'error'
+
+
+def track_generation(num_tokens=None):
+    """
+    Decorate generator of dict(response=...) outputs, e.g. evaluate, with time to first token, duration, tokens/sec
+    :param num_tokens: function(args, kwargs, response) -> number of tokens in final response, or None,
+           only called if count_tokens_enabled
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            t0 = time.time()
+            t_first = None
+            response = None
+            exc = None
+            generate_in_progress.inc()
+            try:
+                for res in func(*args, **kwargs):
+                    if t_first is None and isinstance(res, dict) and res.get('response'):
+                        t_first = time.time()
+                        generate_time_to_first_token.observe(t_first - t0)
+                    if isinstance(res, dict):
+                        response = res.get('response')
+                    yield res
+            except BaseException as e:
+                exc = e
+                raise
+            finally:
+                generate_in_progress.dec()
+                generate_requests.inc(status=get_status(exc))
+                t1 = time.time()
+                generate_duration.observe(t1 - t0)
+                if exc is None and num_tokens is not None and count_tokens_enabled and response:
+                    num_tokens1 = num_tokens(args, kwargs, response)
+                    if num_tokens1:
+                        generate_output_tokens.inc(num_tokens1)
+                        if t_first is not None and t1 > t_first and num_tokens1 > 1:
+                            generate_tokens_per_second.observe((num_tokens1 - 1) / (t1 - t_first))
+
+        return wrapper
+
+    return decorator
+
+
+def track_retrieval(func):
+    """
+    Decorate function returning docs first, e.g. get_similarity_chain, with duration and number of docs
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        langchain_mode = kwargs.get('langchain_mode')
+        t0 = time.time()
+        ret = func(*args, **kwargs)
+        retrieval_duration.observe(time.time() - t0, langchain_mode=langchain_mode)
+        if ret and ret[0]:
+            retrieval_docs.inc(len(ret[0]), langchain_mode=langchain_mode)
+        return ret
+
+    return wrapper
+
+
+def track_ingestion(func):
+    """
+    Decorate generator of list of documents per file, e.g. path_to_docs_iter, with files, documents, and duration
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        t0 = time.time()
+        try:
+            for documents in func(*args, **kwargs):
+                ingest_files.inc()
+                ingest_docs.inc(len(documents))
+                yield documents
+        finally:
+            ingest_duration.observe(time.time() - t0)
+
+    return wrapper
+
+
+def track_event(event):
+    """
+    Decorate gradio event function, generator or not, with count and duration
+    """
+
+    def decorator(func):
+        import inspect
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                t0 = time.time()
+                exc = None
+                try:
+                    yield from func(*args, **kwargs)
+                except BaseException as e:
+                    exc = e
+                    raise
+                finally:
+                    gradio_events.inc(event=event, status=get_status(exc))
+                    gradio_event_duration.observe(time.time() - t0, event=event)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                t0 = time.time()
+                exc = None
+                try:
+                    return func(*args, **kwargs)
+                except BaseException as e:
+                    exc = e
+                    raise
+                finally:
+                    gradio_events.inc(event=event, status=get_status(exc))
+                    gradio_event_duration.observe(time.time() - t0, event=event)
+        return wrapper
+
+    return decorator
+
+
+def register_gradio_queue(demo):
+    """
+    Add gauges of gradio queue depth and busy workers, read from demo's queue when collected
+    """
+
+    def get_queue():
+        return getattr(demo, '_queue', None)
+
+    def queue_depth():
+        queue = get_queue()
+        return len(queue.event_queue) if queue is not None else None
+
+    def queue_active():
+        queue = get_queue()
+        return queue.get_active_worker_count() if queue is not None else None
+
+    Gauge('h2ogpt_gradio_queue_depth', 'Gradio events waiting in queue', func=queue_depth)
+    Gauge('h2ogpt_gradio_queue_active_workers', 'Gradio queue workers busy', func=queue_active)
+
+
+def record_startup_phase(phase, t0):
+    """
+    Add time since t0 to startup phase, phases seen again accumulate
+    """
+    startup_seconds.inc(time.time() - t0, phase=phase)
+
+
+@contextlib.contextmanager
+def startup_phase(phase):
+    """
+    Add time spent in block to startup phase
+    """
+    t0 = time.time()
+    try:
+        yield
+    finally:
+        record_startup_phase(phase, t0)
+
+
+def print_startup_phases(start_time=None):
+    """
+    Print time of each startup phase so far, in order first seen
+    :param start_time: if not None, e.g. process creation time, also print wall time since then,
+           phases can overlap, e.g. deferred import during model loading, so do not sum to wall time
+    """
+    lines = ['%-40s %8.3f' % (labels['phase'], value) for labels, value in startup_seconds.get_samples()]
+    if start_time is not None:
+        lines.append('%-40s %8.3f' % ('total (wall)', time.time() - start_time))
+    print("Startup phases (seconds):\n%s" % '\n'.join(lines), flush=True)